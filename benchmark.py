@@ -0,0 +1,363 @@
+import time
+import argparse
+import yaml
+import torch
+from train_emulator import build_model, PeakMemory, freeze_layers, frozen_prefix_length, SuffixModel, prefix_features
+from losses import get_loss_fcn
+from compile_utils import compile_model, compile_optimizer_step
+from emulator import activation_fcn, ActivationFunction, Attention, Transformer
+
+#===================================================================================================
+# training step benchmarks
+#
+# Steps/s of a full training step (forward, loss, backward, Adam) of each architecture in
+# emulator.py on random data, comparing a baseline with an alternative:
+#
+#   python benchmark.py compile --yaml ./projects/lsst_y1/xi_emulator.yaml --probe cosmic_shear
+#
+# compile:    eager vs the --compile path of train_emulator (compile_utils.py)
+# activation: activation_fcn through plain autograd vs the fused ActivationFunction, after checking
+#             the fused gradients with gradcheck and against autograd
+# trf:        the block diagonal Transformer and three-matmul Attention vs their fast versions, after
+#             checking that a state_dict of one gives the same outputs and gradients in the other
+# checkpoint: peak memory and steps/s per batch size without and with activation checkpointing
+#             (CHECKPOINT_BLOCKS), to pick the largest batch that fits
+# prefix:     an early_* fine-tuning step recomputing the frozen prefix (--recompute_frozen_prefix)
+#             vs training on its cached output, after checking both give identical weights
+#
+# The sizes come from the YAML's extrapar, or from the --input_dim/--output_dim/... options.
+
+ARCHS = ['MLP', 'TRF']
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='benchmark')
+
+    parser.add_argument("comparison", choices=['compile', 'activation', 'trf', 'checkpoint', 'prefix'],
+        help="what to compare")
+    parser.add_argument("--yaml", "-y", dest="train_yaml", default=None,
+        help="training YAML to take the layer sizes from. Default=the options below")
+    parser.add_argument("--probe", "-p", dest="probe", default=None,
+        help="the probe of --yaml")
+    parser.add_argument("--archs", "-a", dest="archs", nargs='+', choices=ARCHS, default=ARCHS,
+        help="architectures to benchmark. Default=all")
+    parser.add_argument("--input_dim", dest="input_dim", type=int, default=12,
+        help="(int) number of input parameters. Default=12")
+    parser.add_argument("--output_dim", dest="output_dim", type=int, default=780,
+        help="(int) OUTPUT_DIM. Default=780")
+    parser.add_argument("--int_dim_res", dest="int_dim_res", type=int, default=256,
+        help="(int) INT_DIM_RES. Default=256")
+    parser.add_argument("--int_dim_trf", dest="int_dim_trf", type=int, default=1024,
+        help="(int) INT_DIM_TRF. Default=1024")
+    parser.add_argument("--nc_trf", dest="nc_trf", type=int, default=16,
+        help="(int) NC_TRF. Default=16")
+    parser.add_argument("--batchsize", "-b", dest="batch_size", type=int, default=256,
+        help="(int) batch size. Default=256")
+    parser.add_argument("--batchsizes", "-bs", dest="batch_sizes", type=int, nargs='+', default=[256, 1024, 4096],
+        help="(int) batch sizes of the checkpoint comparison. Default=256 1024 4096")
+    parser.add_argument("--checkpoint_blocks", "-cb", dest="checkpoint_blocks", type=int, default=1,
+        help="(int) CHECKPOINT_BLOCKS of the checkpoint comparison. Default=1")
+    parser.add_argument("--freeze_strategy", "-fs", dest="freeze_strategy", default='early_2',
+        choices=['early_1', 'early_2', 'early_3', 'early_4'],
+        help="freeze strategy of the prefix comparison. Default=early_2")
+    parser.add_argument("--steps", "-s", dest="steps", type=int, default=200,
+        help="(int) timed steps. Default=200")
+    parser.add_argument("--warmup", "-w", dest="warmup", type=int, default=10,
+        help="(int) untimed steps first (compilation happens here). Default=10")
+    parser.add_argument("--threads", "-t", dest="threads", type=int, default=None,
+        help="(int) torch threads. Default=torch's")
+
+    return parser
+
+def model_infos(args):
+    '''
+    input dimension and model_info of every architecture to benchmark
+    '''
+    if args.train_yaml is not None:
+        with open(args.train_yaml, 'r') as stream:
+            extra_args = yaml.safe_load(stream)['train_args'][args.probe]['extra_args']
+        base = dict(extra_args['extrapar'][0])
+        input_dim = len(extra_args['ord'][0])
+    else:
+        base = {}
+        input_dim = args.input_dim
+
+    infos = {}
+    for arch in args.archs:
+        info = {'OUTPUT_DIM': args.output_dim, 'INT_DIM_RES': args.int_dim_res,
+                'INT_DIM_TRF': args.int_dim_trf, 'NC_TRF': args.nc_trf}
+        info.update(base)
+        info['MLA'] = arch
+        infos[arch] = info
+    return input_dim, infos
+
+def time_steps(step, n_steps, n_warmup):
+    '''
+    returns (steps/s, seconds spent in the warmup steps)
+    '''
+    t0 = time.perf_counter()
+    for _ in range(n_warmup):
+        step()
+    warmup = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in range(n_steps):
+        step()
+    return n_steps / (time.perf_counter() - t0), warmup
+
+def training_step(forward, optim_step, optim, X, Y):
+    loss_fcn = get_loss_fcn('hyperbola')
+    def step():
+        loss = loss_fcn(Y, forward(X))
+        optim.zero_grad()
+        loss.backward()
+        optim_step()
+    return step
+
+def saved_tensor_bytes(forward, X):
+    '''
+    bytes of the tensors autograd saves for the backward pass of forward(X), i.e. the activation memory
+    of a training step. Parameters saved by reference are counted too, the same for every variant.
+    '''
+    seen = {}
+    def pack(t):
+        seen[(t.data_ptr(), t.dtype, tuple(t.shape))] = t.numel() * t.element_size()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        forward(X)
+    return sum(seen.values())
+
+def set_fused_activation(model, fused):
+    for m in model.modules():
+        if isinstance(m, activation_fcn):
+            m.fused = fused
+
+def set_fast_trf(model, fast):
+    for m in model.modules():
+        if isinstance(m, (Attention, Transformer)):
+            m.fast = fast
+
+#===================================================================================================
+# comparisons
+
+def bench_compile(args, input_dim, infos):
+    print(f'{"arch":>5s} {"eager steps/s":>14s} {"compiled steps/s":>17s} {"speedup":>8s} {"compile s":>10s} {"backend":>12s}')
+    for arch, info in infos.items():
+        X = torch.randn(args.batch_size, input_dim)
+        Y = torch.randn(args.batch_size, info['OUTPUT_DIM'])
+
+        torch.manual_seed(0)
+        model = build_model(info, input_dim)
+        model.train()
+        optim = torch.optim.Adam(model.parameters(), lr=1e-4)
+        eager, _ = time_steps(training_step(model, optim.step, optim, X, Y), args.steps, args.warmup)
+
+        torch.manual_seed(0)
+        model = build_model(info, input_dim)
+        model.train()
+        optim   = torch.optim.Adam(model.parameters(), lr=1e-4)
+        forward = compile_model(model)
+        step    = compile_optimizer_step(optim)
+        compiled, warmup = time_steps(training_step(forward, step, optim, X, Y), args.steps, args.warmup)
+
+        backend = forward.backend if step.backend == forward.backend else f'{forward.backend}/{step.backend}'
+        print(f'{arch:>5s} {eager:14.1f} {compiled:17.1f} {compiled/eager:7.2f}x {warmup:10.1f} {backend:>12s}')
+
+def check_activation_gradients(batch_size=16, dim=8):
+    '''
+    gradcheck of ActivationFunction in float64, and a check that its outputs and gradients are
+    bit-identical to those of the autograd version in float32. Raises if either fails.
+    '''
+    torch.manual_seed(0)
+    x     = torch.randn(batch_size, dim, dtype=torch.float64, requires_grad=True)
+    gamma = torch.randn(dim, dtype=torch.float64, requires_grad=True)
+    beta  = torch.randn(dim, dtype=torch.float64, requires_grad=True)
+    torch.autograd.gradcheck(ActivationFunction.apply, (x, gamma, beta))
+
+    act = activation_fcn(dim)
+    with torch.no_grad():
+        act.gamma.copy_(gamma)
+        act.beta.copy_(beta)
+    x32 = x.detach().float()
+    grad_out = torch.randn(batch_size, dim)
+
+    grads = []
+    for fused in (False, True):
+        act.fused = fused
+        act.zero_grad()
+        xi = x32.clone().requires_grad_(True)
+        out = act(xi)
+        out.backward(grad_out)
+        grads.append((out.detach(), xi.grad, act.gamma.grad.clone(), act.beta.grad.clone()))
+
+    (out_ref, *grads_ref), (out_fused, *grads_fused) = grads
+    if not torch.equal(out_ref, out_fused):
+        raise AssertionError('the fused activation_fcn forward differs from the autograd one')
+    for name, a, b in zip(('x', 'gamma', 'beta'), grads_fused, grads_ref):
+        if not torch.equal(a, b):
+            raise AssertionError(f'the fused activation_fcn gradient of {name} differs from the autograd one '
+                                 f'(max difference {float((a - b).abs().max()):1.2e})')
+
+def bench_activation(args, input_dim, infos):
+    check_activation_gradients()
+    print('gradcheck passed, outputs and gradients bit-identical to autograd in float32')
+    print('')
+    print(f'{"arch":>5s} {"autograd steps/s":>17s} {"fused steps/s":>14s} {"speedup":>8s} {"autograd saved MB":>18s} {"fused saved MB":>15s}')
+    for arch, info in infos.items():
+        X = torch.randn(args.batch_size, input_dim)
+        Y = torch.randn(args.batch_size, info['OUTPUT_DIM'])
+
+        results = {}
+        for fused in (False, True):
+            torch.manual_seed(0)
+            model = build_model(info, input_dim)
+            model.train()
+            set_fused_activation(model, fused)
+            optim = torch.optim.Adam(model.parameters(), lr=1e-4)
+            rate, _ = time_steps(training_step(model, optim.step, optim, X, Y), args.steps, args.warmup)
+            results[fused] = (rate, saved_tensor_bytes(model, X) / 2**20)
+
+        (rate_ref, mb_ref), (rate_fused, mb_fused) = results[False], results[True]
+        print(f'{arch:>5s} {rate_ref:17.1f} {rate_fused:14.1f} {rate_fused/rate_ref:7.2f}x {mb_ref:18.1f} {mb_fused:15.1f}')
+
+# the fast path sums the same products in another order, so it agrees to float32 rounding
+TRF_RTOL = 1e-4
+TRF_ATOL = 1e-5
+
+def assert_close(name, a, b):
+    '''
+    raises unless a and b agree within TRF_RTOL, and TRF_ATOL relative to the largest |b|
+    '''
+    atol = TRF_ATOL * max(1.0, float(b.abs().max()))
+    if not torch.allclose(a, b, rtol=TRF_RTOL, atol=atol):
+        raise AssertionError(f'{name}: the fast path differs from the block diagonal one '
+                             f'(max difference {float((a - b).abs().max()):1.2e}, atol {atol:1.2e})')
+
+def check_fast_trf(reference, fast, X, Y):
+    '''
+    the outputs in eval and train mode, and the gradients of a training loss, of the two paths
+    '''
+    for train in (False, True):
+        reference.train(train)
+        fast.train(train)
+        with torch.no_grad():
+            assert_close(f'output ({"train" if train else "eval"} mode)', fast(X), reference(X))
+
+    # the train mode forward above updated the BatchNorm running stats of both the same way
+    loss_fcn = get_loss_fcn('hyperbola')
+    for model in (reference, fast):
+        model.zero_grad()
+        loss_fcn(Y, model(X)).backward()
+    grads_ref = dict(reference.named_parameters())
+    for name, p in fast.named_parameters():
+        g_ref = grads_ref[name].grad
+        if p.grad is None or g_ref is None:     # parameters outside the graph, in both or it is a bug
+            if (p.grad is None) != (g_ref is None):
+                raise AssertionError(f'gradient of {name}: computed by only one of the two paths')
+            continue
+        assert_close(f'gradient of {name}', p.grad, g_ref)
+
+def bench_trf(args, input_dim, infos):
+    if 'TRF' not in infos:
+        raise ValueError("the trf comparison needs --archs TRF")
+    info = infos['TRF']
+    X = torch.randn(args.batch_size, input_dim)
+    Y = torch.randn(args.batch_size, info['OUTPUT_DIM'])
+
+    # a model saved by the old code, loaded into the fast one
+    torch.manual_seed(0)
+    reference = build_model(info, input_dim)
+    set_fast_trf(reference, False)
+    fast = build_model(info, input_dim)
+    fast.load_state_dict(reference.state_dict())
+
+    check_fast_trf(reference, fast, X, Y)
+    print(f'outputs and gradients of the fast path match within float32 tolerance (rtol={TRF_RTOL:g}, atol={TRF_ATOL:g} x max)')
+    print('')
+
+    print(f'INT_DIM_TRF={info["INT_DIM_TRF"]} NC_TRF={info["NC_TRF"]}')
+    print(f'{"":>10s} {"steps/s":>10s} {"saved MB":>10s}')
+    rates = {}
+    for name, model in (('block_diag', reference), ('fast', fast)):
+        model.train()
+        optim = torch.optim.Adam(model.parameters(), lr=1e-4)
+        rates[name], _ = time_steps(training_step(model, optim.step, optim, X, Y), args.steps, args.warmup)
+        print(f'{name:>10s} {rates[name]:10.1f} {saved_tensor_bytes(model, X)/2**20:10.1f}')
+    print(f'speedup {rates["fast"]/rates["block_diag"]:.2f}x')
+
+def bench_checkpoint(args, input_dim, infos):
+    print(f'CHECKPOINT_BLOCKS=0 vs {args.checkpoint_blocks}; peak memory of a training step, above the memory in use before it')
+    print(f'{"arch":>5s} {"batch":>6s} {"peak MB":>9s} {"ckpt peak MB":>13s} {"steps/s":>9s} {"ckpt steps/s":>13s}')
+    for arch, info in infos.items():
+        for batch_size in args.batch_sizes:
+            X = torch.randn(batch_size, input_dim)
+            Y = torch.randn(batch_size, info['OUTPUT_DIM'])
+
+            results = []
+            for blocks in (0, args.checkpoint_blocks):
+                torch.manual_seed(0)
+                model = build_model({**info, 'CHECKPOINT_BLOCKS': blocks}, input_dim)
+                model.train()
+                optim = torch.optim.Adam(model.parameters(), lr=1e-4)
+                step  = training_step(model, optim.step, optim, X, Y)
+                step()      # the Adam state exists from here on
+                with PeakMemory('cpu') as mem:
+                    step()
+                rate, _ = time_steps(step, args.steps, args.warmup)
+                results.append((mem.increase / 2**20, rate))
+
+            (mb, rate), (mb_ckpt, rate_ckpt) = results
+            print(f'{arch:>5s} {batch_size:6d} {mb:9.1f} {mb_ckpt:13.1f} {rate:9.1f} {rate_ckpt:13.1f}')
+
+def bench_prefix(args, input_dim, infos):
+    print(f'{args.freeze_strategy}: frozen prefix recomputed every step vs cached once')
+    print(f'{"arch":>5s} {"prefix":>7s} {"recompute steps/s":>18s} {"cached steps/s":>15s} {"speedup":>8s}')
+    for arch, info in infos.items():
+        X = torch.randn(args.batch_size, input_dim)
+        Y = torch.randn(args.batch_size, info['OUTPUT_DIM'])
+
+        models, rates = [], []
+        for cached in (False, True):
+            torch.manual_seed(0)
+            model = build_model(info, input_dim)
+            freeze_layers(model, args.freeze_strategy)
+            model.train()
+            optim = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+
+            n_prefix = frozen_prefix_length(model)
+            if cached and n_prefix > 0:
+                # one chunk: the features of exactly the batch the recomputing step sees
+                forward, X_in = SuffixModel(model, n_prefix), prefix_features(model.model[:n_prefix], X, 'cpu', len(X))
+            else:
+                forward, X_in = model, X
+
+            step = training_step(forward, optim.step, optim, X_in, Y)
+            models.append(model)
+
+            rate, _ = time_steps(step, args.steps, args.warmup)
+            rates.append(rate)
+
+        # both took the same warmup + timed steps
+        ref, fast = models
+        for (name, a), b in zip(ref.state_dict().items(), fast.state_dict().values()):
+            if not torch.equal(a, b):
+                raise AssertionError(f'{arch}: {name} differs between the cached and the recomputed frozen prefix')
+        print(f'{arch:>5s} {n_prefix:7d} {rates[0]:18.1f} {rates[1]:15.1f} {rates[1]/rates[0]:7.2f}x')
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    input_dim, infos = model_infos(args)
+    print(f'Batch size {args.batch_size}, {torch.get_num_threads()} threads, torch {torch.__version__}')
+
+    if args.comparison == 'compile':
+        bench_compile(args, input_dim, infos)
+    elif args.comparison == 'activation':
+        bench_activation(args, input_dim, infos)
+    elif args.comparison == 'trf':
+        bench_trf(args, input_dim, infos)
+    elif args.comparison == 'checkpoint':
+        bench_checkpoint(args, input_dim, infos)
+    elif args.comparison == 'prefix':
+        bench_prefix(args, input_dim, infos)
@@ -0,0 +1,62 @@
+import os
+import random
+import numpy as np
+import torch
+
+#===================================================================================================
+# training checkpoints
+#
+# A checkpoint holds everything the training loop needs to carry on exactly where it stopped:
+# model, optimizer and scheduler state, the next epoch, the RNG states and the loss/metric
+# histories. It is written to a temporary file and renamed into place, so a job killed while
+# writing leaves the previous checkpoint intact.
+
+def get_rng_state():
+    return {
+        'torch':  torch.get_rng_state(),
+        'numpy':  np.random.get_state(),
+        'python': random.getstate(),
+    }
+
+def set_rng_state(rng_state):
+    torch.set_rng_state(rng_state['torch'])
+    np.random.set_state(rng_state['numpy'])
+    random.setstate(rng_state['python'])
+
+def save_checkpoint(filename, epoch, model, optim, scheduler, histories, **extra):
+    '''
+    atomically write a training checkpoint
+
+    string filename: where to write it
+    int    epoch: the next epoch to run
+    dict   histories: the loss/metric lists accumulated so far
+    extra keyword arguments are stored as they are
+    '''
+    state = {
+        'epoch':     epoch,
+        'model':     model.state_dict(),
+        'optim':     optim.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'histories': histories,
+        'rng':       get_rng_state(),
+    }
+    state.update(extra)
+
+    tmp = filename + '.tmp'
+    torch.save(state, tmp)
+    os.replace(tmp, filename)
+
+def load_checkpoint(filename, model, optim, scheduler):
+    '''
+    restore model, optimizer, scheduler and RNG states from a checkpoint
+
+    returns the checkpoint dict (with 'epoch', 'histories' and any extra entries)
+    '''
+    state = torch.load(filename, map_location='cpu', weights_only=False)
+
+    model.load_state_dict(state['model'])
+    optim.load_state_dict(state['optim'])
+    scheduler.load_state_dict(state['scheduler'])
+    set_rng_state(state['rng'])
+
+    return state
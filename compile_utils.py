@@ -0,0 +1,66 @@
+import sys
+import torch
+
+#===================================================================================================
+# compiled training step
+#
+# A ResBlock forward is a chain of small ops (Linear, the Affine scalar multiply-add, then the
+# mul/expit/sub/mul of activation_fcn), each launched on its own and each allocating its output.
+# torch.compile fuses the elementwise chains into a few kernels; on torch versions without it the
+# model is scripted with TorchScript instead. The Adam step, a loop over the parameter tensors, is
+# compiled too.
+#
+# Compilation happens on the first call. If it fails (an unsupported op, no C++ compiler on the
+# node, ...) the step falls back to eager with a warning rather than killing the run. Errors that
+# also happen in eager are raised again by the eager call. Only the first call falls back: an error
+# on a later call is raised, since re-running e.g. a partly applied Adam step would apply it twice.
+
+class CompiledCall:
+    '''
+    callable compiled: the compiled function, tried first
+    callable eager: the eager function it replaces
+    string   backend: 'inductor', 'torchscript' or 'eager'
+    '''
+    def __init__(self, compiled, eager, backend, name):
+        self.compiled = compiled
+        self.eager    = eager
+        self.backend  = backend
+        self.name     = name
+        self.compiled_once = False
+
+    def __call__(self, *args, **kwargs):
+        if self.backend != 'eager':
+            if self.compiled_once:
+                return self.compiled(*args, **kwargs)
+            try:
+                out = self.compiled(*args, **kwargs)
+            except Exception as err:
+                print(f'\nCould not compile the {self.name} ({type(err).__name__}: {err}); running it eagerly', file=sys.stderr)
+                self.backend = 'eager'
+            else:
+                self.compiled_once = True
+                return out
+        return self.eager(*args, **kwargs)
+
+def compile_model(model, name='model'):
+    '''
+    the model's forward, compiled with torch.compile, else scripted with TorchScript, else eager.
+    The parameters are shared with model, so model.state_dict() is unchanged.
+    '''
+    if hasattr(torch, 'compile'):
+        return CompiledCall(torch.compile(model), model, 'inductor', name)
+    try:
+        return CompiledCall(torch.jit.script(model), model, 'torchscript', name)
+    except Exception as err:
+        print(f'Could not script the {name} ({type(err).__name__}: {err}); running it eagerly', file=sys.stderr)
+        return CompiledCall(None, model, 'eager', name)
+
+def compile_optimizer_step(optim):
+    '''
+    optim.step compiled with torch.compile (eager on torch versions without it). The learning rate is
+    a constant of the compiled step: every reduction by the scheduler compiles it once more, and past
+    torch's recompile limit that step simply runs eagerly.
+    '''
+    if hasattr(torch, 'compile'):
+        return CompiledCall(torch.compile(optim.step), optim.step, 'inductor', 'optimizer step')
+    return CompiledCall(None, optim.step, 'eager', 'optimizer step')
@@ -0,0 +1,540 @@
+import os
+import copy
+import json
+import hashlib
+import uuid
+import psutil
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+#===================================================================================================
+# batch iterator
+#
+# The whole training set is already in memory as two tensors, so there is no need for
+# TensorDataset + DataLoader, which builds every batch sample by sample through __getitem__ and
+# default_collate. Instead we (optionally) gather the tensors once per epoch with a seeded
+# permutation and then hand out contiguous slices, which are views and cost nothing.
+
+class BatchIterator:
+    '''
+    iterates over preloaded (x, y) tensors in batches
+
+    tensor  x: (N, input_dim) inputs
+    tensor  y: (N, output_dim) targets
+    int     batch_size: number of samples per batch
+    boolean shuffle: draw a random permutation every epoch (default=False)
+    boolean drop_last: drop the final batch if it is smaller than batch_size (default=True)
+    int     seed: the permutation of epoch e is drawn from a generator seeded with seed+e, so any
+                  epoch can be replayed exactly (default=0)
+    '''
+    def __init__(self, x, y, batch_size, shuffle=False, drop_last=True, seed=0):
+        if len(x) != len(y):
+            raise ValueError(f"x and y have different lengths: {len(x)} and {len(y)}")
+
+        self.x          = x
+        self.y          = y
+        self.batch_size = batch_size
+        self.shuffle    = shuffle
+        self.drop_last  = drop_last
+        self.seed       = seed
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.x) // self.batch_size
+        return -(-len(self.x) // self.batch_size)
+
+    def permutation(self, epoch):
+        '''
+        the sample order used in the given epoch
+        '''
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        return torch.randperm(len(self.x), generator=generator)
+
+    def epoch(self, epoch=0):
+        '''
+        generator over the (X, Y) batches of the given epoch
+        '''
+        if self.shuffle:
+            perm = self.permutation(epoch)
+            x = self.x[perm]
+            y = self.y[perm]
+        else:
+            x = self.x
+            y = self.y
+
+        stop = len(self) * self.batch_size
+        for i in range(0, min(stop, len(x)), self.batch_size):
+            yield x[i:i+self.batch_size], y[i:i+self.batch_size]
+
+    def __iter__(self):
+        return self.epoch(0)
+
+#===================================================================================================
+# parameter tables
+#
+# The *_parameters*.txt files are plain text with a '# name1 name2 ...' header and can be GBs in
+# size. Parsing them takes minutes, so the first load converts the table into a binary .npy
+# sidecar, stored column-major so that every column is contiguous and can be read on its own from
+# a memory map. A small .json next to it records the column names and the size and mtime of the
+# text file; if either changes the sidecar is rebuilt.
+
+def temp_name(path, ext=''):
+    '''
+    a temporary file name next to path, unique to this call, to write to and then os.replace onto
+    path. Concurrent jobs building the same cache each write their own file and the last rename wins.
+    '''
+    return f'{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp{ext}'
+
+def read_parameter_header(filename):
+    '''
+    column names from the '# name1 name2 ...' header of a parameter file
+    '''
+    with open(filename, 'r') as f:
+        return f.readline().split()[1:]
+
+class ParameterTable:
+    '''
+    column-addressable view of a parameter text file, backed by a binary cache
+
+    string filename: the parameter text file
+    string cache_dir: where to keep the cache (default=None, next to the text file)
+    '''
+    def __init__(self, filename, cache_dir=None):
+        self.filename = filename
+
+        if cache_dir is None:
+            prefix = filename
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            prefix = os.path.join(cache_dir, os.path.basename(filename))
+
+        self.cache_file = prefix + '.cache.npy'
+        self.meta_file  = prefix + '.cache.json'
+
+        if not self._cache_is_valid():
+            self._build_cache()
+
+        with open(self.meta_file, 'r') as f:
+            self.names = json.load(f)['names']
+
+        self.table = np.load(self.cache_file, mmap_mode='r') # (n_columns, n_samples)
+
+    def _source_stamp(self):
+        stat = os.stat(self.filename)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def _cache_is_valid(self):
+        if not (os.path.exists(self.cache_file) and os.path.exists(self.meta_file)):
+            return False
+
+        with open(self.meta_file, 'r') as f:
+            meta = json.load(f)
+
+        return meta.get('source') == self._source_stamp()
+
+    def _build_cache(self):
+        print(f'Building parameter cache for {self.filename}. Only done once...')
+
+        stamp = self._source_stamp()
+        names = read_parameter_header(self.filename)
+        table = np.loadtxt(self.filename, ndmin=2)
+
+        if table.shape[1] != len(names):
+            raise ValueError(f"{self.filename}: header has {len(names)} names but the table has {table.shape[1]} columns")
+
+        # write to temporary files and rename, so an interrupted build never leaves a valid-looking cache
+        tmp_cache = temp_name(self.cache_file, '.npy')
+        tmp_meta  = temp_name(self.meta_file)
+
+        np.save(tmp_cache, np.ascontiguousarray(table.T))
+        with open(tmp_meta, 'w') as f:
+            json.dump({'names': names, 'source': stamp}, f)
+
+        os.replace(tmp_cache, self.cache_file)
+        os.replace(tmp_meta, self.meta_file)
+
+    def __len__(self):
+        return self.table.shape[1]
+
+    def column_index(self, name):
+        if name not in self.names:
+            raise ValueError(f"Parameter '{name}' not found in {self.filename}. Columns are {self.names}")
+        return self.names.index(name)
+
+    def columns(self, names, rows=None):
+        '''
+        the requested columns as an (N, len(names)) float64 array
+
+        list  names: column names, in the order wanted
+        slice rows: optional row selection, e.g. slice(0, n_train) (default=None, all rows)
+        '''
+        if rows is None:
+            rows = slice(None)
+        return np.stack([self.table[self.column_index(name), rows] for name in names], axis=1)
+
+#===================================================================================================
+# covariance files
+#
+# cosmolike writes the covariance as one line per (i, j) element, with 3, 4 or 10 columns:
+#   3:  i j cov
+#   4:  i j cov_g cov_ng
+#   10: i j ... cov_g cov_ng       (the total is the sum of the last two columns)
+# We fill the dense matrix with one vectorized assignment and keep the result in a binary .npy
+# sidecar (invalidated by the size and mtime of the text file) so later runs skip the text parse.
+
+def parse_cov_file(cov_file):
+    '''
+    dense symmetric covariance from a cosmolike covariance text file
+    '''
+    full_cov = np.loadtxt(cov_file, ndmin=2)
+    cov_scenario = full_cov.shape[1]
+
+    i = full_cov[:,0].astype(int)
+    j = full_cov[:,1].astype(int)
+
+    if(cov_scenario == 3):
+        cov_ij = full_cov[:,2]
+    elif(cov_scenario == 4):
+        cov_ij = full_cov[:,2] + full_cov[:,3]
+    elif(cov_scenario == 10):
+        cov_ij = full_cov[:,8] + full_cov[:,9]
+    else:
+        raise ValueError(f"{cov_file}: unknown covariance format with {cov_scenario} columns")
+
+    size = int(max(i.max(), j.max()) + 1)
+
+    # the same element may be listed more than once, as (i, j) and (j, i). The last line wins, as
+    # it did when the file was filled line by line.
+    lo  = np.minimum(i, j)
+    hi  = np.maximum(i, j)
+    _, last = np.unique((lo*size + hi)[::-1], return_index=True)
+    last = len(lo) - 1 - last
+
+    cov = np.zeros((size,size))
+    cov[lo[last], hi[last]] = cov_ij[last]
+    cov[hi[last], lo[last]] = cov_ij[last]
+
+    return cov
+
+def load_cov_file(cov_file):
+    '''
+    parse_cov_file, through the binary sidecar <cov_file>.cache.npy
+    '''
+    cache_file = cov_file + '.cache.npy'
+    meta_file  = cov_file + '.cache.json'
+    stamp = file_stamp(cov_file)
+
+    if os.path.exists(cache_file) and os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+            if json.load(f) == stamp:
+                return np.load(cache_file)
+
+    cov = parse_cov_file(cov_file)
+
+    tmp_cache = temp_name(cache_file, '.npy')
+    tmp_meta  = temp_name(meta_file)
+    np.save(tmp_cache, cov)
+    with open(tmp_meta, 'w') as f:
+        json.dump(stamp, f)
+    os.replace(tmp_cache, cache_file)
+    os.replace(tmp_meta, meta_file)
+
+    return cov
+
+#===================================================================================================
+# datavector sources
+#
+# The datavector .npy files hold every probe of the 3x2pt vector for every sample, which for the
+# 1M-sample datasets is far more than we want in RAM. We memory-map them and only ever read the
+# rows we train on (n_train) and the columns of the probe, a chunk at a time.
+
+def fits_in_ram(nbytes, fraction=0.75):
+    '''
+    same test as the dataset generators: does nbytes fit in a fraction of the available RAM?
+    '''
+    return nbytes < fraction * psutil.virtual_memory().available
+
+class DatavectorSource:
+    '''
+    memory-mapped view of the probe columns of a datavector .npy file
+
+    string filename: the datavector .npy file, shape (n_samples, full_dv_length)
+    int    start, stop: probe columns [start, stop)
+    int    n_rows: only use the first n_rows samples (default=None, all of them)
+    '''
+    def __init__(self, filename, start, stop, n_rows=None):
+        self.filename = filename
+        self.data  = np.load(filename, mmap_mode='r', allow_pickle=False)
+        self.start = start
+        self.stop  = stop
+
+        if self.data.ndim != 2:
+            raise ValueError(f"{filename}: datavectors must be 2D, got {self.data.shape}")
+
+        n = self.data.shape[0]
+        if n_rows is not None:
+            if n_rows > n:
+                raise ValueError(f"{filename}: asked for {n_rows} samples but the file only has {n}")
+            n = n_rows
+
+        self.shape = (n, stop-start)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def shard(self, rows):
+        '''
+        a source over the rows in the slice rows only (for data-parallel training). Slicing the
+        memmap reads nothing, each rank only ever touches its own rows.
+        '''
+        shard = copy.copy(self)
+        shard.data  = self.data[:len(self)][rows]
+        shard.shape = (len(shard.data), self.shape[1])
+        return shard
+
+    def read(self, a, b):
+        '''
+        rows [a, b) of the probe columns as a float64 tensor
+        '''
+        b = min(b, len(self))
+        return torch.as_tensor(np.array(self.data[a:b, self.start:self.stop]), dtype=torch.float64)
+
+    def whiten(self, dv_fid, dv_evecs, dv_evals, out=None, chunk_size=8192):
+        '''
+        project every row onto the covariance eigenbasis, (y - dv_fid) @ dv_evecs / sqrt(dv_evals),
+        chunk by chunk, in float64, storing the result as float32.
+
+        tensor dv_fid, dv_evecs, dv_evals: float64 fiducial data vector and covariance eigenpairs
+        array  out: (N, D) float32 array to write into, e.g. a np.memmap (default=None, allocate in RAM)
+        int    chunk_size: rows per chunk (default=8192)
+        returns out, or a float32 tensor if out was None
+        '''
+        return_tensor = out is None
+        if return_tensor:
+            out = np.empty(self.shape, dtype=np.float32)
+
+        sqrt_evals = torch.sqrt(dv_evals)
+        for a in range(0, len(self), chunk_size):
+            y = self.read(a, a+chunk_size)
+            out[a:a+len(y)] = torch.div( (y - dv_fid) @ dv_evecs, sqrt_evals).numpy().astype(np.float32)
+
+        if return_tensor:
+            return torch.from_numpy(out)
+        return out
+
+#===================================================================================================
+# streaming batch iterator
+#
+# When the whitened training set does not fit in RAM it lives in a memmap on disk. We then read it
+# in large contiguous blocks (cheap sequential I/O), prefetching the next block in a background
+# thread while the current one is trained on. Shuffling permutes the block order and the samples
+# within each block, which keeps the reads sequential.
+
+class StreamingBatchIterator:
+    '''
+    iterates over (x, y) in batches where y is read from disk block by block
+
+    tensor  x: (N, input_dim) inputs, in RAM
+    array   y: (N, output_dim) float32 targets, e.g. a np.memmap
+    int     batch_size: number of samples per batch
+    boolean shuffle: shuffle the block order and the samples within each block (default=False)
+    boolean drop_last: drop the final batch if it is smaller than batch_size (default=True)
+    int     seed: epoch e is shuffled with a generator seeded with seed+e (default=0)
+    int     block_size: samples read from disk at once, rounded to a multiple of batch_size (default=65536)
+    '''
+    def __init__(self, x, y, batch_size, shuffle=False, drop_last=True, seed=0, block_size=65536):
+        if len(x) != len(y):
+            raise ValueError(f"x and y have different lengths: {len(x)} and {len(y)}")
+
+        self.x          = x
+        self.y          = y
+        self.batch_size = batch_size
+        self.shuffle    = shuffle
+        self.drop_last  = drop_last
+        self.seed       = seed
+        self.block_size = max(1, block_size // batch_size) * batch_size
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.x) // self.batch_size
+        return -(-len(self.x) // self.batch_size)
+
+    def _read(self, a, b):
+        return self.x[a:b], torch.from_numpy(np.array(self.y[a:b], dtype=np.float32))
+
+    def epoch(self, epoch=0):
+        '''
+        generator over the (X, Y) batches of the given epoch
+        '''
+        n = len(self.x)
+        blocks = [(a, min(a+self.block_size, n)) for a in range(0, n, self.block_size)]
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        if self.shuffle:
+            blocks = [blocks[i] for i in torch.randperm(len(blocks), generator=generator)]
+
+        carry = None
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(self._read, *blocks[0])
+            for k in range(len(blocks)):
+                X, Y = future.result()
+                if k+1 < len(blocks):
+                    future = pool.submit(self._read, *blocks[k+1])
+
+                if self.shuffle:
+                    perm = torch.randperm(len(X), generator=generator)
+                    X = X[perm]
+                    Y = Y[perm]
+
+                # a partial block can land anywhere once blocks are shuffled, so leftovers are
+                # carried over into the next block rather than yielded as a short batch
+                if carry is not None:
+                    X = torch.cat([carry[0], X])
+                    Y = torch.cat([carry[1], Y])
+
+                n_full = (len(X) // self.batch_size) * self.batch_size
+                for i in range(0, n_full, self.batch_size):
+                    yield X[i:i+self.batch_size], Y[i:i+self.batch_size]
+
+                carry = (X[n_full:], Y[n_full:]) if n_full < len(X) else None
+
+        if carry is not None and not self.drop_last:
+            yield carry
+
+    def __iter__(self):
+        return self.epoch(0)
+
+#===================================================================================================
+# preprocessing cache
+#
+# Every run used to redo the same preprocessing: parse the covariance, eigh a ~1000x1000 block and
+# project train/valid/test onto the eigenbasis. The results only depend on the covariance content,
+# the probe slice, the mask and the data files, so we store them on disk under a hash of exactly
+# those inputs. Everything is kept at squeeze_factor=1: squeezing the covariance by s divides
+# its eigenvalues by s and leaves the eigenvectors alone, so the whitened targets of a squeezed
+# run are just sqrt(s) times the cached ones and never need another eigh or projection.
+
+def file_stamp(filename):
+    '''
+    identifies a file by path, size and modification time (cheap, used for large data files)
+    '''
+    stat = os.stat(filename)
+    return {'file': os.path.abspath(filename), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def file_digest(filename, block_size=2**24):
+    '''
+    sha256 of the file content
+    '''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class PreprocessingCache:
+    '''
+    a directory of .npy arrays keyed by a hash of everything they were computed from
+
+    string cache_dir: root of the cache
+    string kind: subdirectory, e.g. 'whitening' or 'inputs'
+    dict   key: json-serializable description of the inputs
+    '''
+    def __init__(self, cache_dir, kind, key):
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+        self.dir = os.path.join(cache_dir, kind, digest)
+        os.makedirs(self.dir, exist_ok=True)
+
+        key_file = os.path.join(self.dir, 'key.json')
+        if not os.path.exists(key_file):
+            tmp = temp_name(key_file)
+            with open(tmp, 'w') as f:
+                json.dump(key, f, indent=2, sort_keys=True)
+            os.replace(tmp, key_file)
+
+    def path(self, name):
+        return os.path.join(self.dir, name + '.npy')
+
+    def has(self, *names):
+        return all(os.path.exists(self.path(name)) for name in names)
+
+    def load(self, name, mmap=False):
+        return np.load(self.path(name), mmap_mode='r' if mmap else None, allow_pickle=False)
+
+    def save(self, name, array):
+        tmp = temp_name(self.path(name), '.npy')
+        np.save(tmp, np.asarray(array))
+        os.replace(tmp, self.path(name))
+
+    def open_memmap(self, name, shape):
+        '''
+        a float32 memmap to fill in; call commit(name) once it is written
+        '''
+        return np.lib.format.open_memmap(temp_name(self.path(name), '.npy'), mode='w+', dtype=np.float32, shape=shape)
+
+    def commit(self, name, memmap):
+        memmap.flush()
+        os.replace(memmap.filename, self.path(name))
+
+def squeeze_tag(squeeze_factor):
+    return f'sf{squeeze_factor:g}'
+
+def cached_eigenbasis(cache, get_covmat, get_dv_fid, squeeze_factor=1.0):
+    '''
+    eigenvalues and eigenvectors of the probe covariance, plus dv_fid, from the cache if present
+
+    PreprocessingCache cache: the whitening cache
+    callable get_covmat: returns the unsqueezed probe covariance as a float64 tensor (only called on a miss)
+    callable get_dv_fid: returns dv_fid as a float64 tensor (only called on a miss)
+    float    squeeze_factor: covariance is divided by this; only rescales the eigenvalues
+    returns dv_evals, dv_evecs, dv_fid as float64 tensors
+    '''
+    if cache.has('dv_evals', 'dv_evecs', 'dv_fid'):
+        print('Loading covariance eigenbasis from', cache.dir)
+        dv_evals = torch.as_tensor(cache.load('dv_evals'))
+        dv_evecs = torch.as_tensor(cache.load('dv_evecs'))
+        dv_fid   = torch.as_tensor(cache.load('dv_fid'))
+    else:
+        dv_evals, dv_evecs = torch.linalg.eigh(get_covmat())
+        dv_fid = get_dv_fid()
+        cache.save('dv_evals', dv_evals.numpy())
+        cache.save('dv_evecs', dv_evecs.numpy())
+        cache.save('dv_fid',   dv_fid.numpy())
+
+    return dv_evals / squeeze_factor, dv_evecs, dv_fid
+
+def cached_targets(cache, name, source, dv_fid, dv_evecs, dv_evals, squeeze_factor=1.0, chunk_size=8192):
+    '''
+    whitened float32 targets of a DatavectorSource, as a read-only memmap of the cached file
+
+    On a miss the squeeze_factor=1 targets are derived by rescaling when they exist, and otherwise
+    projected from the raw datavectors.
+
+    PreprocessingCache cache: the whitening cache
+    string  name: 'y_train', 'y_valid' or 'y_test'
+    DatavectorSource source: the raw datavectors
+    tensor  dv_fid, dv_evecs, dv_evals: as returned by cached_eigenbasis (dv_evals already squeezed)
+    float   squeeze_factor: the squeeze factor dv_evals corresponds to
+    '''
+    tagged = f'{name}_{squeeze_tag(squeeze_factor)}'
+    base   = f'{name}_{squeeze_tag(1.0)}'
+
+    if not cache.has(tagged):
+        out = cache.open_memmap(tagged, source.shape)
+
+        if cache.has(base):
+            print(f'Rescaling cached {base} to squeeze_factor={squeeze_factor:g}')
+            y_base = cache.load(base, mmap=True)
+            scale  = np.float32(np.sqrt(squeeze_factor))
+            for a in range(0, len(out), chunk_size):
+                out[a:a+chunk_size] = y_base[a:a+chunk_size] * scale
+            del y_base
+        else:
+            print(f'Whitening {source.filename}')
+            source.whiten(dv_fid, dv_evecs, dv_evals, out=out, chunk_size=chunk_size)
+
+        cache.commit(tagged, out)
+
+    return cache.load(tagged, mmap=True)
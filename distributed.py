@@ -0,0 +1,127 @@
+import os
+import sys
+from datetime import timedelta
+import torch
+import torch.distributed as dist
+
+#===================================================================================================
+# data-parallel training
+#
+# train_emulator can run as N ranks that each train on their own shard of the training set, with
+# the gradients averaged by DistributedDataParallel over gloo. The ranks are launched with either
+#
+#   torchrun --nproc_per_node=40 train_emulator.py ... --distributed
+#   mpirun -n 96 python train_emulator.py ... --distributed
+#
+# torchrun sets RANK/WORLD_SIZE/LOCAL_RANK itself; under mpirun they are read from the Open MPI or
+# MPICH/Intel MPI variables. Across nodes, MASTER_ADDR must point at the node running rank 0.
+# When torch.distributed is not initialized every helper below behaves as a single process.
+
+# (rank, world size, local rank, local world size) variables of each launcher
+_LAUNCHER_ENV = [
+    ('RANK',                 'WORLD_SIZE',           'LOCAL_RANK',                 'LOCAL_WORLD_SIZE'),
+    ('OMPI_COMM_WORLD_RANK', 'OMPI_COMM_WORLD_SIZE', 'OMPI_COMM_WORLD_LOCAL_RANK', 'OMPI_COMM_WORLD_LOCAL_SIZE'),
+    ('PMI_RANK',             'PMI_SIZE',             'MPI_LOCALRANKID',            'MPI_LOCALNRANKS'),
+]
+
+# stdout of this process while the ranks other than 0 have theirs silenced
+_stdout = None
+
+def _launcher_env():
+    for rank, size, local_rank, local_size in _LAUNCHER_ENV:
+        if rank in os.environ and size in os.environ:
+            return (int(os.environ[rank]), int(os.environ[size]),
+                    int(os.environ.get(local_rank, 0)), int(os.environ.get(local_size, 1)))
+    return 0, 1, 0, 1
+
+def init_distributed(backend='gloo'):
+    '''
+    join the process group set up by torchrun or mpirun
+
+    returns (rank, world_size, local_rank)
+    '''
+    rank, world_size, local_rank, local_world_size = _launcher_env()
+    if world_size == 1:
+        return 0, 1, 0
+
+    os.environ['RANK']       = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+
+    # the other ranks wait while rank 0 builds the caches, which on a first run can take far longer
+    # than the default 30 minute timeout
+    dist.init_process_group(backend=backend, init_method='env://', rank=rank, world_size=world_size,
+        timeout=timedelta(hours=4))
+
+    # torchrun pins OMP_NUM_THREADS, mpirun does not: split the cores of the node between its ranks
+    # rather than letting every rank start one thread per core
+    if 'OMP_NUM_THREADS' not in os.environ:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+
+    # only rank 0 prints its progress. stderr stays open on every rank for warnings and errors.
+    global _stdout
+    if rank != 0:
+        _stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    return rank, world_size, local_rank
+
+def cleanup_distributed():
+    global _stdout
+    if dist.is_initialized():
+        dist.destroy_process_group()
+    if _stdout is not None:
+        sys.stdout.close()
+        sys.stdout, _stdout = _stdout, None
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+def shard_slice(n, rank, world_size, equal=False):
+    '''
+    the contiguous rows [a, b) of n rows owned by rank. With equal=True every shard has n // world_size
+    rows and the remainder is dropped (training, where all ranks must run the same number of
+    batches); otherwise the remainder is spread over the first ranks so every row is covered.
+    '''
+    if equal:
+        size = n // world_size
+        return slice(rank*size, (rank+1)*size)
+    return slice(rank*n // world_size, (rank+1)*n // world_size)
+
+def broadcast_tensor(tensor, src=0):
+    '''
+    overwrite tensor in place with its value on rank src
+    '''
+    if dist.is_initialized():
+        dist.broadcast(tensor, src)
+    return tensor
+
+def all_reduce_mean(value, weight=1.0):
+    '''
+    weighted mean of a python float over all ranks
+    '''
+    if not dist.is_initialized():
+        return value
+    t = torch.tensor([value*weight, weight], dtype=torch.float64)
+    dist.all_reduce(t)
+    return float(t[0] / t[1])
+
+def all_gather_cat(tensor):
+    '''
+    concatenate the 1D tensors of all ranks (they may have different lengths)
+    '''
+    if not dist.is_initialized():
+        return tensor
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, tensor.cpu())
+    return torch.cat(gathered).to(tensor.device)
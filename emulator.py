@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
+from contextlib import contextmanager, nullcontext
 from torch.distributions import MultivariateNormal
 import numpy as np
 import os
@@ -8,7 +10,48 @@ import sys
 from datetime import datetime
 import h5py as h5
 
+class ActivationFunction(torch.autograd.Function):
+    '''
+    (gamma + expit(beta*x)*(1-gamma)) * x with a hand-written backward. Autograd would keep beta*x,
+    the sigmoid, 1-gamma, the sum and more alive for the backward pass; here only x is saved (gamma
+    and beta are the parameters) and the sigmoid is recomputed. Forward and backward are the same
+    sequences of ops as the autograd version, so outputs and gradients are bit-identical.
+    '''
+    generate_vmap_rule = True     # ensembles call it under vmap
+
+    @staticmethod
+    def forward(x, gamma, beta):
+        inv = torch.special.expit(torch.mul(beta,x))
+        return torch.mul(gamma + torch.mul(inv,1-gamma), x)
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        x, gamma, beta = inputs
+        ctx.save_for_backward(x, gamma, beta)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, gamma, beta = ctx.saved_tensors
+        inv   = torch.special.expit(torch.mul(beta,x))
+        fac_2 = 1-gamma
+
+        # as autograd: out = s*x with s = gamma + inv*fac_2, then back through the sum, the product
+        # and the sigmoid (its own backward kernel), reducing the broadcast parameters with sum_to_size
+        grad_s   = grad_out * x
+        grad_exp = torch.ops.aten.sigmoid_backward(grad_s * fac_2, inv)
+
+        grad_x = grad_gamma = grad_beta = None
+        if ctx.needs_input_grad[0]:
+            grad_x = grad_out * (gamma + torch.mul(inv,fac_2)) + grad_exp * beta
+        if ctx.needs_input_grad[1]:
+            grad_gamma = grad_s.sum_to_size(gamma.shape) - (grad_s * inv).sum_to_size(gamma.shape)
+        if ctx.needs_input_grad[2]:
+            grad_beta = (grad_exp * x).sum_to_size(beta.shape)
+        return grad_x, grad_gamma, grad_beta
+
 class activation_fcn(nn.Module):
+    fused = True    # False for the plain autograd version, e.g. to compare with it
+
     def __init__(self, dim):
         super(activation_fcn, self).__init__()
 
@@ -17,6 +60,9 @@ class activation_fcn(nn.Module):
         self.beta = nn.Parameter(torch.zeros((dim)))
 
     def forward(self,x):
+        if self.fused:
+            return ActivationFunction.apply(x, self.gamma, self.beta)
+
         exp = torch.mul(self.beta,x)
         inv = torch.special.expit(exp)
         fac_2 = 1-self.gamma
@@ -62,6 +108,11 @@ class ResBlock(nn.Module):
         return o3
 
 class Attention(nn.Module):
+    # fast=True computes Q, K and V with one matmul against the concatenated WQ/WK/WV weights, False
+    # with three as originally. Note the softmax runs over the query axis (dim=1 of QK^T), not over
+    # the keys, so this is not the attention of scaled_dot_product_attention and cannot use it.
+    fast = True
+
     def __init__(self, in_size ,n_partitions):
         super(Attention, self).__init__()
 
@@ -80,11 +131,16 @@ class Attention(nn.Module):
         batch_size = x.shape[0]
         _x = x_norm.reshape(batch_size,self.n_partitions,self.embed_dim) # put into channels
 
-        Q = self.WQ(_x) # query with q_i as rows
-        K = self.WK(_x) # key   with k_i as rows
-        V = self.WV(_x) # value with v_i as rows
+        if self.fast:
+            W = torch.cat((self.WQ.weight, self.WK.weight, self.WV.weight))
+            b = torch.cat((self.WQ.bias,   self.WK.bias,   self.WV.bias))
+            Q, K, V = F.linear(_x, W, b).split(self.embed_dim, dim=-1)
+        else:
+            Q = self.WQ(_x) # query with q_i as rows
+            K = self.WK(_x) # key   with k_i as rows
+            V = self.WV(_x) # value with v_i as rows
 
-        dot_product = torch.bmm(Q,K.transpose(1, 2).contiguous())
+        dot_product = torch.bmm(Q,K.transpose(1, 2))
         normed_mat  = self.act(dot_product/self.scale)
         prod        = torch.bmm(normed_mat,V)
 
@@ -94,6 +150,12 @@ class Attention(nn.Module):
         return out
 
 class Transformer(nn.Module):
+    # fast=True multiplies each of the n_partitions blocks of x by its own weight matrix with one bmm.
+    # fast=False builds the (in_size, in_size) block diagonal matrix every forward and multiplies by
+    # it, n_partitions times the FLOPs (all but 1/n_partitions of them on zeros). The weights are the
+    # same parameters either way, so checkpoints load into both.
+    fast = True
+
     def __init__(self, in_size, n_partitions):
         super(Transformer, self).__init__()  
     
@@ -129,7 +191,22 @@ class Transformer(nn.Module):
         bound2 = 1 / np.sqrt(fan_in2) 
         nn.init.uniform_(self.bias2, -bound2, bound2)
 
+    def block_matmul(self, x, weights):
+        '''
+        x @ block_diag(*weights) without building the block diagonal matrix
+        '''
+        batch_size = x.shape[0]
+        x_blocks = x.reshape(batch_size, self.n_partitions, self.int_dim).transpose(0, 1)  # (n, batch, int_dim)
+        return torch.bmm(x_blocks, weights).transpose(0, 1).reshape(batch_size, self.in_size)
+
     def forward(self,x):
+        if self.fast:
+            o1 = self.norm(self.block_matmul(x, self.weights1)+self.bias1)
+            o2 = self.act(o1)
+            o3 = self.block_matmul(o1, self.weights2) + self.bias2 + x
+            o4 = self.act3(o3)
+            return o4
+
         mat1 = torch.block_diag(*self.weights1) # how can I do this on init rather than on each forward pass?
         mat2 = torch.block_diag(*self.weights2)
 
@@ -139,8 +216,64 @@ class Transformer(nn.Module):
         o4 = self.act3(o3)
         return o4
 
+#===================================================================================================
+# activation checkpointing. With checkpoint_blocks=k the residual blocks of the network (ResBlock,
+# Attention, Transformer) are run in groups of k consecutive blocks under torch.utils.checkpoint:
+# only the input of each group is kept for backward and its insides are recomputed then. Larger k
+# saves more memory for the same recomputation (every block is recomputed once in any case).
+
+CHECKPOINT_BLOCK_TYPES = (ResBlock, Attention, Transformer)
+
+@contextmanager
+def frozen_batchnorm_stats(modules):
+    '''
+    BatchNorm momentum 0 for the recomputation, so that the running statistics are only updated once
+    per training step as without checkpointing
+    '''
+    norms = [m for m in modules if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momenta = [m.momentum for m in norms]
+    for m in norms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, momentum in zip(norms, momenta):
+            m.momentum = momentum
+
+def checkpointed_forward(layers, x, checkpoint_blocks):
+    '''
+    layers(x) for an nn.Sequential, with its residual blocks checkpointed in groups of checkpoint_blocks
+    '''
+    def run(group):
+        def forward(x):
+            for layer in group:
+                x = layer(x)
+            return x
+        return forward
+
+    def checkpoint(group, x):
+        modules = [m for layer in group for m in layer.modules()]
+        return torch.utils.checkpoint.checkpoint(run(group), x, use_reentrant=False,
+            context_fn=lambda: (nullcontext(), frozen_batchnorm_stats(modules)))
+
+    group = []
+    for layer in layers:
+        if isinstance(layer, CHECKPOINT_BLOCK_TYPES):
+            group.append(layer)
+            if len(group) == checkpoint_blocks:
+                x = checkpoint(group, x)
+                group = []
+            continue
+        if group:
+            x = checkpoint(group, x)
+            group = []
+        x = layer(x)
+    if group:
+        x = checkpoint(group, x)
+    return x
+
 class ResMLP(nn.Module):
-    def __init__(self, input_dim, output_dim, int_dim_res):
+    def __init__(self, input_dim, output_dim, int_dim_res, checkpoint_blocks=0):
         super(ResMLP, self).__init__()  
         layers = []
 
@@ -152,13 +285,16 @@ class ResMLP(nn.Module):
         layers.append(Affine())
 
         self.model = nn.Sequential(*layers)
+        self.checkpoint_blocks = checkpoint_blocks
 
     def forward(self, x):
+        if self.checkpoint_blocks > 0 and self.training and torch.is_grad_enabled():
+            return checkpointed_forward(self.model, x, self.checkpoint_blocks)
         out = self.model(x)
         return out
 
 class ResTRF(nn.Module):
-    def __init__(self, input_dim, output_dim, int_dim_res, int_dim_trf, N_channels):
+    def __init__(self, input_dim, output_dim, int_dim_res, int_dim_trf, N_channels, checkpoint_blocks=0):
         super(ResTRF, self).__init__()  
         layers = []
 
@@ -177,8 +313,11 @@ class ResTRF(nn.Module):
         layers.append(Affine())
 
         self.model = nn.Sequential(*layers)
+        self.checkpoint_blocks = checkpoint_blocks
 
     def forward(self, x):
+        if self.checkpoint_blocks > 0 and self.training and torch.is_grad_enabled():
+            return checkpointed_forward(self.model, x, self.checkpoint_blocks)
         out = self.model(x)
         return out
 
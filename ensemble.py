@@ -0,0 +1,83 @@
+import os
+import copy
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+from losses import chi2_rows
+
+#===================================================================================================
+# multi-seed ensembles
+#
+# K replicas of the same (small) emulator are trained in one process on the same batches. Every
+# forward pass stacks their parameters along a new leading axis and evaluates all K at once with
+# vmap, so the replicas share one pass over the data and one set of (K times wider) matmuls
+# instead of K processes each loading the data and running tiny matmuls.
+#
+# The stacking is done with torch.stack on every forward rather than once with
+# stack_module_state, so that the gradients flow back into each replica's own parameters. Each
+# replica therefore stays an ordinary nn.Module with its own optimizer, scheduler and state_dict,
+# and behaves exactly like a separate run (other than sharing the batch order).
+
+class ModelEnsemble:
+    '''
+    list models: K modules of the same architecture, already on the right device
+
+    Calling the ensemble on a (B, input_dim) batch returns the (K, B, output_dim) predictions.
+    Modules whose forward depends on running statistics (BatchNorm, i.e. ResTRF) are not supported.
+    '''
+    def __init__(self, models):
+        self.models = models
+        self.names  = [name for name, _ in models[0].named_parameters()]
+
+        # buffers are not trained, stacking them once is enough
+        _, self.buffers = stack_module_state(models)
+
+        # a stateless copy of the architecture that functional_call fills with the stacked tensors
+        base = copy.deepcopy(models[0]).to('meta')
+        def call(params, buffers, x):
+            return functional_call(base, (params, buffers), (x,))
+
+        self._forward = vmap(call, in_dims=(0, 0, None))
+
+    def __len__(self):
+        return len(self.models)
+
+    def __call__(self, x):
+        params = {name: torch.stack([m.get_parameter(name) for m in self.models]) for name in self.names}
+        return self._forward(params, self.buffers, x)
+
+    def train(self):
+        for m in self.models:
+            m.train()
+
+    def eval(self):
+        for m in self.models:
+            m.eval()
+
+def eval_ensemble_delta_chi2(ensemble, x, y, device, chunk_size=4096):
+    '''
+    delta chi2 of every replica on every sample in (x, y), evaluated in chunks
+
+    returns a (K, N) tensor on device
+    '''
+    n = len(x)
+    delta_chi2 = torch.empty((len(ensemble), n), dtype=torch.float32, device=device)
+
+    ensemble.eval()
+    with torch.inference_mode():
+        for i in range(0, n, chunk_size):
+            X = x[i:i+chunk_size].to(device)
+            Y = y[i:i+chunk_size].to(device)
+            delta_chi2[:, i:i+chunk_size] = chi2_rows(Y - ensemble(X))
+
+    return delta_chi2
+
+def replica_filenames(model_filename, extra_filename, seed):
+    '''
+    the model and .h5 filenames of the replica with the given seed. The seed goes at the end of the
+    model filename; the .h5 keeps the <model file>.h5 convention if the YAML follows it.
+    '''
+    model_k = f'{model_filename}_seed{seed}'
+    if extra_filename == model_filename + '.h5':
+        return model_k, model_k + '.h5'
+    root, ext = os.path.splitext(extra_filename)
+    return model_k, f'{root}_seed{seed}{ext}'
@@ -1,7 +1,7 @@
 #!/bin/bash
 # =============================================================================
 # TL N_train sweep: LCDM -> w0wa, Takahashi, T500 run1 (COLUMN-MASKED INPUT)
-# Locks the 15 pretrained input columns via MASK_INPUT_COLS; only the new
+# Locks the 15 pretrained input columns via --lock_input_cols; only the new
 # (w, w0pwa) columns plus the strategy's unfrozen layers train.
 # Base: LCDM taka run4 N500k checkpoint (bs32), input layer padded 15 -> 17
 #   with zero columns appended for (w, w0pwa); see pad_lcdm_to_w0wa.py
@@ -59,7 +59,6 @@ check_file() {
     echo "  ✓ $1"
 }
 check_file "${TRAIN_SCRIPT}"
-grep -q "MASK_INPUT_COLS" "${TRAIN_SCRIPT}" || { echo "ERROR: train_emulator.py is missing the MASK_INPUT_COLS patch"; exit 1; }
 check_file "${BASE_YAML}"
 check_file "${PRETRAINED_MODEL}"
 check_file "${PRETRAINED_MODEL%.pt}.h5"
@@ -147,7 +146,7 @@ PYEOF
     echo "Starting training..."
     TRAIN_START=$(date +%s)
 
-    MASK_INPUT_COLS=15 python "${TRAIN_SCRIPT}" \
+    python "${TRAIN_SCRIPT}" \
         --yaml "${TEMP_YAML}" \
         --probe "${PROBE}" \
         --learning_rate "${LEARNING_RATE}" \
@@ -159,6 +158,7 @@ PYEOF
         --transfer_learning True \
         --pretrained_model "${PRETRAINED_MODEL}" \
         --freeze_strategy "${FREEZE_STRATEGY}" \
+        --lock_input_cols 15 \
         2>&1 | tee "${LOG_DIR}/train_${FREEZE_STRATEGY}_N${size}.log"
 
     TRAIN_EXIT_CODE=${PIPESTATUS[0]}
@@ -0,0 +1,115 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from emulator import ResBlock
+
+#===================================================================================================
+# low-rank adapters (LoRA) for transfer learning
+#
+# freeze_strategy='lora' keeps every pretrained weight frozen and learns a low-rank update
+# W + (alpha/r) B A next to the chosen nn.Linear layers, with A (r, in) and B (out, r). B starts at
+# zero, so training starts exactly from the pretrained model. The activation_fcn and Affine
+# parameters stay trainable (see freeze_layers). The rank of each group of layers sets how far the
+# model can move, between freezing it and fine-tuning it all:
+#
+#   input:  model.0, the input projection
+#   res:    layer1 and layer2 of every ResBlock
+#   output: the output projection, the Linear before the final Affine
+#
+# At the end merge_lora folds the updates into the weights, so the saved model is a plain ResMLP or
+# ResTRF with the usual state_dict and the usual inference cost.
+
+LORA_GROUPS = ['input', 'res', 'output']
+
+class LoRALinear(nn.Module):
+    '''
+    nn.Linear base (frozen) plus the trainable update (alpha/rank) * lora_B @ lora_A
+    '''
+    def __init__(self, base, rank, alpha=None):
+        super(LoRALinear, self).__init__()
+
+        self.base  = base
+        self.rank  = rank
+        self.scale = (alpha if alpha is not None else rank) / rank
+
+        for p in self.base.parameters():
+            p.requires_grad = False
+
+        kwargs = {'device': base.weight.device, 'dtype': base.weight.dtype}
+        self.lora_A = nn.Parameter(torch.empty((rank, base.in_features), **kwargs))
+        self.lora_B = nn.Parameter(torch.zeros((base.out_features, rank), **kwargs))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))     # as nn.Linear
+
+    def forward(self, x):
+        return self.base(x) + F.linear(F.linear(x, self.lora_A), self.lora_B) * self.scale
+
+    def merged(self):
+        '''
+        an nn.Linear with the update folded into its weight
+        '''
+        linear = nn.Linear(self.base.in_features, self.base.out_features, bias=self.base.bias is not None,
+                           device=self.base.weight.device, dtype=self.base.weight.dtype)
+        with torch.no_grad():
+            linear.weight.copy_(self.base.weight + self.scale * (self.lora_B @ self.lora_A))
+            if self.base.bias is not None:
+                linear.bias.copy_(self.base.bias)
+        return linear
+
+def lora_targets(model):
+    '''
+    (parent module, attribute name) of the nn.Linear layers of each group
+    '''
+    layers = model.model
+    targets = {
+        'input':  [(layers, '0')],
+        'res':    [],
+        'output': [(layers, str(len(layers)-2))],
+    }
+    for layer in layers:
+        if isinstance(layer, ResBlock):
+            targets['res'] += [(layer, 'layer1'), (layer, 'layer2')]
+    return targets
+
+def parse_lora_ranks(specs):
+    '''
+    ['res=8', 'input=4', ...] -> {'res': 8, 'input': 4, ...}. Groups not listed get rank 0 (no adapter).
+    '''
+    ranks = {group: 0 for group in LORA_GROUPS}
+    for spec in specs:
+        group, _, rank = spec.partition('=')
+        if group not in LORA_GROUPS or not rank.isdigit():
+            raise ValueError(f"LoRA ranks are given as <group>=<rank> with group one of {LORA_GROUPS}, not '{spec}'")
+        ranks[group] = int(rank)
+    return ranks
+
+def add_lora_adapters(model, ranks, alpha=None):
+    '''
+    wrap the nn.Linear layers of every group with rank > 0 in a LoRALinear, in place
+
+    returns the number of adapter parameters
+    '''
+    n_params = 0
+    for group, targets in lora_targets(model).items():
+        rank = ranks.get(group, 0)
+        if rank <= 0:
+            continue
+        for parent, name in targets:
+            base = getattr(parent, name)
+            if not isinstance(base, nn.Linear):
+                raise TypeError(f"LoRA group '{group}': {name} is a {type(base).__name__}, not an nn.Linear")
+            adapter = LoRALinear(base, min(rank, base.in_features, base.out_features), alpha)
+            setattr(parent, name, adapter)
+            n_params += adapter.lora_A.numel() + adapter.lora_B.numel()
+    return n_params
+
+def merge_lora(model):
+    '''
+    replace every LoRALinear of model by its merged nn.Linear, in place. The state_dict is then that of
+    the plain architecture.
+    '''
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, LoRALinear):
+                setattr(module, name, child.merged())
+    return model
@@ -0,0 +1,124 @@
+import torch
+
+#===================================================================================================
+# chi2 in the whitened basis
+#
+# The emulator output lives in the basis where the data covariance is the identity
+# (dv_norm = D^{-1/2} U^{-1} dv, see the reminder at the end of train_emulator), so the chi2 of
+# one sample is just the squared norm of its residual. We reduce along the data vector axis,
+# which is O(B*D) and works for any batch size, including a ragged final batch.
+# The old torch.diag(diff @ diff.T) built a BxB matrix just to read its diagonal.
+
+def chi2_rows(diff):
+    '''
+    per-sample chi2 of whitened residuals
+
+    tensor diff: (B, D) residuals in the whitened basis
+    returns a (B,) tensor
+    '''
+    return torch.sum(diff*diff, dim=-1)
+
+#===================================================================================================
+# loss forms. All take the (B,) chi2 vector and return a scalar.
+
+def loss_chi2(chi2):
+    return torch.mean(chi2)                      # ordinary chi2
+
+def loss_hyperbola(chi2):
+    return torch.mean((1+2*chi2)**(1/2))-1       # hyperbola
+
+def loss_sqrt_chi2(chi2):
+    return torch.mean(chi2**(1/2))               # sqrt(chi2)
+
+LOSS_FORMS = {
+    'chi2':      loss_chi2,
+    'hyperbola': loss_hyperbola,
+    'sqrt_chi2': loss_sqrt_chi2,
+}
+
+def get_loss_fcn(loss_form):
+    '''
+    returns a function (Y_batch, Y_pred) -> scalar loss for the requested form
+
+    string loss_form: one of 'chi2', 'hyperbola', 'sqrt_chi2'
+    '''
+    if loss_form not in LOSS_FORMS:
+        raise ValueError(f"Unknown loss_form: {loss_form}. Options are {list(LOSS_FORMS.keys())}")
+
+    reduce = LOSS_FORMS[loss_form]
+
+    def loss_fcn(Y_batch, Y_pred):
+        return reduce(chi2_rows(Y_batch - Y_pred))
+
+    return loss_fcn
+
+def get_ensemble_loss_fcn(loss_form):
+    '''
+    the same losses for K stacked replicas: returns a function (Y_batch, Y_pred) -> (K,) tensor
+    with the loss of every replica, where Y_pred is (K, B, D) and Y_batch is (B, D)
+    '''
+    if loss_form not in LOSS_FORMS:
+        raise ValueError(f"Unknown loss_form: {loss_form}. Options are {list(LOSS_FORMS.keys())}")
+
+    reduce = torch.vmap(LOSS_FORMS[loss_form])
+
+    def loss_fcn(Y_batch, Y_pred):
+        return reduce(chi2_rows(Y_batch - Y_pred))
+
+    return loss_fcn
+
+#===================================================================================================
+# streaming test set evaluation
+#
+# Walks the test set in fixed-size chunks so we never hold the full forward pass (or worse, an
+# NxN matrix) in memory. The per-sample delta chi2 is written into a preallocated vector.
+
+def eval_delta_chi2(model, x, y, device, chunk_size=4096):
+    '''
+    delta chi2 of every sample in (x, y), evaluated in chunks
+
+    nn.Module model: the emulator
+    tensor    x: (N, input_dim) normalized inputs
+    tensor    y: (N, D) whitened data vectors
+    string    device: device to run the model on
+    int       chunk_size: number of samples per forward pass (default=4096)
+    returns a (N,) tensor on device
+    '''
+    n = len(x)
+    delta_chi2 = torch.empty(n, dtype=torch.float32, device=device)
+
+    model.eval()
+    with torch.inference_mode():
+        for i in range(0, n, chunk_size):
+            X = x[i:i+chunk_size].to(device)
+            Y = y[i:i+chunk_size].to(device)
+            delta_chi2[i:i+chunk_size] = chi2_rows(Y - model(X))
+
+    return delta_chi2
+
+def chi2_metrics(delta_chi2):
+    '''
+    summary statistics of a delta chi2 vector
+
+    returns a dict with the mean and median, the number of points with chi2 > 0.2, >= 1 and < 0.2,
+    the corresponding fractions, and whether the fractional criterion (frac < 0.2 above 0.1) is met.
+    '''
+    n_total  = delta_chi2.numel()
+    n_gt_0p2 = int(torch.count_nonzero(delta_chi2 > 0.2))
+    n_gt_1   = int(torch.count_nonzero(delta_chi2 >= 1))
+    n_lt_0p2 = int(torch.count_nonzero(delta_chi2 < 0.2))
+
+    frac_lt_0p2 = n_lt_0p2 / n_total
+
+    return {
+        'mean_chi2':     float(torch.mean(delta_chi2)),
+        'median_chi2':   float(torch.median(delta_chi2)),
+        'n_total':       n_total,
+        'n_gt_0p2':      n_gt_0p2,
+        'n_gt_1':        n_gt_1,
+        'n_lt_0p2':      n_lt_0p2,
+        'frac_gt_0p2':   n_gt_0p2 / n_total,
+        'frac_gt_1':     n_gt_1 / n_total,
+        'frac_lt_0p2':   frac_lt_0p2,
+        'criterion_met': frac_lt_0p2 > 0.1,
+    }
@@ -0,0 +1,341 @@
+import os
+import re
+import sys
+import time
+import math
+import heapq
+import itertools
+import shlex
+import shutil
+import signal
+import argparse
+import subprocess
+import yaml
+import torch
+
+#===================================================================================================
+# core-packing job scheduler
+#
+# One small-MLP training run cannot keep a 96-core node busy, so this runs several at once inside
+# a single SLURM allocation (or on any node), each pinned to its own set of cores with taskset and
+# running with that many torch threads. The number of threads per job comes from a short
+# throughput probe of the job's model: we pick the thread count that finishes the whole queue
+# soonest, i.e. trades per-job speed against the number of jobs that fit side by side.
+#
+# The queue is a YAML file:
+#
+#   defaults:                  # optional, applied to every job
+#     retries: 1
+#     threads: auto            # or a number
+#   jobs:
+#     - name: n1000_early2
+#       args: --yaml ./projects/lsst_y1/xi_tl.yaml --probe cosmic_shear --ntrain 1000 ...
+#       priority: 10           # higher starts first (default 0)
+#     - name: n5000_early2
+#       args: ...
+#       script: sweep.py       # default train_emulator.py
+#
+# Each job writes <log_dir>/<name>.log. Unless the job sets them, train_emulator jobs get
+# --losses_file/--metrics_file and --model_file/--extra_file in <log_dir>/<name>/ so that concurrent
+# jobs sharing a YAML do not overwrite each other's losses.txt, model, .h5 and .ckpt (or resume from
+# another job's checkpoint). A summary table is written to <log_dir>/summary.txt.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='scheduler')
+
+    parser.add_argument("queue",
+        help="YAML file with the jobs")
+    parser.add_argument("--log_dir", "-l", dest="log_dir", default='scheduler_logs',
+        help="directory for the job logs and the summary. Default=scheduler_logs")
+    parser.add_argument("--threads", "-t", dest="threads", default=None,
+        help="threads per job for every job, overriding the queue: a number or 'auto'. Default=the queue's, else auto")
+    parser.add_argument("--max_threads", "-mt", dest="max_threads", type=int, default=None,
+        help="(int) largest thread count the probe considers. Default=all cores")
+    parser.add_argument("--poll", dest="poll", type=float, default=2.0,
+        help="(float) seconds between checks on the running jobs. Default=2")
+
+    return parser
+
+#===================================================================================================
+# jobs
+
+def has_option(args, *flags):
+    '''
+    whether args sets any of flags, as '--flag value' or '--flag=value'
+    '''
+    return any(a in flags or a.split('=', 1)[0] in flags for a in args)
+
+class Job:
+    def __init__(self, name, args, script='train_emulator.py', priority=0, retries=0, threads='auto'):
+        self.name     = name
+        self.args     = shlex.split(args) if isinstance(args, str) else list(args)
+        self.script   = script
+        self.priority = priority
+        self.retries  = retries
+        self.threads  = threads
+
+        self.attempts  = 0
+        self.status    = 'queued'
+        self.cores     = []
+        self.returncode = None
+        self.seconds   = 0.0
+        self.process   = None
+        self.started   = None
+        self.log       = None
+
+    def command(self, log_dir):
+        script = self.script if os.path.isabs(self.script) else os.path.join(SCRIPT_DIR, self.script)
+        args = list(self.args)
+
+        if os.path.basename(self.script) == 'train_emulator.py':
+            job_dir = os.path.join(log_dir, self.name)
+            os.makedirs(job_dir, exist_ok=True)
+            if not has_option(args, '--losses_file', '-lof'):
+                args += ['--losses_file', os.path.join(job_dir, 'losses.txt')]
+            if not has_option(args, '--metrics_file', '-mef'):
+                args += ['--metrics_file', os.path.join(job_dir, 'testing_metrics.txt')]
+            if not has_option(args, '--model_file', '-mf'):
+                args += ['--model_file', os.path.join(job_dir, self.name)]
+            if not has_option(args, '--extra_file', '-xf'):
+                args += ['--extra_file', os.path.join(job_dir, self.name + '.h5')]
+            if not has_option(args, '--threads', '-th'):
+                args += ['--threads', str(len(self.cores))]
+
+        return [sys.executable, '-u', script] + args
+
+def load_queue(filename, threads_override=None):
+    with open(filename, 'r') as stream:
+        queue = yaml.safe_load(stream)
+
+    defaults = queue.get('defaults', {}) or {}
+    jobs = []
+    for i, entry in enumerate(queue['jobs']):
+        entry = {**defaults, **entry}
+        threads = threads_override if threads_override is not None else entry.get('threads', 'auto')
+        jobs.append(Job(entry.get('name', f'job{i}'), entry['args'],
+            script=entry.get('script', 'train_emulator.py'),
+            priority=entry.get('priority', 0),
+            retries=entry.get('retries', 0),
+            threads=threads if threads == 'auto' else int(threads)))
+
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{filename}: job names must be unique")
+
+    return jobs
+
+#===================================================================================================
+# throughput probe
+
+def probe_key(job):
+    '''
+    the (yaml, probe, batch size) of a train_emulator job, which decides the cost of a training step.
+    None for other scripts.
+    '''
+    if os.path.basename(job.script) != 'train_emulator.py':
+        return None
+    from train_emulator import get_parser as get_train_parser
+    args, _ = get_train_parser().parse_known_args(job.args)
+    return (args.cobaya_yaml, args.probe, args.batch_size)
+
+def probe_throughput(train_yaml, probe, batch_size, cores, thread_counts, n_steps=20):
+    '''
+    training samples/s of the job's model for each thread count, on the first k of the given cores,
+    with random data. A few dozen steps are enough: these models are small and the steps uniform.
+    '''
+    from train_emulator import build_model
+    from losses import get_loss_fcn
+
+    with open(train_yaml, 'r') as stream:
+        args = yaml.safe_load(stream)
+    extra_args = args['train_args'][probe]['extra_args']
+    model_info = extra_args['extrapar'][0]
+    input_dim  = len(extra_args['ord'][0])
+
+    model    = build_model(model_info, input_dim)
+    optim    = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_fcn = get_loss_fcn('hyperbola')
+    X = torch.randn(batch_size, input_dim)
+    Y = torch.randn(batch_size, model_info['OUTPUT_DIM'])
+
+    def step():
+        loss = loss_fcn(Y, model(X))
+        optim.zero_grad()
+        loss.backward()
+        optim.step()
+
+    affinity = os.sched_getaffinity(0)
+    n_threads = torch.get_num_threads()
+    rates = {}
+    try:
+        for k in thread_counts:
+            os.sched_setaffinity(0, cores[:k])
+            torch.set_num_threads(k)
+            for _ in range(3):
+                step()
+            t0 = time.perf_counter()
+            for _ in range(n_steps):
+                step()
+            rates[k] = n_steps * batch_size / (time.perf_counter() - t0)
+    finally:
+        os.sched_setaffinity(0, affinity)
+        torch.set_num_threads(n_threads)
+
+    return rates
+
+def choose_threads(rates, n_jobs, n_cores):
+    '''
+    the thread count that finishes n_jobs equal jobs soonest when n_cores // k of them run at once
+    '''
+    def makespan(k):
+        return math.ceil(n_jobs / max(1, n_cores // k)) / rates[k]
+    return min(sorted(rates), key=makespan)
+
+def thread_candidates(n_cores):
+    counts = []
+    k = 1
+    while k < n_cores:
+        counts.append(k)
+        k *= 2
+    counts.append(n_cores)
+    return counts
+
+#===================================================================================================
+# the scheduler
+
+def launch(job, cores, log_dir):
+    job.cores    = cores
+    job.attempts += 1
+    job.status   = 'running'
+    job.started  = time.perf_counter()
+
+    env = dict(os.environ)
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        env[var] = str(len(cores))
+
+    command = job.command(log_dir)
+    core_list = ','.join(str(c) for c in cores)
+    if shutil.which('taskset') is not None:
+        command = ['taskset', '-c', core_list] + command
+        preexec = None
+    else:
+        preexec = lambda: os.sched_setaffinity(0, cores)
+
+    log = open(os.path.join(log_dir, f'{job.name}.log'), 'a')
+    log.write(f'\n===== attempt {job.attempts}, cores {core_list}: {" ".join(shlex.quote(c) for c in command)}\n')
+    log.flush()
+    job.process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env, preexec_fn=preexec)
+    job.log = log
+
+def last_median_chi2(log_file):
+    '''
+    the last 'Median Delta Chi2 = ...' line that train_emulator printed, or None
+    '''
+    median = None
+    with open(log_file, 'r', errors='replace') as f:
+        for line in f:
+            m = re.search(r'Median Delta Chi2 = ([-+0-9.eE]+)', line)
+            if m:
+                median = m.group(1)
+    return median
+
+def run_queue(jobs, log_dir, max_threads=None, poll=2.0):
+    '''
+    run the jobs, several at once on disjoint core sets, and return them with their final status
+    '''
+    os.makedirs(log_dir, exist_ok=True)
+
+    all_cores = sorted(os.sched_getaffinity(0))
+    n_cores   = len(all_cores)
+    candidates = thread_candidates(min(n_cores, max_threads or n_cores))
+
+    # threads of the 'auto' jobs, one probe per kind of job
+    probes = {}
+    for job in jobs:
+        if job.threads != 'auto':
+            job.threads = min(job.threads, n_cores)
+            continue
+        key = probe_key(job)
+        if key is None:
+            job.threads = 1
+            continue
+        if key not in probes:
+            print(f'Probing throughput of {key[0]} ({key[1]}, batch {key[2]}) on {candidates} threads...')
+            rates = probe_throughput(*key, all_cores, candidates)
+            n_same = sum(1 for other in jobs if other.threads == 'auto' and probe_key(other) == key)
+            probes[key] = choose_threads(rates, n_same, n_cores)
+            print('  ' + ', '.join(f'{k}: {rate:.0f} samples/s' for k, rate in rates.items()) + f' -> {probes[key]} threads per job')
+        job.threads = probes[key]
+
+    # priority queue: higher priority first, then queue order (retries go behind the jobs of their priority)
+    order = itertools.count()
+    queue = [(-job.priority, next(order), job) for job in jobs]
+    heapq.heapify(queue)
+    free    = list(all_cores)
+    running = []
+
+    def stop_all(signum, frame):
+        for job in running:
+            job.process.terminate()
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, stop_all)
+    signal.signal(signal.SIGINT,  stop_all)
+
+    start = time.perf_counter()
+    while queue or running:
+        # start as many of the highest priority jobs as there are free cores for. A job that does
+        # not fit waits for cores rather than letting lower priority jobs pass it forever.
+        while queue and len(free) >= queue[0][2].threads:
+            _, _, job = heapq.heappop(queue)
+            cores, free = free[:job.threads], free[job.threads:]
+            launch(job, cores, log_dir)
+            running.append(job)
+            print(f'[{time.strftime("%H:%M:%S")}] started  {job.name} (attempt {job.attempts}) on {job.threads} cores')
+
+        time.sleep(poll)
+
+        for job in list(running):
+            returncode = job.process.poll()
+            if returncode is None:
+                continue
+
+            job.log.close()
+            running.remove(job)
+            free = sorted(free + job.cores)
+            job.seconds   += time.perf_counter() - job.started
+            job.returncode = returncode
+
+            if returncode == 0:
+                job.status = 'done'
+            elif job.attempts <= job.retries:
+                job.status = 'retrying'
+                heapq.heappush(queue, (-job.priority, next(order), job))
+            else:
+                job.status = 'failed'
+            print(f'[{time.strftime("%H:%M:%S")}] {job.status:8s} {job.name} (exit code {returncode}, {job.seconds/60:.1f} min)')
+
+    print(f'\nQueue finished in {(time.perf_counter() - start)/60:.1f} min')
+    return jobs
+
+def write_summary(jobs, log_dir):
+    lines = [f'{"job":<32s} {"status":>7s} {"tries":>5s} {"threads":>7s} {"minutes":>8s} {"exit":>5s} {"median_chi2":>12s}']
+    for job in jobs:
+        median = last_median_chi2(os.path.join(log_dir, f'{job.name}.log')) if job.attempts > 0 else None
+        lines.append(f'{job.name:<32s} {job.status:>7s} {job.attempts:5d} {job.threads:7d} {job.seconds/60:8.1f} '
+                     f'{str(job.returncode):>5s} {median or "-":>12s}')
+
+    summary_file = os.path.join(log_dir, 'summary.txt')
+    with open(summary_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    print('\n'.join(lines))
+    print(f'Summary written to {summary_file}')
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    jobs = load_queue(args.queue, args.threads)
+    run_queue(jobs, args.log_dir, args.max_threads, args.poll)
+    write_summary(jobs, args.log_dir)
+    sys.exit(0 if all(job.status == 'done' for job in jobs) else 1)
@@ -0,0 +1,331 @@
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import argparse
+import traceback
+from contextlib import redirect_stdout
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from train_emulator import train_emulator, load_shared_data
+
+#===================================================================================================
+# successive halving / ASHA hyperparameter search
+#
+# Every configuration is first trained for --min_epochs. Only the best 1/eta of them, ranked on the
+# validation loss at that epoch, continue to min_epochs*eta epochs, the best 1/eta of those to
+# min_epochs*eta^2, and so on up to --max_epochs. A trial that is promoted resumes from the
+# checkpoint of its last rung, so no epoch is trained twice, and the losers stop at the first rung
+# where they fall behind.
+#
+# With --mode asha (default) promotions happen as soon as a configuration is in the top 1/eta of
+# the results so far, so --workers processes never wait for a rung to fill up (Li et al. 2020).
+# With --mode sh a rung is only promoted once every trial in it is done (plain successive halving).
+#
+# The data is loaded and whitened once and shared with the workers as in sweep.py. Every finished
+# rung is appended to <output_dir>/search_history.jsonl, and the trials are ranked in
+# <output_dir>/search_summary.txt.
+
+SEARCH_AXES = ['learning_rate', 'batch_size', 'weight_decay', 'int_dim_res', 'loss_form', 'freeze_strategy']
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='search')
+
+    parser.add_argument("--yaml", "-y", dest="train_yaml", required=True,
+        help="The training YAML containing the training_args block")
+    parser.add_argument("--probe", "-p", dest="probe", required=True,
+        help="the probe, listed in the yaml, to train")
+    parser.add_argument("--output_dir", "-o", dest="output_dir", required=True,
+        help="directory for the models/, losses/, metrics/, logs/ and the search history")
+    parser.add_argument("--name", dest="name", default='trial',
+        help="model file prefix. Default=trial")
+
+    # the search space
+    parser.add_argument("--learning_rate", "-lr", dest="learning_rate", type=float, nargs='+', default=[1e-3],
+        help="(float) learning rates. Default=1e-3")
+    parser.add_argument("--batchsize", "-b", dest="batch_size", type=int, nargs='+', default=[256],
+        help="(int) batch sizes. Default=256")
+    parser.add_argument("--weight_decay", "-wd", dest="weight_decay", type=float, nargs='+', default=[0.0],
+        help="(float) weight decays. Default=0")
+    parser.add_argument("--int_dim_res", "-id", dest="int_dim_res", type=int, nargs='+', default=[None],
+        help="(int) INT_DIM_RES values. Default=the YAML's")
+    parser.add_argument("--loss_form", "-lf", dest="loss_form", nargs='+', default=[None],
+        help="loss forms. Default=the YAML's, else 'hyperbola'")
+    parser.add_argument("--freeze_strategy", "-fs", dest="freeze_strategy", nargs='+', default=['none'],
+        help="freeze strategies (transfer learning only). Default=none")
+    parser.add_argument("--n_trials", "-nt", dest="n_trials", type=int, default=None,
+        help="(int) number of configurations to draw from the grid. Default=all of them")
+
+    # the schedule
+    parser.add_argument("--mode", dest="mode", choices=['asha', 'sh'], default='asha',
+        help="asynchronous (asha) or synchronous (sh) successive halving. Default=asha")
+    parser.add_argument("--min_epochs", dest="min_epochs", type=int, default=25,
+        help="(int) epochs of the first rung. Default=25")
+    parser.add_argument("--max_epochs", dest="max_epochs", type=int, default=1000,
+        help="(int) epochs of the last rung. Default=1000")
+    parser.add_argument("--eta", dest="eta", type=int, default=3,
+        help="(int) keep the best 1/eta of each rung. Default=3")
+
+    # shared by every trial
+    parser.add_argument("--ntrain", dest="n_train", type=int, default=None,
+        help="(int) training set size. Default=all the samples")
+    parser.add_argument("--squeeze_factor", "-sf", dest="squeeze_factor", type=float, default=1.0,
+        help="(float) factor to divide the covariance by. Default=1")
+    parser.add_argument("--transfer_learning", "-tl", dest="transfer_learning", action='store_true',
+        help="fine-tune --pretrained_model")
+    parser.add_argument("--pretrained_model", "-pm", dest="pretrained_model", default=None,
+        help="path to the pretrained model for transfer learning")
+    parser.add_argument("--shuffle", "-sh", dest="shuffle", action='store_true',
+        help="shuffle the training set every epoch")
+    parser.add_argument("--seed", "-sd", dest="seed", type=int, default=0,
+        help="(int) seed of the initialization, the shuffling and the configuration draw. Default=0")
+
+    # execution
+    parser.add_argument("--workers", "-w", dest="workers", type=int, default=1,
+        help="(int) trials trained at the same time, in separate processes. Default=1")
+    parser.add_argument("--threads", "-t", dest="threads", type=int, default=None,
+        help="(int) torch threads per worker. Default=cores/workers")
+
+    return parser
+
+def rung_epochs(min_epochs, max_epochs, eta):
+    '''
+    the epochs at the end of each rung: min_epochs * eta^k, with max_epochs as the last one
+    '''
+    rungs = [min_epochs]
+    while rungs[-1] * eta < max_epochs:
+        rungs.append(rungs[-1] * eta)
+    if rungs[-1] != max_epochs:
+        rungs.append(max_epochs)
+    return rungs
+
+#===================================================================================================
+# trials
+
+class Trial:
+    def __init__(self, trial_id, config, output_dir, name):
+        self.id      = trial_id
+        self.config  = config
+        self.tag     = f'{name}{trial_id:03d}'
+        self.results = {}          # rung -> validation loss at the end of the rung
+        self.rung    = -1          # the rung running or last finished
+        self.running = False
+        self.failed  = False
+
+        self.model_file   = os.path.join(output_dir, 'models',  self.tag)
+        self.extra_file   = self.model_file + '.h5'
+        self.losses_file  = os.path.join(output_dir, 'losses',  f'losses_{self.tag}.txt')
+        self.metrics_file = os.path.join(output_dir, 'metrics', f'testing_metrics_{self.tag}.txt')
+        self.log_file     = os.path.join(output_dir, 'logs',    f'{self.tag}.log')
+
+    def score(self, rung):
+        loss = self.results[rung]
+        return loss if np.isfinite(loss) else np.inf
+
+def draw_configs(args):
+    '''
+    the configurations to try: the grid of the search axes in a random (seeded) order, truncated to n_trials
+    '''
+    grid = [dict(zip(SEARCH_AXES, values)) for values in itertools.product(*[getattr(args, axis) for axis in SEARCH_AXES])]
+    random.Random(args.seed).shuffle(grid)
+    return grid[:args.n_trials] if args.n_trials is not None else grid
+
+#===================================================================================================
+# the workers
+
+_shared_data = None
+
+def init_worker(shared_data, n_threads):
+    global _shared_data
+    _shared_data = shared_data
+    torch.set_num_threads(n_threads)
+
+def run_rung(trial, rung, epochs, args):
+    '''
+    train the trial up to the given epoch, continuing from the checkpoint of its previous rung.
+    Returns (trial id, rung, validation loss, test metrics, seconds, error).
+    '''
+    start  = time.perf_counter()
+    config = trial.config
+    try:
+        with open(trial.log_file, 'a') as f, redirect_stdout(f):
+            print(f'\n===== rung {rung}: epochs {epochs}')
+            torch.manual_seed(args.seed)
+            metrics = train_emulator(args.train_yaml, args.probe,
+                epochs, config['batch_size'], config['learning_rate'], config['weight_decay'],
+                True, True, args.squeeze_factor,
+                args.transfer_learning, args.pretrained_model, config['freeze_strategy'],
+                loss_form=config['loss_form'], eval_every=0, shuffle=args.shuffle, seed=args.seed,
+                n_train=args.n_train, resume=rung > 0, keep_checkpoint=True,
+                extrapar={'INT_DIM_RES': config['int_dim_res']} if config['int_dim_res'] is not None else None,
+                shared_data=_shared_data, model_file=trial.model_file, extra_file=trial.extra_file,
+                losses_file=trial.losses_file, metrics_file=trial.metrics_file)
+
+        valid_loss = float(np.loadtxt(trial.losses_file, ndmin=2)[1][-1])
+        return trial.id, rung, valid_loss, metrics, time.perf_counter() - start, None
+    except Exception:
+        return trial.id, rung, np.inf, None, time.perf_counter() - start, traceback.format_exc()
+
+#===================================================================================================
+# the search
+
+class Search:
+    '''
+    the successive halving bookkeeping: which trial to run next, at which rung
+    '''
+    def __init__(self, trials, rungs, eta, synchronous=False):
+        self.trials      = trials
+        self.rungs       = rungs
+        self.eta         = eta
+        self.synchronous = synchronous
+        self.n_started   = 0
+
+    def rung_complete(self, k):
+        '''
+        every trial that entered rung k has finished it (and, for rung 0, every trial has started)
+        '''
+        if k == 0 and self.n_started < len(self.trials):
+            return False
+        return all(not (t.running and t.rung == k) for t in self.trials)
+
+    def promotable(self, k):
+        '''
+        the trials of rung k that are in its top 1/eta and have not gone on to rung k+1
+        '''
+        done = [t for t in self.trials if k in t.results and not t.failed]
+        entered = [t for t in self.trials if t.rung >= k] if self.synchronous else done
+        n_top = len(entered) // self.eta
+        top = sorted(done, key=lambda t: t.score(k))[:n_top]
+        return [t for t in top if t.rung == k and not t.running and np.isfinite(t.score(k))]
+
+    def next_job(self):
+        '''
+        (trial, rung) to run next, or None if nothing can run now. Promotions come first, from the
+        top rung down, so the most promising trials finish early.
+        '''
+        for k in reversed(range(len(self.rungs)-1)):
+            if self.synchronous and not self.rung_complete(k):
+                continue
+            candidates = self.promotable(k)
+            if candidates:
+                return candidates[0], k+1
+
+        if self.n_started < len(self.trials):
+            trial = self.trials[self.n_started]
+            self.n_started += 1
+            return trial, 0
+
+        return None
+
+def json_float(x):
+    '''
+    x, or None if it is missing or not finite (json.dumps would write Infinity/NaN, which is not JSON)
+    '''
+    return float(x) if x is not None and np.isfinite(x) else None
+
+def write_summary(trials, rungs, output_dir):
+    '''
+    rank the trials by the highest rung they reached, then by their loss there
+    '''
+    def key(t):
+        if not t.results:
+            return (1, 0, np.inf)
+        k = max(t.results)
+        return (0, -k, t.score(k))
+
+    lines = [f'{"trial":<12s} {"epochs":>6s} {"valid_loss":>11s}  ' + ' '.join(f'{axis}' for axis in SEARCH_AXES)]
+    for t in sorted(trials, key=key):
+        if t.results:
+            k = max(t.results)
+            head = f'{t.tag:<12s} {rungs[k]:6d} {t.results[k]:11.4e}'
+        else:
+            head = f'{t.tag:<12s} {"-":>6s} {"-":>11s}'
+        if t.failed:
+            head += ' FAILED'
+        lines.append(head + '  ' + ' '.join(f'{t.config[axis]}' for axis in SEARCH_AXES))
+
+    summary_file = os.path.join(output_dir, 'search_summary.txt')
+    with open(summary_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    print('\n'.join(lines))
+    print(f'Summary written to {summary_file}')
+
+def run_search(args):
+    if not args.transfer_learning and args.freeze_strategy != ['none']:
+        raise ValueError("--freeze_strategy only applies with --transfer_learning")
+
+    for sub in ('models', 'losses', 'metrics', 'logs'):
+        os.makedirs(os.path.join(args.output_dir, sub), exist_ok=True)
+
+    rungs   = rung_epochs(args.min_epochs, args.max_epochs, args.eta)
+    trials  = [Trial(i, config, args.output_dir, args.name) for i, config in enumerate(draw_configs(args))]
+    search  = Search(trials, rungs, args.eta, synchronous=args.mode == 'sh')
+    workers = max(1, args.workers)
+    threads = args.threads if args.threads is not None else max(1, (os.cpu_count() or 1) // workers)
+
+    print(f'{args.mode.upper()} over {len(trials)} configurations, rungs at epochs {rungs}, eta={args.eta}, {workers} worker(s)')
+    print('Loading and whitening the data once...')
+    shared_data = load_shared_data(args.train_yaml, args.probe, args.squeeze_factor)
+
+    history_file = os.path.join(args.output_dir, 'search_history.jsonl')
+    search_start = time.perf_counter()
+    epochs_trained = 0
+
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(workers, initializer=init_worker, initargs=(shared_data, threads)) as pool:
+        running = []
+        while True:
+            while len(running) < workers:
+                job = search.next_job()
+                if job is None:
+                    break
+                trial, k = job
+                trial.running = True
+                trial.rung    = k
+                running.append(pool.apply_async(run_rung, (trial, k, rungs[k], args)))
+
+            if not running:
+                break
+
+            time.sleep(1.0)
+            for result in [r for r in running if r.ready()]:
+                running.remove(result)
+                trial_id, k, valid_loss, metrics, seconds, error = result.get()
+                trial = trials[trial_id]
+                trial.running = False
+                trial.results[k] = valid_loss
+                trial.failed = error is not None
+                epochs_trained += rungs[k] - (rungs[k-1] if k > 0 else 0)
+
+                record = {
+                    'trial':       trial.tag,
+                    'config':      trial.config,
+                    'rung':        k,
+                    'epochs':      rungs[k],
+                    'valid_loss':  json_float(valid_loss),
+                    'median_chi2': json_float(metrics['median_chi2']) if metrics is not None else None,
+                    'frac_lt_0p2': json_float(metrics['frac_lt_0p2']) if metrics is not None else None,
+                    'seconds':     seconds,
+                    'error':       error,
+                }
+                with open(history_file, 'a') as f:
+                    f.write(json.dumps(record, allow_nan=False) + '\n')
+
+                status = 'FAILED' if error is not None else f'valid loss {valid_loss:1.4e}'
+                print(f'[{time.strftime("%H:%M:%S")}] {trial.tag} rung {k} ({rungs[k]} epochs): {status}')
+
+    # the checkpoints were only kept to continue promoted trials
+    for trial in trials:
+        if os.path.exists(trial.model_file + '.ckpt'):
+            os.remove(trial.model_file + '.ckpt')
+
+    full = len(trials) * rungs[-1]
+    print(f'\nSearch finished in {(time.perf_counter() - search_start)/60:.1f} min, '
+          f'{epochs_trained} epochs trained ({100*epochs_trained/full:.0f}% of running every trial to {rungs[-1]})')
+    write_summary(trials, rungs, args.output_dir)
+
+if __name__ == "__main__":
+    run_search(get_parser().parse_args())
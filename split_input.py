@@ -0,0 +1,77 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+#===================================================================================================
+# partial-column input training for transfer learning
+#
+# When a pretrained emulator is extended to new input parameters (LCDM -> w0wa: the input layer
+# padded with zero columns for w, w0pwa, see experiments/2026-07_lcdm2w0wa_tl), lock_input_cols
+# keeps the pretrained columns of the input projection model.0 (and its bias) fixed and trains only
+# the new ones. The layer is split into a frozen block, held as buffers, and a small trainable block,
+# so the optimizer (moments, weight decay) only ever sees the new columns.
+#
+# The state_dict of the split layer is the merged weight and bias, so checkpoints, the saved model
+# and the early stopping state have the standard layout and load into the plain architecture.
+
+class SplitInputLinear(nn.Module):
+    '''
+    nn.Linear whose first n_locked input columns and bias are frozen buffers and whose remaining
+    columns are the trainable parameter weight_new
+    '''
+    def __init__(self, base, n_locked):
+        super(SplitInputLinear, self).__init__()
+
+        if not 0 < n_locked < base.in_features:
+            raise ValueError(f"lock_input_cols must be between 1 and {base.in_features-1}, not {n_locked}")
+
+        self.in_features  = base.in_features
+        self.out_features = base.out_features
+        self.n_locked     = n_locked
+
+        with torch.no_grad():
+            self.register_buffer('weight_locked', base.weight[:, :n_locked].detach().clone(), persistent=False)
+            self.register_buffer('bias_locked', base.bias.detach().clone(), persistent=False)
+            self.weight_new = nn.Parameter(base.weight[:, n_locked:].detach().clone())
+
+    @property
+    def weight(self):
+        return torch.cat([self.weight_locked, self.weight_new], dim=1)
+
+    def forward(self, x):
+        return F.linear(x, self.weight, self.bias_locked)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        weight = self.weight
+        destination[prefix + 'weight'] = weight if keep_vars else weight.detach()
+        destination[prefix + 'bias']   = self.bias_locked
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        for name in ('weight', 'bias'):
+            if prefix + name not in state_dict:
+                missing_keys.append(prefix + name)
+        if prefix + 'weight' not in state_dict or prefix + 'bias' not in state_dict:
+            return
+
+        weight = state_dict[prefix + 'weight']
+        if weight.shape != (self.out_features, self.in_features):
+            error_msgs.append(f'size mismatch for {prefix}weight: copying a param with shape {tuple(weight.shape)}, '
+                              f'the shape in current model is {(self.out_features, self.in_features)}.')
+            return
+        with torch.no_grad():
+            self.weight_locked.copy_(weight[:, :self.n_locked])
+            self.weight_new.copy_(weight[:, self.n_locked:])
+            self.bias_locked.copy_(state_dict[prefix + 'bias'])
+
+def split_input_layer(model, n_locked):
+    '''
+    replace the input projection model.0 by a SplitInputLinear, in place. The new columns train
+    whatever the freeze strategy did to model.0.
+
+    returns the number of trainable input parameters
+    '''
+    base = model.model[0]
+    if not isinstance(base, nn.Linear):
+        raise TypeError(f"lock_input_cols needs an nn.Linear input layer, not a {type(base).__name__}")
+    model.model[0] = SplitInputLinear(base, n_locked)
+    return model.model[0].weight_new.numel()
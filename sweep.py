@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import itertools
+import argparse
+import traceback
+from contextlib import redirect_stdout
+import torch
+import torch.multiprocessing as mp
+from train_emulator import train_emulator, load_shared_data
+
+#===================================================================================================
+# in-process sweeps
+#
+# The bash sweeps (data_size_sweep.sh, run_tl_sweep*.sh, hyperparam_testing.sh) write a YAML per
+# configuration and start a fresh train_emulator.py each time, which re-reads the parameter text,
+# reloads the datavectors and redoes the eigh. Here the data is loaded and whitened once and every
+# configuration of the grid is trained on it, one after the other or in --workers processes that
+# read the same tensors from shared memory. For example, the data size sweep is
+#
+#   python sweep.py --yaml ./projects/lsst_y1/xi_emulator_transfer_learning.yaml --probe cosmic_shear \
+#       --transfer_learning --pretrained_model ./projects/lsst_y1/emulators/xi_low_accuracy \
+#       --freeze_strategy early_2 --epochs 1000 --ntrain 200 500 1000 1500 2500 5000 \
+#       --output_dir ./projects/lsst_y1/emulators/data_size_sweep --name xi_transfer
+#
+# The outputs keep the names and layout of the bash sweeps:
+#   <output_dir>/models/<name>_<tag>, <output_dir>/models/<name>_<tag>.h5
+#   <output_dir>/losses/losses_<tag>.txt, <output_dir>/metrics/testing_metrics_<tag>.txt
+# where the tag joins the values of the grid axes that take more than one value (just the size in
+# the example above, as in losses_1000.txt).
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='sweep')
+
+    parser.add_argument("--yaml", "-y", dest="train_yaml", required=True,
+        help="The training YAML containing the training_args block")
+    parser.add_argument("--probe", "-p", dest="probe", required=True,
+        help="the probe, listed in the yaml, to train")
+    parser.add_argument("--output_dir", "-o", dest="output_dir", required=True,
+        help="directory for the models/, losses/, metrics/ and logs/ of the sweep")
+    parser.add_argument("--name", dest="name", default=None,
+        help="model file prefix. Default=the YAML model filename")
+
+    # the grid
+    parser.add_argument("--ntrain", "-nt", dest="n_train", type=int, nargs='+', default=[None],
+        help="(int) training set sizes. Default=all the samples")
+    parser.add_argument("--freeze_strategy", "-fs", dest="freeze_strategy", nargs='+', default=['none'],
+        help="freeze strategies (transfer learning only). Default=none")
+    parser.add_argument("--learning_rate", "-lr", dest="learning_rate", type=float, nargs='+', default=[1e-3],
+        help="(float) learning rates. Default=1e-3")
+    parser.add_argument("--batchsize", "-b", dest="batch_size", type=int, nargs='+', default=[256],
+        help="(int) batch sizes. Default=256")
+    parser.add_argument("--seeds", "-sd", dest="seed", type=int, nargs='+', default=[0],
+        help="(int) seeds of the initialization and the shuffling. Default=0")
+
+    # shared by every configuration
+    parser.add_argument("--epochs", "-e", dest="n_epochs", type=int, default=250,
+        help="(int) number of training epochs. Default=250")
+    parser.add_argument("--weight_decay", "-wd", dest="weight_decay", type=float, default=0.0,
+        help="(float) weight decay. Default=0")
+    parser.add_argument("--squeeze_factor", "-sf", dest="squeeze_factor", type=float, default=1.0,
+        help="(float) factor to divide the covariance by. Default=1")
+    parser.add_argument("--transfer_learning", "-tl", dest="transfer_learning", action='store_true',
+        help="fine-tune --pretrained_model")
+    parser.add_argument("--pretrained_model", "-pm", dest="pretrained_model", default=None,
+        help="path to the pretrained model for transfer learning")
+    parser.add_argument("--loss_form", "-lf", dest="loss_form", default=None,
+        help="loss form. Default=the YAML's, else 'hyperbola'")
+    parser.add_argument("--eval_every", "-ee", dest="eval_every", type=int, default=1,
+        help="(int) evaluate the testing metrics every k epochs. Default=1")
+    parser.add_argument("--shuffle", "-sh", dest="shuffle", action='store_true',
+        help="shuffle the training set every epoch")
+    parser.add_argument("--patience", "-pa", dest="patience", type=int, default=0,
+        help="(int) early stopping patience, 0 disables it. Default=0")
+    parser.add_argument("--min_lr", "-mlr", dest="min_lr", type=float, default=0.0,
+        help="(float) early stopping learning rate floor, 0 disables it. Default=0")
+
+    # execution
+    parser.add_argument("--workers", "-w", dest="workers", type=int, default=1,
+        help="(int) configurations trained at the same time, in separate processes. Default=1")
+    parser.add_argument("--threads", "-t", dest="threads", type=int, default=None,
+        help="(int) torch threads per worker. Default=cores/workers")
+
+    return parser
+
+#===================================================================================================
+# the grid
+
+GRID_AXES = ['n_train', 'freeze_strategy', 'learning_rate', 'batch_size', 'seed']
+
+def axis_tag(axis, value):
+    if axis == 'n_train':
+        return 'all' if value is None else f'{value}'
+    if axis == 'freeze_strategy':
+        return value
+    if axis == 'learning_rate':
+        return f'lr{value:g}'
+    if axis == 'batch_size':
+        return f'bs{value}'
+    return f'seed{value}'
+
+def make_grid(args, model_prefix):
+    '''
+    one dict per configuration, with its grid values and output filenames
+    '''
+    values  = {axis: getattr(args, axis) for axis in GRID_AXES}
+    varying = [axis for axis in GRID_AXES if len(values[axis]) > 1]
+
+    configs = []
+    for combination in itertools.product(*[values[axis] for axis in GRID_AXES]):
+        config = dict(zip(GRID_AXES, combination))
+        tag    = '_'.join(axis_tag(axis, config[axis]) for axis in varying) or 'run'
+
+        config['tag']          = tag
+        config['model_file']   = os.path.join(args.output_dir, 'models',  f'{model_prefix}_{tag}')
+        config['extra_file']   = config['model_file'] + '.h5'
+        config['losses_file']  = os.path.join(args.output_dir, 'losses',  f'losses_{tag}.txt')
+        config['metrics_file'] = os.path.join(args.output_dir, 'metrics', f'testing_metrics_{tag}.txt')
+        config['log_file']     = os.path.join(args.output_dir, 'logs',    f'{tag}.log')
+        configs.append(config)
+
+    return configs
+
+#===================================================================================================
+# running one configuration. The shared data is handed to each worker once, when it starts.
+
+_shared_data = None
+
+def init_worker(shared_data, n_threads):
+    global _shared_data
+    _shared_data = shared_data
+    torch.set_num_threads(n_threads)
+
+def run_config(config, args, log=True):
+    '''
+    train one configuration. Returns (config, metrics, seconds, error) where error is None on success.
+    '''
+    start = time.perf_counter()
+
+    def train():
+        # seeds the initialization of runs from scratch; seed also drives the shuffling
+        torch.manual_seed(config['seed'])
+        return train_emulator(args.train_yaml, args.probe,
+            args.n_epochs, config['batch_size'], config['learning_rate'], args.weight_decay,
+            True, True, args.squeeze_factor,
+            args.transfer_learning, args.pretrained_model, config['freeze_strategy'],
+            loss_form=args.loss_form, eval_every=args.eval_every, shuffle=args.shuffle,
+            seed=config['seed'], n_train=config['n_train'], patience=args.patience, min_lr=args.min_lr,
+            shared_data=_shared_data, model_file=config['model_file'], extra_file=config['extra_file'],
+            losses_file=config['losses_file'], metrics_file=config['metrics_file'])
+
+    try:
+        if log:
+            with open(config['log_file'], 'w') as f, redirect_stdout(f):
+                metrics = train()
+        else:
+            metrics = train()
+        return config, metrics, time.perf_counter() - start, None
+    except Exception:
+        return config, None, time.perf_counter() - start, traceback.format_exc()
+
+def _run_config_logged(job):
+    return run_config(*job, log=True)
+
+#===================================================================================================
+# the sweep
+
+def run_sweep(args):
+    '''
+    train every configuration of the grid and print a summary. Returns the number of failed runs.
+    '''
+    if not args.transfer_learning and args.freeze_strategy != ['none']:
+        raise ValueError("--freeze_strategy only applies with --transfer_learning")
+
+    if args.name is None:
+        import yaml
+        with open(args.train_yaml,'r') as stream:
+            config_args = yaml.safe_load(stream)
+        args.name = os.path.basename(config_args['train_args'][args.probe]['extra_args']['file'][0])
+
+    for sub in ('models', 'losses', 'metrics', 'logs'):
+        os.makedirs(os.path.join(args.output_dir, sub), exist_ok=True)
+
+    configs = make_grid(args, args.name)
+    workers = max(1, min(args.workers, len(configs)))
+    threads = args.threads if args.threads is not None else max(1, (os.cpu_count() or 1) // workers)
+
+    print(f'Sweep of {len(configs)} configurations on {workers} worker(s) with {threads} thread(s) each')
+    print('Loading and whitening the data once...')
+    load_start = time.perf_counter()
+    shared_data = load_shared_data(args.train_yaml, args.probe, args.squeeze_factor)
+    print(f'Data ready in {time.perf_counter() - load_start:.1f} s')
+
+    sweep_start = time.perf_counter()
+    results = []
+    if workers == 1:
+        init_worker(shared_data, threads)
+        for i, config in enumerate(configs):
+            print(f'\n=== {i+1}/{len(configs)}: {config["tag"]} ===')
+            results.append(run_config(config, args, log=False))
+    else:
+        # spawn rather than fork: forking a process with live OpenMP threads can deadlock
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(workers, initializer=init_worker, initargs=(shared_data, threads)) as pool:
+            for result in pool.imap_unordered(_run_config_logged, [(config, args) for config in configs]):
+                results.append(result)
+                config, metrics, seconds, error = result
+                status = 'FAILED' if error is not None else 'done'
+                print(f'[{len(results)}/{len(configs)}] {config["tag"]}: {status} in {seconds/60:.1f} min (log: {config["log_file"]})')
+
+    # summary, in grid order
+    order = {config['tag']: i for i, config in enumerate(configs)}
+    results.sort(key=lambda result: order[result[0]['tag']])
+
+    lines = [f'{"tag":<40s} {"status":>7s} {"minutes":>8s} {"median_chi2":>12s} {"frac<0.2":>9s}']
+    for config, metrics, seconds, error in results:
+        if error is None:
+            lines.append(f'{config["tag"]:<40s} {"ok":>7s} {seconds/60:8.1f} {metrics["median_chi2"]:12.3e} {metrics["frac_lt_0p2"]:9.3f}')
+        else:
+            lines.append(f'{config["tag"]:<40s} {"FAILED":>7s} {seconds/60:8.1f} {"-":>12s} {"-":>9s}')
+
+    summary_file = os.path.join(args.output_dir, 'sweep_summary.txt')
+    with open(summary_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    print('')
+    print('\n'.join(lines))
+    print(f'\nSweep finished in {(time.perf_counter() - sweep_start)/60:.1f} min. Summary written to {summary_file}')
+
+    failed = [result for result in results if result[3] is not None]
+    for config, _, _, error in failed:
+        print(f'\n{config["tag"]} failed:\n{error}')
+
+    return len(failed)
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    sys.exit(1 if run_sweep(args) > 0 else 0)
@@ -3,122 +3,354 @@ import numpy as np
 import os
 import sys
 from datetime import datetime
-from emulator import ResTRF, ResMLP
+from emulator import ResTRF, ResMLP, Affine, activation_fcn, checkpointed_forward
+from lora import LoRALinear, add_lora_adapters, merge_lora, parse_lora_ranks
+from split_input import split_input_layer
+from losses import get_loss_fcn, get_ensemble_loss_fcn, LOSS_FORMS, eval_delta_chi2, chi2_metrics
+from data_utils import BatchIterator, StreamingBatchIterator, ParameterTable, DatavectorSource, fits_in_ram
+from data_utils import PreprocessingCache, cached_eigenbasis, cached_targets, file_stamp, file_digest
+from data_utils import load_cov_file
+from checkpoint import save_checkpoint, load_checkpoint
+from distributed import init_distributed, cleanup_distributed, barrier, shard_slice
+from distributed import broadcast_tensor, all_reduce_mean, all_gather_cat
+from ensemble import ModelEnsemble, eval_ensemble_delta_chi2, replica_filenames
+from compile_utils import compile_model, compile_optimizer_step
+from torch.nn.parallel import DistributedDataParallel
+import time
+import contextlib
 import yaml
 import h5py as h5
 import argparse
+import psutil
 
 #===================================================================================================
 # Command line args
 
-parser = argparse.ArgumentParser(prog='train_emulator')
-
-parser.add_argument("--yaml", "-y",
-    dest="cobaya_yaml",
-    help="The training YAML containing the training_args block",
-    type=str,
-    nargs='?')
-
-parser.add_argument("--probe", "-p",
-    dest="probe",
-    help="the probe, listed in the yaml, of which to generate data vectors for.",
-    type=str,
-    nargs='?')
-
-parser.add_argument("--epochs", "-e",
-    dest="n_epochs",
-    help="(int) number of training epochs. Default=250",
-    type=int,
-    default=250,
-    nargs='?')
-
-parser.add_argument("--batchsize", "-b",
-    dest="batch_size",
-    help="(int) batch size to use while training. Default=256",
-    type=int,
-    default=256,
-    nargs='?')
-
-parser.add_argument("--learning_rate", "-lr",
-    dest="learning_rate",
-    help="(float) learning rate to use while training. Default=1e-3",
-    type=float,
-    default=1e-3,
-    nargs='?')
-
-parser.add_argument("--weight_decay", "-wd",
-    dest="weight_decay",
-    help="(float) Weight decay (adds L2 norm of model weights to loss fcn) to use while training. Default=0",
-    type=float,
-    default=0.0,
-    nargs='?')
-
-parser.add_argument("--save_losses", "-s",
-    dest="save_losses",
-    help="(bool) Save losses at each epoch to a text file 'losses.txt'. Default=False",
-    type=bool,
-    default=False,
-    nargs='?')
-        
-# ======== Additions by Béla =======  
-parser.add_argument("--save_testing_metrics", "-stm",
-    dest="save_testing_metrics",
-    help="(bool) Save testing metrics (chi2 mean, median, fractions) at each epoch to 'testing_metrics.txt'. Default=False",
-    type=bool,
-    default=False,
-    nargs='?')
-
-parser.add_argument("--squeeze_factor", "-sf",
-    dest="squeeze_factor",
-    help="(float) Factor to divide covariance matrix by (cov = cov/squeeze_factor). Default=1.0 (no squeezing)",
-    type=float,
-    default=1.0,
-    nargs='?')
-
-# === TRANSFER LEARNING ARGUMENTS ===
-parser.add_argument("--transfer_learning", "-tl",
-    dest="transfer_learning",
-    help="(bool) Enable transfer learning mode. Default=False",
-    type=bool,
-    default=False,
-    nargs='?')
-
-parser.add_argument("--pretrained_model", "-pm",
-    dest="pretrained_model",
-    help="Path to pretrained model (.pth file) for transfer learning",
-    type=str,
-    default=None,
-    nargs='?')
-
-parser.add_argument("--freeze_strategy", "-fs",
-    dest="freeze_strategy",
-    help="Freezing strategy: 'none', 'input_output'",
-    type=str,
-    default='none',
-    choices=['none', 'early_1', 'early_2', 'early_3', 'early_4', 'late_1', 'late_2', 'late_3', 'late_4', 'input_output', 
-         'resnet_1', 'resnet_2', 'resnet_3', 'resnet_12', 'resnet_23', 'resnet_123'],
-    nargs='?')
-
-args, unknown = parser.parse_known_args()
-cobaya_yaml   = args.cobaya_yaml
-probe         = args.probe
-n_epochs      = args.n_epochs
-batch_size    = args.batch_size
-learning_rate = args.learning_rate
-weight_decay  = args.weight_decay
-save_losses   = args.save_losses
-# ======== Additions by Béla =======  
-save_testing_metrics = args.save_testing_metrics
-squeeze_factor = args.squeeze_factor
-# === TRANSFER LEARNING VARIABLES ===
-transfer_learning = args.transfer_learning
-pretrained_model = args.pretrained_model
-freeze_strategy = args.freeze_strategy
+def get_parser():
+    '''
+    the command line arguments of train_emulator.py. Parsed in __main__ only, so that
+    train_emulator() can be imported (e.g. by sweep.py) without touching sys.argv.
+    '''
+    parser = argparse.ArgumentParser(prog='train_emulator')
+
+    parser.add_argument("--yaml", "-y",
+        dest="cobaya_yaml",
+        help="The training YAML containing the training_args block",
+        type=str,
+        nargs='?')
+
+    parser.add_argument("--probe", "-p",
+        dest="probe",
+        help="the probe, listed in the yaml, of which to generate data vectors for.",
+        type=str,
+        nargs='?')
+
+    parser.add_argument("--epochs", "-e",
+        dest="n_epochs",
+        help="(int) number of training epochs. Default=250",
+        type=int,
+        default=250,
+        nargs='?')
+
+    parser.add_argument("--batchsize", "-b",
+        dest="batch_size",
+        help="(int) batch size to use while training. Default=256",
+        type=int,
+        default=256,
+        nargs='?')
+
+    parser.add_argument("--learning_rate", "-lr",
+        dest="learning_rate",
+        help="(float) learning rate to use while training. Default=1e-3",
+        type=float,
+        default=1e-3,
+        nargs='?')
+
+    parser.add_argument("--weight_decay", "-wd",
+        dest="weight_decay",
+        help="(float) Weight decay (adds L2 norm of model weights to loss fcn) to use while training. Default=0",
+        type=float,
+        default=0.0,
+        nargs='?')
+
+    parser.add_argument("--save_losses", "-s",
+        dest="save_losses",
+        help="(bool) Save losses at each epoch to a text file 'losses.txt'. Default=False",
+        type=bool,
+        default=False,
+        nargs='?')
+
+    # ======== Additions by Béla =======  
+    parser.add_argument("--save_testing_metrics", "-stm",
+        dest="save_testing_metrics",
+        help="(bool) Save testing metrics (chi2 mean, median, fractions) at each epoch to 'testing_metrics.txt'. Default=False",
+        type=bool,
+        default=False,
+        nargs='?')
+
+    parser.add_argument("--ntrain", "-nt",
+        dest="n_train",
+        help="(int) Number of training samples. Only these rows of the training files are read. Default=None (use all)",
+        type=int,
+        default=None,
+        nargs='?')
+
+    parser.add_argument("--squeeze_factor", "-sf",
+        dest="squeeze_factor",
+        help="(float) Factor to divide covariance matrix by (cov = cov/squeeze_factor). Default=1.0 (no squeezing)",
+        type=float,
+        default=1.0,
+        nargs='?')
+
+    # === TRANSFER LEARNING ARGUMENTS ===
+    parser.add_argument("--transfer_learning", "-tl",
+        dest="transfer_learning",
+        help="(bool) Enable transfer learning mode. Default=False",
+        type=bool,
+        default=False,
+        nargs='?')
+
+    parser.add_argument("--pretrained_model", "-pm",
+        dest="pretrained_model",
+        help="Path to pretrained model (.pth file) for transfer learning",
+        type=str,
+        default=None,
+        nargs='?')
+
+    parser.add_argument("--freeze_strategy", "-fs",
+        dest="freeze_strategy",
+        help="Freezing strategy: 'none', 'input_output'",
+        type=str,
+        default='none',
+        choices=['none', 'early_1', 'early_2', 'early_3', 'early_4', 'late_1', 'late_2', 'late_3', 'late_4', 'input_output', 
+             'resnet_1', 'resnet_2', 'resnet_3', 'resnet_12', 'resnet_23', 'resnet_123', 'lora'],
+        nargs='?')
+
+    parser.add_argument("--loss_form", "-lf",
+        dest="loss_form",
+        help="Loss form: 'chi2', 'hyperbola' or 'sqrt_chi2'. Default=None (use train_args['loss_form'] from the YAML, else 'hyperbola')",
+        type=str,
+        default=None,
+        choices=list(LOSS_FORMS.keys()),
+        nargs='?')
+
+    parser.add_argument("--eval_every", "-ee",
+        dest="eval_every",
+        help="(int) Evaluate the testing metrics every k epochs. 0 evaluates on the final epoch only. Default=1",
+        type=int,
+        default=1,
+        nargs='?')
+
+    parser.add_argument("--eval_chunk_size", "-ec",
+        dest="eval_chunk_size",
+        help="(int) Number of test samples per forward pass when evaluating the testing metrics. Default=4096",
+        type=int,
+        default=4096,
+        nargs='?')
+
+    parser.add_argument("--cache_preprocessing", "-cp",
+        dest="cache_preprocessing",
+        help="(bool) Cache the covariance eigenbasis, whitened targets and normalized inputs on disk and reuse them in later runs. Default=False",
+        type=bool,
+        default=False,
+        nargs='?')
+
+    parser.add_argument("--checkpoint_every", "-ce",
+        dest="checkpoint_every",
+        help="(int) Write a resumable checkpoint to <model file>.ckpt every k epochs. 0 disables checkpoints. Default=0",
+        type=int,
+        default=0,
+        nargs='?')
+
+    parser.add_argument("--resume", "-r",
+        dest="resume",
+        help="(bool) Continue training from <model file>.ckpt if it exists. Default=False",
+        type=bool,
+        default=False,
+        nargs='?')
+
+    parser.add_argument("--distributed", "-ddp",
+        dest="distributed",
+        help="Data-parallel training (DistributedDataParallel over gloo). Launch with torchrun or mpirun; --batchsize is the global batch, split over the ranks",
+        action='store_true',
+        default=False)
+
+    parser.add_argument("--ensemble", "-ens",
+        dest="ensemble",
+        help="(int) Train this many replicas (seeds seed, seed+1, ...) at once in one process, vectorized with vmap. Writes one model/.h5 pair and metrics file per seed. Default=1",
+        type=int,
+        default=1,
+        nargs='?')
+
+    parser.add_argument("--threads", "-th",
+        dest="threads",
+        help="(int) Number of torch threads (torch.set_num_threads). Default=None, torch's own choice",
+        type=int,
+        default=None,
+        nargs='?')
+
+    parser.add_argument("--model_file", "-mf",
+        dest="model_file",
+        help="Save the model here instead of the YAML's file entry (the .h5 goes to --extra_file). Default=None",
+        type=str,
+        default=None,
+        nargs='?')
+
+    parser.add_argument("--extra_file", "-xf",
+        dest="extra_file",
+        help="Save the preprocessing .h5 here instead of the YAML's extra entry. Default=None",
+        type=str,
+        default=None,
+        nargs='?')
+
+    parser.add_argument("--losses_file", "-lof",
+        dest="losses_file",
+        help="Where --save_losses writes. Default=losses.txt",
+        type=str,
+        default='losses.txt',
+        nargs='?')
+
+    parser.add_argument("--metrics_file", "-mef",
+        dest="metrics_file",
+        help="Where --save_testing_metrics writes. Default=testing_metrics.txt",
+        type=str,
+        default='testing_metrics.txt',
+        nargs='?')
+
+    parser.add_argument("--patience", "-pa",
+        dest="patience",
+        help="(int) Early stopping: stop after this many epochs without a new best validation loss. 0 disables it. Default=0",
+        type=int,
+        default=0,
+        nargs='?')
+
+    parser.add_argument("--min_lr", "-mlr",
+        dest="min_lr",
+        help="(float) Early stopping: stop once the scheduler has reduced the learning rate to this value or below. 0 disables it. Default=0",
+        type=float,
+        default=0.0,
+        nargs='?')
+
+    parser.add_argument("--target_median_chi2", "-tmc",
+        dest="target_median_chi2",
+        help="(float) Early stopping: stop once the test median Delta Chi2 reaches this value (checked on the --eval_every cadence). Default=None",
+        type=float,
+        default=None,
+        nargs='?')
+
+    parser.add_argument("--lbfgs_steps", "-ls",
+        dest="lbfgs_steps",
+        help="(int) Full-batch L-BFGS steps over the trainable parameters after the Adam epochs (--epochs 0 to skip Adam). 0 disables it. Default=0",
+        type=int,
+        default=0,
+        nargs='?')
+
+    parser.add_argument("--lbfgs_max_iter", "-lmi",
+        dest="lbfgs_max_iter",
+        help="(int) L-BFGS iterations per step. Default=20",
+        type=int,
+        default=20,
+        nargs='?')
+
+    parser.add_argument("--lbfgs_lr", "-llr",
+        dest="lbfgs_lr",
+        help="(float) L-BFGS step length before the strong Wolfe line search. Default=1.0",
+        type=float,
+        default=1.0,
+        nargs='?')
+
+    parser.add_argument("--precision", "-pr",
+        dest="precision",
+        help="Training precision: fp32, or bf16 for bfloat16 autocast of the forward and backward. Default=fp32",
+        type=str,
+        choices=['fp32', 'bf16'],
+        default='fp32')
+
+    parser.add_argument("--reference_metrics", "-rm",
+        dest="reference_metrics",
+        help="testing_metrics file of a float32 run, to compare the final metrics of a --precision bf16 run with. Default=None",
+        type=str,
+        default=None,
+        nargs='?')
+
+    parser.add_argument("--compile", "-co",
+        dest="compile",
+        help="Compile the training step with torch.compile (TorchScript on older torch), falling back to eager if that fails",
+        action='store_true')
+
+    parser.add_argument("--recompute_frozen_prefix", "-rfp",
+        dest="recompute_frozen_prefix",
+        help="Run the frozen leading layers of an early_* freeze strategy every step instead of caching their output once",
+        action='store_true')
+
+    parser.add_argument("--head_solve", "-hs",
+        dest="head_solve",
+        help="With --freeze_strategy early_4, solve the output layer by ridge least squares on the frozen features, then run the --epochs Adam epochs (0 for none)",
+        action='store_true')
+
+    parser.add_argument("--ridge", "-rdg",
+        dest="ridge",
+        help="(float) Ridge regularization of --head_solve, relative to the mean feature power. Default=1e-6",
+        type=float,
+        default=1e-6,
+        nargs='?')
+
+    parser.add_argument("--lora_rank", "-lrk",
+        dest="lora_rank",
+        help="With --freeze_strategy lora, the adapter rank of each group of layers as <group>=<rank>, groups input, res, output (a group left out gets no adapter). Default=input=8 res=8 output=8",
+        type=str,
+        default=['input=8', 'res=8', 'output=8'],
+        nargs='+')
+
+    parser.add_argument("--lora_alpha", "-la",
+        dest="lora_alpha",
+        help="(float) With --freeze_strategy lora, scale the adapters by lora_alpha/rank. Default=the rank",
+        type=float,
+        default=None,
+        nargs='?')
+
+    parser.add_argument("--lock_input_cols", "-lic",
+        dest="lock_input_cols",
+        help="(int) With --transfer_learning, keep the first N input columns of the input layer (and its bias) at their pretrained values and train only the remaining, new ones (e.g. w, w0pwa appended to a padded LCDM model). Default=0 (off)",
+        type=int,
+        default=0,
+        nargs='?')
+
+    parser.add_argument("--renormalize_inputs", "-rni",
+        dest="renormalize_inputs",
+        help="With --transfer_learning, normalize the inputs with the target training set statistics instead of the pretrained .h5 ones, and reparameterize the input layer so the pretrained model is preserved exactly",
+        action='store_true')
+
+    parser.add_argument("--shuffle", "-sh",
+        dest="shuffle",
+        help="(bool) Shuffle the training set with a seeded random permutation every epoch. Default=False",
+        type=bool,
+        default=False,
+        nargs='?')
+
+    parser.add_argument("--seed", "-sd",
+        dest="seed",
+        help="(int) Seed of the per-epoch training set permutation. Default=0",
+        type=int,
+        default=0,
+        nargs='?')
+
+    parser.add_argument("--keep_last_batch", "-klb",
+        dest="keep_last_batch",
+        help="(bool) Keep the final, smaller batch of each epoch instead of dropping it. Default=False",
+        type=bool,
+        default=False,
+        nargs='?')
+
+    return parser
 
 #===================================================================================================
 # covariance matrix read from file specified in the .dataset file specified in YAML
-    
-def get_cov(train_yaml):
+
+def get_dataset_file(train_yaml, key):
+    '''
+    path of the file listed under key ('cov_file', 'mask_file', 'data_file') in the .dataset file
+    '''
     with open(train_yaml,'r') as stream:
         config_args = yaml.safe_load(stream)
 
@@ -131,31 +363,128 @@ def get_cov(train_yaml):
     for line in data.readlines():
         split = line.split()
         # need: dv_fid, cov, mask.
-        if(split[0] == 'cov_file'):
-            cov_file = split[2]
+        if(len(split) > 2 and split[0] == key):
+            return path+'/'+split[2]
 
-    full_cov = np.loadtxt(path+'/'+cov_file)
-    cov_scenario = full_cov.shape[1]
-    size = int(np.max(full_cov[:])+1)
+    raise ValueError(f"No {key} in {path+'/'+data_file}")
 
-    cov = np.zeros((size,size))
+def get_cov_file(train_yaml):
+    return get_dataset_file(train_yaml, 'cov_file')
 
-    for line in full_cov:
-        i = int(line[0])
-        j = int(line[1])
+def get_mask(train_yaml):
+    '''
+    binary scale cut mask ordered by data vector index
+    '''
+    mask = np.loadtxt(get_dataset_file(train_yaml, 'mask_file'))
+    idxs = np.argsort(mask[:,0])
 
-        if(cov_scenario == 3):
-            cov_ij = line[2]
-        elif(cov_scenario == 4):
-            cov_ij = line[2]+line[3]
-        elif(cov_scenario == 10):
-            cov_ij = line[8]+line[9]
+    return mask[:,1][idxs]
 
-        cov[i,j] = cov_ij
-        cov[j,i] = cov_ij
+def get_cov(train_yaml, squeeze_factor=1.0, masked=False):
+    '''
+    the data covariance, divided by squeeze_factor. The text file is parsed once and kept in a
+    binary sidecar next to it (see data_utils.load_cov_file).
 
+    If masked, only the rows and columns kept by the scale cut mask are returned. Zeroing the
+    masked off-diagonal elements, inverting, cutting and inverting back gives exactly this block.
+    '''
+    cov = load_cov_file(get_cov_file(train_yaml))
     cov = cov / squeeze_factor
-    return cov
+
+    if not masked:
+        return cov
+
+    mask = get_mask(train_yaml).astype(bool)
+    return cov[mask][:,mask]
+
+#===================================================================================================
+# data files. The probe slice and the dataset paths, and the data shared by the runs of a sweep.
+
+def probe_slice(probe):
+    '''
+    the columns [start, stop) of the probe in the 3x2pt data vector
+    '''
+    # TODO: get indices from cosmolike
+    if probe=='galaxy_galaxy_lensing':
+        start = 780
+        stop = 780+650
+
+    elif probe=='cosmic_shear':
+        start = 0
+        stop = 780
+
+    elif probe=='galaxy_clustering':
+        start=780+650
+        stop = 1560
+
+    else:
+        raise NotImplementedError
+
+    return start, stop
+
+def get_data_files(train_args):
+    '''
+    full paths of the train/valid/test datavector and parameter files listed in train_args
+    '''
+    # get training and validation_data
+    if train_args['training_data_path'][0] == '/':
+        PATH = train_args['training_data_path']
+    else:
+        PATH = os.environ.get("ROOTDIR") + '/' + train_args['training_data_path']
+
+    return {key: PATH + train_args[key] for key in (
+        'train_datavectors_file', 'train_parameters_file',
+        'valid_datavectors_file', 'valid_parameters_file',
+        'test_datavectors_file',  'test_parameters_file')}
+
+def load_shared_data(train_yaml, probe, squeeze_factor=1.0):
+    '''
+    load and whiten the full training, validation and test sets once, for a sweep of runs that
+    all use them (see sweep.py). train_emulator(shared_data=...) then only slices n_train and
+    normalizes the inputs, which depends on the run (n_train, transfer learning).
+
+    returns a dict with the raw inputs x_*, the whitened targets y_* and the eigenbasis, whose
+    tensors are moved to shared memory so worker processes can use them without a copy
+    '''
+    start, stop = probe_slice(probe)
+
+    with open(train_yaml,'r') as stream:
+        args = yaml.safe_load(stream)
+
+    files          = get_data_files(args['train_args'])
+    cache_dir      = args['train_args'].get('cache_dir', None)
+    sampled_params = args['train_args'][probe]['extra_args']['ord'][0]
+
+    y_src = {name: DatavectorSource(files[f'{name}_datavectors_file'], start, stop) for name in ('train', 'valid', 'test')}
+
+    nbytes = 4 * (stop-start) * sum(len(src) for src in y_src.values())
+    if not fits_in_ram(nbytes):
+        raise MemoryError(f"The whitened datasets ({nbytes/2**30:.1f} GB) do not fit in RAM; run train_emulator.py on its own (it streams from disk)")
+
+    shared = {
+        'train_yaml':     train_yaml,
+        'probe':          probe,
+        'squeeze_factor': squeeze_factor,
+        'sampled_params': list(sampled_params),
+    }
+
+    for name in ('train', 'valid', 'test'):
+        table = ParameterTable(files[f'{name}_parameters_file'], cache_dir)
+        shared[f'x_{name}'] = torch.as_tensor(table.columns(sampled_params, rows=slice(0, len(y_src[name]))),dtype=torch.float64)
+
+    # same preprocessing as train_emulator, with dv_fid taken over rows start:stop of the full file
+    covmat = torch.as_tensor(get_cov(train_yaml, squeeze_factor)[start:stop,start:stop],dtype=torch.float64)
+    shared['dv_fid'] = torch.mean(y_src['train'].read(start, stop),axis=0)
+    shared['dv_evals'], shared['dv_evecs'] = torch.linalg.eigh(covmat)
+
+    for name in ('train', 'valid', 'test'):
+        shared[f'y_{name}'] = y_src[name].whiten(shared['dv_fid'], shared['dv_evecs'], shared['dv_evals'])
+
+    for value in shared.values():
+        if torch.is_tensor(value):
+            value.share_memory_()
+
+    return shared
 
 #===================================================================================================
 # === TRANSFER LEARNING: Layer freezing function ===
@@ -328,18 +657,197 @@ def freeze_layers(model, freeze_strategy, transfer_learning=True):
         print(f"TRANSFER LEARNING: ResNet Block 3 Frozen - model.3 ({frozen_params}/{total_params} = {100*frozen_params/total_params:.1f}%)")
         print("TRANSFER LEARNING: Trainable layers: Input + ResBlocks 1,2 + Output + Affine")
     
+    elif freeze_strategy == 'lora':
+        # LoRA: every weight frozen except the activation_fcn and Affine ones; the low-rank adapters
+        # added afterwards by add_lora_adapters are the rest of the trainable parameters
+        for module in model.modules():
+            if isinstance(module, (activation_fcn, Affine)):
+                continue
+            for param in module.parameters(recurse=False):
+                param.requires_grad = False
+                frozen_params += param.numel()
+
+        print(f"TRANSFER LEARNING: LoRA - all Linear/Attention/Transformer weights frozen ({frozen_params}/{total_params} = {100*frozen_params/total_params:.1f}%)")
+        print("TRANSFER LEARNING: Trainable layers: low-rank adapters + activations + Affine")
+
     else:
         raise ValueError(f"Unknown freeze_strategy: {freeze_strategy}")
     
     return frozen_params, total_params
 
+#===================================================================================================
+# input renormalization for transfer learning. The inputs are normalized as (x - mean)/(5*std), an
+# affine map, so moving from the pretrained statistics to those of the target training set changes
+# the input of model.0 by x_old = scale * x_new + shift, with scale = std_new/std_old and
+# shift = (mean_new - mean_old)/(5*std_old). Folding it into model.0,
+# W x_old + b = (W diag(scale)) x_new + (b + W shift), leaves the pretrained function unchanged.
+
+def renormalize_input_layer(model, old_mean, old_std, new_mean, new_std):
+    '''
+    reparameterize model.0 (nn.Linear, its SplitInputLinear or LoRALinear) in place for inputs
+    normalized with new_mean, new_std instead of old_mean, old_std. Computed in float64.
+
+    returns scale, shift (float64, one entry per input)
+    '''
+    old_mean, old_std, new_mean, new_std = (torch.as_tensor(t, dtype=torch.float64).flatten()
+                                            for t in (old_mean, old_std, new_mean, new_std))
+    scale = new_std / old_std
+    shift = (new_mean - old_mean) / (5 * old_std)
+
+    layer  = model.model[0]
+    target = layer.base if isinstance(layer, LoRALinear) else layer
+
+    # the state_dict of nn.Linear and SplitInputLinear is the merged weight and bias
+    state  = target.state_dict()
+    weight = state['weight'].double()
+    if weight.shape[1] != len(scale):
+        raise ValueError(f"the input layer takes {weight.shape[1]} inputs, the pretrained normalization has {len(scale)}")
+    scale, shift = scale.to(weight.device), shift.to(weight.device)
+
+    bias = state['bias'].double() + weight @ shift
+    if isinstance(layer, LoRALinear):
+        with torch.no_grad():
+            bias += layer.scale * (layer.lora_B.double() @ (layer.lora_A.double() @ shift))
+            layer.lora_A.mul_(scale.to(layer.lora_A.dtype))
+
+    target.load_state_dict({'weight': (weight * scale).to(state['weight'].dtype),
+                            'bias':   bias.to(state['bias'].dtype)})
+    return scale, shift
+
+#===================================================================================================
+# early stopping. Tracks the best validation loss, keeps a copy of the weights that achieved it, and
+# decides when training should stop. A stop on target_median_chi2 makes the weights that met the
+# target the ones kept, whatever their validation loss.
+
+class EarlyStopping:
+    '''
+    int   patience: stop after this many epochs without a new best validation loss (0 = off)
+    float min_lr: stop once the learning rate is at or below this value (0 = off)
+    float target_median_chi2: stop once the test median delta chi2 is at or below this value (None = off)
+    '''
+    def __init__(self, patience=0, min_lr=0.0, target_median_chi2=None):
+        self.patience           = patience
+        self.min_lr             = min_lr
+        self.target_median_chi2 = target_median_chi2
+
+        self.best_loss  = np.inf
+        self.best_epoch = -1
+        self.best_state = None
+        self.bad_epochs = 0
+        self.last_loss  = np.inf
+        self.last_epoch = -1
+        self.reached_target = False
+
+    @property
+    def enabled(self):
+        return self.patience > 0 or self.min_lr > 0 or self.target_median_chi2 is not None
+
+    def update(self, valid_loss, model, epoch):
+        '''
+        record the validation loss of this epoch, copying the weights if it is the best so far
+        '''
+        self.last_loss  = valid_loss
+        self.last_epoch = epoch
+        if self.reached_target:
+            return
+        if valid_loss < self.best_loss:
+            self.best_loss  = valid_loss
+            self.best_epoch = epoch
+            self.best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+
+    def stop_reason(self, optim, model, metrics=None):
+        '''
+        a message saying why training should stop now, or None to keep going.
+        metrics are the testing metrics if they were evaluated this epoch. If they meet the target,
+        the current weights of model become the best ones.
+        '''
+        lr = optim.param_groups[0]['lr']
+
+        if self.target_median_chi2 is not None and metrics is not None and metrics['median_chi2'] <= self.target_median_chi2:
+            self.reached_target = True
+            self.best_loss  = self.last_loss
+            self.best_epoch = self.last_epoch
+            self.best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            return f'median Delta Chi2 {metrics["median_chi2"]:1.3e} reached target {self.target_median_chi2:1.3e}'
+        if self.patience > 0 and self.bad_epochs >= self.patience:
+            return f'no improvement in validation loss for {self.bad_epochs} epochs'
+        # the scheduler's repeated multiplications land a rounding error away from e.g. 1e-6
+        if self.min_lr > 0 and lr <= self.min_lr * (1 + 1e-9):
+            return f'learning rate {lr:1.2e} reached min_lr={self.min_lr:1.2e}'
+        return None
+
+    def restore_best(self, model):
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+
+    def state_dict(self):
+        return {'best_loss': self.best_loss, 'best_epoch': self.best_epoch,
+                'best_state': self.best_state, 'bad_epochs': self.bad_epochs,
+                'reached_target': self.reached_target}
+
+    def load_state_dict(self, state):
+        self.best_loss  = state['best_loss']
+        self.best_epoch = state['best_epoch']
+        self.best_state = state['best_state']
+        self.bad_epochs = state['bad_epochs']
+        self.reached_target = state.get('reached_target', False)
+
+#===================================================================================================
+# peak memory of the training steps, to find the largest batch size that fits on a node
+
+class PeakMemory:
+    '''
+    with PeakMemory(device) as mem: ...  then mem.peak is the peak memory in bytes while inside, and
+    mem.increase the peak above the memory in use on entering. On cuda this is the memory allocated
+    by torch; on cpu the resident set size of the process (its peak is reset on entering on Linux,
+    elsewhere it is the peak since the process started).
+    '''
+    def __init__(self, device):
+        self.cuda = str(device).startswith('cuda')
+        self.device = device
+
+    def __enter__(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.base = torch.cuda.memory_allocated(self.device)
+        else:
+            try:
+                with open('/proc/self/clear_refs', 'w') as f:
+                    f.write('5')     # resets VmHWM, the peak RSS
+            except OSError:
+                pass
+            self.base = psutil.Process().memory_info().rss
+        return self
+
+    def __exit__(self, *exc):
+        if self.cuda:
+            self.peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            self.peak = self._peak_rss()
+        self.increase = self.peak - self.base
+        return False
+
+    @staticmethod
+    def _peak_rss():
+        try:
+            with open('/proc/self/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return psutil.Process().memory_info().rss
 
 #===================================================================================================
 # a progress bar to display while training. I find tqdm to be a little strange looking.
 
-def progress_bar(train_loss, valid_loss, start_time, epoch, total_epochs, optim):
+def progress_bar(train_loss, valid_loss, start_time, epoch, total_epochs, optim, first_epoch=0):
     ''' 
-    simple progress bar for training the emulator
+    simple progress bar for training the emulator. first_epoch is the epoch this process started at
+    (non-zero when resuming), used for the time estimate.
     '''
 
     elapsed_time = int((datetime.now() - start_time).total_seconds())
@@ -356,7 +864,7 @@ def progress_bar(train_loss, valid_loss, start_time, epoch, total_epochs, optim)
             bar += ' '
     bar += ']'
 
-    remaining_time = int((elapsed_time / (epoch)) * (total_epochs - (epoch)))
+    remaining_time = int((elapsed_time / (epoch - first_epoch)) * (total_epochs - (epoch)))
 
     print('\r' + bar + ' ' +                                \
           f'Epoch {epoch:3d}/{total_epochs:3d} | ' +        \
@@ -364,13 +872,422 @@ def progress_bar(train_loss, valid_loss, start_time, epoch, total_epochs, optim)
           f'lr={lr:1.2e} | ' +                              \
           f'time elapsed={elapsed_time:7d} s; time remaining={remaining_time:7d} s',end='')
 
+#===================================================================================================
+# model construction, training histories and output files
+
+def build_model(model_info, sampling_dim):
+    if( 'TRF' == model_info['MLA'] ):
+        return ResTRF(sampling_dim, 
+            model_info['OUTPUT_DIM'], 
+            model_info['INT_DIM_RES'], 
+            model_info['INT_DIM_TRF'],
+            model_info['NC_TRF'],
+            checkpoint_blocks=model_info.get('CHECKPOINT_BLOCKS', 0))
+    elif( 'MLP' == model_info['MLA'] ):
+        return ResMLP(sampling_dim,
+            model_info['OUTPUT_DIM'],
+            model_info['INT_DIM_RES'],
+            checkpoint_blocks=model_info.get('CHECKPOINT_BLOCKS', 0))
+    else:
+        raise NotImplementedError
+
+#===================================================================================================
+# frozen-prefix feature cache. When a freeze strategy freezes the first k layers of model.model
+# (early_1..4), their output for a sample is the same every epoch. It is computed once for the
+# training, validation and test sets and the remaining layers train on these features.
+
+def frozen_prefix_length(model):
+    '''
+    number of leading layers of model.model with no trainable parameters. BatchNorm, whose output
+    depends on the rest of the batch, ends the prefix.
+    '''
+    n = 0
+    for layer in model.model:
+        if any(p.requires_grad for p in layer.parameters()):
+            break
+        if any(isinstance(m, torch.nn.modules.batchnorm._BatchNorm) for m in layer.modules()):
+            break
+        n += 1
+    return n
+
+class SuffixModel(torch.nn.Module):
+    '''
+    the layers of model.model from start on, sharing their parameters with model and using the same
+    activation checkpointing
+    '''
+    def __init__(self, model, start):
+        super(SuffixModel, self).__init__()
+        self.model = model.model[start:]
+        self.checkpoint_blocks = getattr(model, 'checkpoint_blocks', 0)
+
+    def forward(self, x):
+        if self.checkpoint_blocks > 0 and self.training and torch.is_grad_enabled():
+            return checkpointed_forward(self.model, x, self.checkpoint_blocks)
+        return self.model(x)
+
+def prefix_features(layers, x, device, chunk_size=4096):
+    '''
+    layers(x) evaluated in chunks, on cpu. no_grad rather than inference_mode: the features are the
+    inputs of the trained layers, which save them for backward.
+    '''
+    features = []
+    with torch.no_grad():
+        for i in range(0, len(x), chunk_size):
+            features.append(layers(x[i:i+chunk_size].to(device)).cpu())
+    return torch.cat(features)
+
+def solve_output_head(features, linear, affine, x, y, device, ridge=1e-6, chunk_size=4096):
+    '''
+    set the output Linear and Affine layers to the ridge least squares fit of y on features(x)
+
+    The targets are whitened, so least squares is the minimum of the chi2 loss. The normal equations
+    are accumulated chunk by chunk in float64, and ridge is relative to the mean power of the features
+    (the bias is not regularized). The fit is absorbed into the Linear layer and the Affine is reset
+    to the identity.
+    '''
+    width = linear.in_features
+    n     = len(x)
+    HtH = torch.zeros((width+1, width+1), dtype=torch.float64)
+    HtY = torch.zeros((width+1, linear.out_features), dtype=torch.float64)
+
+    with torch.no_grad():
+        for i in range(0, n, chunk_size):
+            H = features(x[i:i+chunk_size].to(device)).to('cpu', torch.float64)
+            H = torch.cat((H, torch.ones((len(H), 1), dtype=torch.float64)), dim=1)
+            Y = torch.as_tensor(np.asarray(y[i:i+chunk_size]), dtype=torch.float64)
+            HtH += H.T @ H
+            HtY += H.T @ Y
+
+        HtH /= n
+        HtY /= n
+        reg = ridge * torch.mean(torch.diagonal(HtH)[:-1])
+        HtH[:-1, :-1] += reg * torch.eye(width, dtype=torch.float64)
+
+        solution = torch.linalg.solve(HtH, HtY)
+        linear.weight.copy_(solution[:-1].T)
+        linear.bias.copy_(solution[-1])
+        affine.gain.fill_(1.0)
+        affine.bias.fill_(0.0)
+
+def new_histories():
+    return {
+        'losses_train':       [],
+        'losses_valid':       [],
+        'test_mean_chi2':     [],
+        'test_median_chi2':   [],
+        'test_frac_gt_0p2':   [],
+        'test_frac_gt_1':     [],
+        'test_frac_lt_0p2':   [],     # fraction with chi^2 < 0.2
+        'test_criterion_met': [],     # boolean if criterion is satisfied
+        'test_epochs':        [],     # epochs at which the metrics were evaluated
+    }
+
+def append_metrics(histories, metrics, epoch):
+    histories['test_mean_chi2'].append(metrics['mean_chi2'])
+    histories['test_median_chi2'].append(metrics['median_chi2'])
+    histories['test_frac_gt_0p2'].append(metrics['frac_gt_0p2'])
+    histories['test_frac_gt_1'].append(metrics['frac_gt_1'])
+    histories['test_frac_lt_0p2'].append(metrics['frac_lt_0p2'])
+    histories['test_criterion_met'].append(float(metrics['criterion_met']))
+    histories['test_epochs'].append(epoch+1)
+
+def seed_filename(filename, seed):
+    root, ext = os.path.splitext(filename)
+    return f'{root}_seed{seed}{ext}'
+
+def save_histories(histories, losses_file, metrics_file, save_losses, save_testing_metrics):
+    if ( save_losses ):
+        np.savetxt(losses_file, np.array([histories['losses_train'],histories['losses_valid']],dtype=np.float64))
+
+    if ( save_testing_metrics ):
+        np.savetxt(metrics_file, np.array([
+            histories['test_mean_chi2'],           # mean chi2
+            histories['test_median_chi2'],         # median chi2  
+            histories['test_frac_gt_0p2'],         # fraction > 0.2
+            histories['test_frac_gt_1'],           # fraction > 1.0
+            histories['test_frac_lt_0p2'],         # NEW fraction < 0.2 
+            histories['test_criterion_met'],       # NEW criterion met (1 if True, 0 if False)
+            histories['test_epochs']               # epoch of each column (see --eval_every)
+        ], dtype=np.float64))
+
+def save_extra(extra_filename, samples_mean, samples_std, dv_fid, dv_evals, dv_evecs, sampled_params):
+    with h5.File(extra_filename, 'w') as f:
+        f['sample_mean']   = samples_mean
+        f['sample_std']    = samples_std
+        f['dv_fid']        = dv_fid
+        f['dv_evals']      = dv_evals
+        f['dv_evecs']      = dv_evecs
+        f['train_params']  = sampled_params
+
+#===================================================================================================
+# mixed precision. With precision='bf16' the forward (and so the backward) runs under autocast: the
+# matmuls of the Linear, Transformer and Attention layers run in bfloat16 (AVX-512 BF16 / AMX on
+# recent CPUs), while the elementwise activation_fcn and Affine layers, whose float32 parameters
+# promote their inputs, the loss, and the Adam state stay in float32.
+
+PRECISIONS = ['fp32', 'bf16']
+
+def autocast_context(precision, device):
+    if precision == 'bf16':
+        return torch.autocast('cuda' if device.startswith('cuda') else 'cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+def load_metrics_file(metrics_file):
+    '''
+    the final testing metrics of a run from its testing_metrics file (the last column)
+    '''
+    rows = np.atleast_2d(np.loadtxt(metrics_file))
+    keys = ['mean_chi2', 'median_chi2', 'frac_gt_0p2', 'frac_gt_1', 'frac_lt_0p2']
+    return {key: float(rows[i][-1]) for i, key in enumerate(keys)}
+
+def precision_report(metrics, metrics_bf16, reference=None):
+    '''
+    compare the test delta chi2 of a bf16-trained model, evaluated in float32 (as it is used) and under
+    bf16 autocast, with a float32 reference run if one is given
+    '''
+    columns = [('fp32 eval', metrics), ('bf16 eval', metrics_bf16)]
+    if reference is not None:
+        columns.append(('fp32 reference', reference))
+
+    print('')
+    print('Precision report (bf16 training).')
+    print(f'{"":16s}' + ''.join(f'{name:>16s}' for name, _ in columns))
+    for key, label in [('mean_chi2', 'mean Delta Chi2'), ('median_chi2', 'median Delta Chi2'),
+                       ('frac_gt_0p2', 'frac Chi2 > 0.2'), ('frac_gt_1', 'frac Chi2 > 1'),
+                       ('frac_lt_0p2', 'frac Chi2 < 0.2')]:
+        print(f'{label:16s}' + ''.join(f'{m[key]:16.4e}' for _, m in columns))
+
+    if reference is not None:
+        shift = metrics['median_chi2'] - reference['median_chi2']
+        print(f'Median Delta Chi2 shift vs the fp32 reference: {shift:+1.3e} ({shift/0.2:+.1%} of the 0.2 target)')
+
+#===================================================================================================
+# ensemble training. K replicas see the same batches and are evaluated together with vmap (see
+# ensemble.py); each has its own optimizer, scheduler and early stopping, exactly as K separate runs.
+
+def train_ensemble(replicas, loss_form, learning_rate, weight_decay, n_epochs, trainloader, validloader,
+            x_test, y_test, device, eval_every=1, eval_chunk_size=4096,
+            patience=0, min_lr=0.0, target_median_chi2=None):
+    '''
+    train the replicas in place
+
+    list replicas: K emulators of the same architecture
+    the other arguments are as in train_emulator
+    returns the list of histories and the list of final testing metrics, one per replica
+    '''
+    for replica in replicas:
+        replica.to(device)
+
+    ensemble   = ModelEnsemble(replicas)
+    loss_fcn   = get_ensemble_loss_fcn(loss_form)
+    optims     = [torch.optim.Adam([p for p in replica.parameters() if p.requires_grad], lr=learning_rate, weight_decay=weight_decay) for replica in replicas]
+    schedulers = [torch.optim.lr_scheduler.ReduceLROnPlateau(optim, 'min',patience=15,factor=0.1) for optim in optims]
+    early_stoppings = [EarlyStopping(patience, min_lr, target_median_chi2) for _ in replicas]
+    histories  = [new_histories() for _ in replicas]
+    active     = [True for _ in replicas]
+
+    print(f'Begin training {len(replicas)} replicas...',end='')
+    train_start_time = datetime.now()
+    train_time    = 0.0
+    train_samples = 0
+
+    for e in range(n_epochs):
+        ensemble.train()
+
+        # training loss. The replicas share no parameters, so backpropagating the sum of their losses
+        # gives each one its own gradient. Replicas that stopped early are still evaluated, just not updated.
+        losses = []
+        epoch_start = time.perf_counter()
+        for X, Y_batch in trainloader.epoch(e):
+            X       = X.to(device)
+            Y_batch = Y_batch.to(device)
+
+            loss = loss_fcn(Y_batch, ensemble(X))
+            losses.append(loss.cpu().detach().numpy())
+
+            for optim in optims:
+                optim.zero_grad()
+            loss.sum().backward()
+            for k, optim in enumerate(optims):
+                if active[k]:
+                    optim.step()
+
+        train_time    += time.perf_counter() - epoch_start
+        train_samples += len(losses) * trainloader.batch_size
+        losses_train = np.mean(losses, axis=0)
+
+        ###validation loss
+        with torch.no_grad():
+            ensemble.eval()
+            losses = []
+            for X_v, Y_v_batch in validloader:
+                X_v       = X_v.to(device)
+                Y_v_batch = Y_v_batch.to(device)
+                losses.append(loss_fcn(Y_v_batch, ensemble(X_v)).cpu().numpy())
+            losses_valid = np.mean(losses, axis=0)
+
+        ### Testing metrics every eval_every epochs, and always on the last one
+        evaluated = e == n_epochs-1 or (eval_every > 0 and (e+1) % eval_every == 0)
+        if evaluated:
+            delta_chi2 = eval_ensemble_delta_chi2(ensemble, x_test, y_test, device, eval_chunk_size)
+
+        for k in range(len(replicas)):
+            if not active[k]:
+                continue
+
+            histories[k]['losses_train'].append(float(losses_train[k]))
+            histories[k]['losses_valid'].append(float(losses_valid[k]))
+            schedulers[k].step(losses_valid[k])
+            early_stoppings[k].update(losses_valid[k], replicas[k], e)
+
+            metrics = None
+            if evaluated:
+                metrics = chi2_metrics(delta_chi2[k])
+                append_metrics(histories[k], metrics, e)
+
+            stop_reason = early_stoppings[k].stop_reason(optims[k], replicas[k], metrics) if early_stoppings[k].enabled else None
+            if stop_reason is not None:
+                print(f'\nReplica {k}: early stopping at epoch {e+1}: {stop_reason}')
+                active[k] = False
+
+        first_active = active.index(True) if any(active) else 0
+        progress_bar(float(np.mean(losses_train)), float(np.mean(losses_valid)), train_start_time, e, n_epochs, optims[first_active])
+
+        if not any(active):
+            break
+
+    if train_time > 0:
+        rate = train_samples / train_time
+        print(f'\nTraining throughput: {rate:1.3e} samples/s, {len(replicas)*rate:1.3e} replica-samples/s')
+
+    # keep the best validation weights of every replica that used early stopping, and report the
+    # testing metrics of the weights that are saved
+    for early_stopping, replica in zip(early_stoppings, replicas):
+        if early_stopping.enabled:
+            early_stopping.restore_best(replica)
+
+    delta_chi2 = eval_ensemble_delta_chi2(ensemble, x_test, y_test, device, eval_chunk_size)
+    metrics = [chi2_metrics(delta_chi2[k]) for k in range(len(replicas))]
+
+    return histories, metrics
+
+#===================================================================================================
+# full-batch L-BFGS
+
+def full_batch_loss(model, loss_fcn, x, y, device, chunk_size, weight_decay=0.0, backward=False):
+    '''
+    the loss over the whole of (x, y), evaluated in chunks. The chunks are weighted by their size, so
+    this is the same number as one batch of len(x) samples. With backward=True the gradients of the
+    full-batch loss are accumulated into .grad, one chunk at a time so only a chunk of activations is
+    ever alive. weight_decay adds the L2 term that Adam's weight_decay corresponds to.
+    '''
+    n = len(x)
+    total = 0.0
+    for i in range(0, n, chunk_size):
+        X = x[i:i+chunk_size].to(device)
+        Y = torch.as_tensor(y[i:i+chunk_size]).to(device)
+        loss = loss_fcn(Y, model(X)) * (len(X) / n)
+        if backward:
+            loss.backward()
+        total += float(loss.detach())
+
+    if weight_decay > 0:
+        params = [p for p in model.parameters() if p.requires_grad]
+        penalty = 0.5 * weight_decay * sum(torch.sum(p*p) for p in params)
+        if backward:
+            penalty.backward()
+        total += float(penalty.detach())
+
+    return total
+
+def train_lbfgs(model, loss_fcn, x_train, y_train, validloader, x_test, y_test, device,
+                n_steps, histories, early_stopping, first_epoch, lr=1.0, max_iter=20, history_size=100,
+                weight_decay=0.0, chunk_size=4096, eval_every=1, forward_model=None):
+    '''
+    fine-tune the trainable parameters of model with full-batch L-BFGS and a strong Wolfe line search
+
+    Every step runs up to max_iter L-BFGS iterations and is recorded in histories as one more epoch
+    (epoch first_epoch, first_epoch+1, ...), so the losses and metrics files continue where the Adam
+    epochs stopped. The objective is evaluated in eval mode, so that it is the same function at every
+    line search point (BatchNorm uses its running statistics).
+
+    forward_model runs the network on x (the layers after a cached frozen prefix); default model.
+
+    returns the testing metrics after the last step
+    '''
+    net    = forward_model if forward_model is not None else model
+    params = [p for p in model.parameters() if p.requires_grad]
+    optim  = torch.optim.LBFGS(params, lr=lr, max_iter=max_iter, history_size=history_size,
+                               line_search_fn='strong_wolfe')
+
+    def closure():
+        optim.zero_grad()
+        return full_batch_loss(net, loss_fcn, x_train, y_train, device, chunk_size, weight_decay, backward=True)
+
+    print(f'\nL-BFGS: {n_steps} full-batch steps of up to {max_iter} iterations on {len(x_train)} samples, '
+          f'{sum(p.numel() for p in params)} trainable parameters')
+
+    net.eval()
+    start_time  = datetime.now()
+    lbfgs_start = time.perf_counter()
+    metrics     = None
+    n_epochs    = first_epoch + n_steps
+
+    for e in range(first_epoch, n_epochs):
+        previous = [p.detach().clone() for p in params]
+        optim.step(closure)
+
+        with torch.no_grad():
+            train_loss = full_batch_loss(net, loss_fcn, x_train, y_train, device, chunk_size)
+
+        # a failed line search can leave non-finite weights: go back to the last good step and stop
+        if not np.isfinite(train_loss):
+            with torch.no_grad():
+                for p, p_prev in zip(params, previous):
+                    p.copy_(p_prev)
+            print(f'\nL-BFGS: non-finite loss at step {e-first_epoch+1}, keeping the previous weights')
+            break
+
+        with torch.no_grad():
+            losses = [float(loss_fcn(Y_v.to(device), net(X_v.to(device)))) for X_v, Y_v in validloader]
+        histories['losses_train'].append(train_loss)
+        histories['losses_valid'].append(float(np.mean(losses)))
+        early_stopping.update(histories['losses_valid'][-1], model, e)
+
+        converged = all(torch.equal(p, p_prev) for p, p_prev in zip(params, previous))
+        if e == n_epochs-1 or converged or (eval_every > 0 and (e+1) % eval_every == 0):
+            metrics = chi2_metrics(eval_delta_chi2(net, x_test, y_test, device, chunk_size))
+            append_metrics(histories, metrics, e)
+
+        progress_bar(histories['losses_train'][-1], histories['losses_valid'][-1], start_time, e, n_epochs, optim, first_epoch)
+
+        # L-BFGS stops within a step once the loss or the step stalls (tolerance_change); a step
+        # that moved nothing means the optimizer has converged
+        if converged:
+            print(f'\nL-BFGS: converged after {e-first_epoch+1} steps')
+            break
+
+    print(f'\nL-BFGS time: {time.perf_counter() - lbfgs_start:.1f} s')
+    return metrics
+
 #===================================================================================================
 # training routine
 
 def train_emulator(train_yaml, probe,
             n_epochs=250, batch_size=32, learning_rate=1e-3, weight_decay=0, 
             save_losses=False, save_testing_metrics=False, squeeze_factor=1.0,
-            transfer_learning=False, pretrained_model=None, freeze_strategy='none'):
+            transfer_learning=False, pretrained_model=None, freeze_strategy='none',
+            loss_form=None, eval_every=1, eval_chunk_size=4096,
+            shuffle=False, seed=0, keep_last_batch=False, n_train=None, cache_preprocessing=False,
+            checkpoint_every=0, resume=False,
+            patience=0, min_lr=0.0, target_median_chi2=None, distributed=False, ensemble=1,
+            shared_data=None, model_file=None, extra_file=None,
+            losses_file='losses.txt', metrics_file='testing_metrics.txt',
+            extrapar=None, keep_checkpoint=False,
+            lbfgs_steps=0, lbfgs_max_iter=20, lbfgs_lr=1.0,
+            precision='fp32', reference_metrics=None, compile_step=False, cache_frozen_prefix=True,
+            head_solve=False, ridge=1e-6, lora_ranks=None, lora_alpha=None,
+            lock_input_cols=0, renormalize_inputs=False):
     '''
     routine to train an emulator. 
 
@@ -380,60 +1297,145 @@ def train_emulator(train_yaml, probe,
     int     batch_size: batch size for training (default=32)
     float   learning_rate: learning rate for ADAM optimizer (default=1e-3)
     float   weight_decay: L2 regularization weight decay (default=0)
-    boolean save_losses: save training and validation loss to 'losses.txt' (default=False)
-    boolean save_testing_metrics: save testing metrics to 'testing_metrics.txt' (default=False)
+    boolean save_losses: save training and validation loss to losses_file (default=False)
+    boolean save_testing_metrics: save testing metrics to metrics_file (default=False)
     float   squeeze_factor: factor to divide covariance matrix by (default=1.0, no squeezing)
     boolean transfer_learning: use transfer learning from pretrained model (default=False)
     string  pretrained_model: path to pretrained model file (required if transfer_learning=True)
     string  freeze_strategy: layer freezing strategy - 'none', 'early_1', 'early_2', 'early_3', 'early_4', 
                            'late_1', 'late_2', 'late_3', 'late_4', 'input_output' (default='none')
+    string  loss_form: 'chi2', 'hyperbola' or 'sqrt_chi2'. If None, read train_args['loss_form'] from
+                       the YAML, falling back to 'hyperbola' (default=None)
+    int     eval_every: evaluate the testing metrics every k epochs, 0 for the final epoch only (default=1)
+    int     eval_chunk_size: test samples per forward pass in the testing metrics (default=4096)
+    boolean shuffle: shuffle the training set every epoch with a seeded permutation (default=False)
+    int     seed: seed of the permutation; epoch e uses seed+e so runs can be replayed (default=0)
+    boolean keep_last_batch: keep the final, smaller batch instead of dropping it (default=False)
+    int     n_train: number of training samples to use, from the start of the files (default=None, all)
+    boolean cache_preprocessing: cache the eigenbasis, whitened targets and normalized inputs on disk,
+                                 keyed by the covariance content, probe slice and data files (default=False)
+    int     checkpoint_every: write a resumable checkpoint to <model file>.ckpt every k epochs, 0 to
+                              disable (default=0)
+    boolean resume: continue from <model file>.ckpt if it exists (default=False)
+    int     patience: early stopping after this many epochs without a better validation loss, 0 to
+                      disable (default=0)
+    float   min_lr: early stopping once the learning rate is at or below this value, 0 to disable (default=0)
+    float   target_median_chi2: early stopping once the test median delta chi2 reaches this value (default=None)
+    If any early stopping criterion is set, the weights with the best validation loss are the ones saved.
+    boolean distributed: data-parallel training over the ranks started by torchrun/mpirun. batch_size
+                         is the global batch size. Only rank 0 writes files (default=False)
+    int     ensemble: train this many replicas at once, initialized with seeds seed, seed+1, ... Each
+                      gets its own model/.h5 pair (<model file>_seed<s>) and losses/metrics files
+                      (default=1, a single model as usual)
+    dict    shared_data: data already loaded and whitened by load_shared_data, e.g. by sweep.py
+                         (default=None, load it here)
+    string  model_file, extra_file: override the model and .h5 filenames of the YAML (default=None)
+    string  losses_file, metrics_file: where save_losses and save_testing_metrics write
+                                       (default='losses.txt', 'testing_metrics.txt')
+    dict    extrapar: entries overriding the YAML's extrapar, e.g. {'INT_DIM_RES': 512} or
+                      {'CHECKPOINT_BLOCKS': 2} for activation checkpointing (default=None)
+    boolean keep_checkpoint: leave a checkpoint of the final epoch in <model file>.ckpt, so that the
+                             run can be continued to more epochs with resume=True (default=False)
+    int     lbfgs_steps: after the n_epochs Adam epochs (n_epochs=0 for none), fine-tune the trainable
+                         parameters with this many full-batch L-BFGS steps, each recorded as an epoch.
+                         Needs the training set in RAM (default=0, off)
+    int     lbfgs_max_iter: L-BFGS iterations per step (default=20)
+    float   lbfgs_lr: L-BFGS step length before the line search (default=1.0)
+    string  precision: 'fp32', or 'bf16' to run the Adam epochs' forward and backward under bfloat16
+                       autocast. The testing metrics are always evaluated in float32 (default='fp32')
+    string  reference_metrics: testing_metrics file of a float32 run to compare a bf16 run with (default=None)
+    boolean compile_step: compile the training forward/backward and the Adam step with torch.compile
+                          (TorchScript on older torch), falling back to eager if that fails (default=False)
+    boolean cache_frozen_prefix: compute the output of the frozen leading layers (early_* freeze
+                                 strategies) once and train the remaining layers on it. fp32 only: under
+                                 bf16 the prefix would have to run under autocast for training and in
+                                 float32 for testing, so it is recomputed (default=True)
+    boolean head_solve: with early_4, set the output layer to the ridge least squares solution on the
+                        frozen features before the n_epochs Adam epochs (n_epochs=0 for none) (default=False)
+    float   ridge: ridge regularization of head_solve, relative to the mean feature power (default=1e-6)
+    dict    lora_ranks: with freeze_strategy='lora', the adapter rank of each group of layers, 'input',
+                        'res' and 'output' (see lora.py), 0 for none (default=None, rank 8 for all)
+    float   lora_alpha: the adapters are scaled by lora_alpha/rank (default=None, the rank: scale 1)
+    int     lock_input_cols: in transfer learning, keep the first lock_input_cols input columns of model.0
+                             and its bias fixed and train the remaining (new) columns, whatever the freeze
+                             strategy. Only the new columns have optimizer state (default=0, off)
+    boolean renormalize_inputs: in transfer learning, normalize the inputs with the statistics of the
+                                target training set instead of the pretrained ones, and fold the change
+                                into model.0 so the pretrained function is preserved exactly (default=False)
+    returns the final testing metrics (a list of them for an ensemble; None on ranks other than 0)
     '''
-    print('')
-    print('Probe =', probe)
-
-    # TODO: get indices from cosmolike
-    if probe=='galaxy_galaxy_lensing':
-        start = 780
-        stop = 780+650
+    if ensemble > 1 and (distributed or checkpoint_every > 0 or resume or keep_checkpoint):
+        raise ValueError("ensemble training does not support distributed, checkpoint_every, resume or keep_checkpoint")
+    if ensemble > 1 and transfer_learning:
+        # the replicas would all start from the pretrained weights and see the same batches: K copies of one run
+        raise ValueError("ensemble training does not support transfer_learning")
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, not {precision}")
+    if precision != 'fp32' and ensemble > 1:
+        raise ValueError("ensemble training only supports precision='fp32'")
+    if compile_step and ensemble > 1:
+        raise ValueError("ensemble training does not support compile_step")
+
+    if lora_ranks is None:
+        lora_ranks = {'input': 8, 'res': 8, 'output': 8}
+
+    if lock_input_cols > 0 and not transfer_learning:
+        raise ValueError("lock_input_cols needs transfer_learning")
+    if renormalize_inputs and not transfer_learning:
+        raise ValueError("renormalize_inputs needs transfer_learning")
+    if lock_input_cols > 0 and freeze_strategy == 'lora' and lora_ranks.get('input', 0) > 0:
+        raise ValueError("lock_input_cols cannot be combined with a LoRA adapter on the input layer (use --lora_rank without input=)")
+
+    if head_solve and (distributed or ensemble > 1):
+        raise ValueError("head_solve does not support distributed or ensemble training")
+
+    if lbfgs_steps > 0 and (distributed or ensemble > 1):
+        raise ValueError("lbfgs_steps does not support distributed or ensemble training")
+
+    if shared_data is not None:
+        if distributed or cache_preprocessing:
+            raise ValueError("shared_data cannot be combined with distributed or cache_preprocessing")
+        if (shared_data['probe'], shared_data['squeeze_factor']) != (probe, squeeze_factor):
+            raise ValueError(f"shared_data was prepared for probe={shared_data['probe']}, squeeze_factor={shared_data['squeeze_factor']}")
+
+    # data-parallel training: every rank trains on its own shard of the training set. Only rank 0
+    # prints and writes files.
+    if distributed:
+        rank, world_size, local_rank = init_distributed('gloo')
+    else:
+        rank, world_size, local_rank = 0, 1, 0
 
-    elif probe=='cosmic_shear':
-        start = 0
-        stop = 780
+    if batch_size % world_size != 0:
+        raise ValueError(f"batch_size={batch_size} is not divisible by the {world_size} ranks")
+    rank_batch_size = batch_size // world_size
 
-    elif probe=='galaxy_clustering':
-        start=780+650
-        stop = 1560
+    print('')
+    print('Probe =', probe)
 
-    else:
-        raise NotImplementedError
+    start, stop = probe_slice(probe)
 
     # open the config file and get the arguments we want.
     with open(train_yaml,'r') as stream:
         args = yaml.safe_load(stream)
 
-    # get training and validation_data
-    if args['train_args']['training_data_path'][0] == '/':
-        PATH = args['train_args']['training_data_path']
-    else:
-        PATH = os.environ.get("ROOTDIR") + '/' + args['train_args']['training_data_path']
-
     # get saving filenames      
-    model_filename = args['train_args'][probe]['extra_args']['file'][0]
-    extra_filename = args['train_args'][probe]['extra_args']['extra'][0]
+    model_filename = model_file if model_file is not None else args['train_args'][probe]['extra_args']['file'][0]
+    extra_filename = extra_file if extra_file is not None else args['train_args'][probe]['extra_args']['extra'][0]
 
     print('Model will be saved to:',model_filename,'and',extra_filename)
     print('')
 
-    covmat_file      = PATH + args['train_args']['data_covmat_file']
+    files = get_data_files(args['train_args'])
 
-    train_datavectors_file = PATH + args['train_args']['train_datavectors_file']
-    train_parameters_file  = PATH + args['train_args']['train_parameters_file']
+    train_datavectors_file = files['train_datavectors_file']
+    train_parameters_file  = files['train_parameters_file']
 
-    valid_datavectors_file = PATH + args['train_args']['valid_datavectors_file']
-    valid_parameters_file  = PATH + args['train_args']['valid_parameters_file']
+    valid_datavectors_file = files['valid_datavectors_file']
+    valid_parameters_file  = files['valid_parameters_file']
 
-    test_datavectors_file = PATH + args['train_args']['test_datavectors_file']
-    test_parameters_file  = PATH + args['train_args']['test_parameters_file']
+    test_datavectors_file = files['test_datavectors_file']
+    test_parameters_file  = files['test_parameters_file']
 
     print('Loading training data from:')
     print(train_datavectors_file)
@@ -447,28 +1449,43 @@ def train_emulator(train_yaml, probe,
     sampled_params = args['train_args'][probe]['extra_args']['ord'][0]
     sampling_dim = len(sampled_params)
 
+    if shared_data is not None and list(sampled_params) != shared_data['sampled_params']:
+        raise ValueError(f"shared_data was prepared for the parameters {shared_data['sampled_params']}")
+
     print('Parameters are:')
     print(sampled_params)
     print('')
 
     # get device
     device = args['train_args'][probe]['extra_args']['device']
+    if world_size > 1 and device.startswith('cuda'):
+        device = f'cuda:{local_rank}'
 
-    # get model
-    model_info = args['train_args'][probe]['extra_args']['extrapar'][0]
+    if world_size > 1:
+        print(f'Data-parallel training on {world_size} ranks, {rank_batch_size} samples per rank in each batch of {batch_size}')
+        print('')
 
-    if( 'TRF' == model_info['MLA'] ):
-        model = ResTRF(sampling_dim, 
-            model_info['OUTPUT_DIM'], 
-            model_info['INT_DIM_RES'], 
-            model_info['INT_DIM_TRF'],
-            model_info['NC_TRF'])
-    elif( 'MLP' == model_info['MLA'] ):
-        model = ResMLP(sampling_dim,
-            model_info['OUTPUT_DIM'],
-            model_info['INT_DIM_RES'])
-    else:
-        raise NotImplementedError
+    # get the loss. Command line takes precedence over the YAML.
+    if loss_form is None:
+        loss_form = args['train_args'].get('loss_form', 'hyperbola')
+    loss_fcn = get_loss_fcn(loss_form)
+
+    print('Loss form:', loss_form)
+    print('')
+
+    # get model
+    model_info = dict(args['train_args'][probe]['extra_args']['extrapar'][0])
+    if extrapar is not None:
+        model_info.update(extrapar)
+
+    if ensemble > 1 and model_info['MLA'] != 'MLP':
+        raise NotImplementedError("ensemble training only supports MLA: MLP")
+    if ensemble > 1 and model_info.get('CHECKPOINT_BLOCKS', 0) > 0:
+        raise NotImplementedError("ensemble training does not support CHECKPOINT_BLOCKS")
+
+    if ensemble > 1:
+        torch.manual_seed(seed)
+    model = build_model(model_info, sampling_dim)
     
     # === TRANSFER LEARNING: Load pretrained model if specified ===
     if transfer_learning:
@@ -495,6 +1512,15 @@ def train_emulator(train_yaml, probe,
         
         # Apply layer freezing
         frozen_params, total_params = freeze_layers(model, freeze_strategy, transfer_learning=True)
+
+        if freeze_strategy == 'lora':
+            n_adapter = add_lora_adapters(model, lora_ranks, lora_alpha)
+            print(f'TRANSFER LEARNING: LoRA ranks {lora_ranks}, {n_adapter} adapter parameters')
+
+        if lock_input_cols > 0:
+            n_new = split_input_layer(model, lock_input_cols)
+            print(f'TRANSFER LEARNING: input columns 0-{lock_input_cols-1} locked; '
+                  f'training only the last {sampling_dim - lock_input_cols} input columns ({n_new} parameters)')
     else:
         # Normal training - no pretrained parameters
         pretrained_samples_mean = None
@@ -505,76 +1531,201 @@ def train_emulator(train_yaml, probe,
         
         frozen_params, total_params = freeze_layers(model, 'none', transfer_learning=False)
 
+    # the ensemble replicas. Replica k is initialized with seed+k.
+    if ensemble > 1:
+        seeds = [seed + k for k in range(ensemble)]
+        replicas = [model]
+        for s in seeds[1:]:
+            torch.manual_seed(s)
+            replicas.append(build_model(model_info, sampling_dim))
+        print(f'ENSEMBLE: {ensemble} replicas with seeds {seeds}')
+
 
     # load and preprocess the data
     print('Processing the data. May take some time...')
 
-    # read the header from the train_parameters:
-    f_train = open(train_parameters_file)
-    train_params = np.array(f_train.readline().split(' ')[1:])
-    train_params[-1] = train_params[-1][:-1] # because the last param has a \n
-
-    f_valid = open(valid_parameters_file)
-    valid_params = np.array(f_valid.readline().split(' ')[1:])
-    valid_params[-1] = valid_params[-1][:-1] # because the last param has a \n
+    # rank 0 goes through the preprocessing first, so it alone builds the parameter, covariance and
+    # preprocessing caches, and the other ranks just read them
+    if rank != 0:
+        barrier()
+
+    cache_dir = args['train_args'].get('cache_dir', None)
+
+    # the preprocessing cache (--cache_preprocessing) lives in cache_dir, or next to the training data
+    if cache_preprocessing:
+        preprocessing_dir = cache_dir if cache_dir is not None else os.path.join(os.path.dirname(train_datavectors_file), 'preprocessing_cache')
+
+        inputs_cache = PreprocessingCache(preprocessing_dir, 'inputs', {
+            'parameter_files': [file_stamp(f) for f in (train_parameters_file, valid_parameters_file, test_parameters_file)],
+            'params':          list(sampled_params),
+            'n_train':         n_train,
+            'pretrained':      file_stamp(pretrained_h5) if (transfer_learning and not renormalize_inputs) else None,
+        })
+
+    # the datavectors are memory-mapped: only the first n_train rows and the probe columns are ever
+    # read, and they are whitened chunk by chunk further down. Leave on cpu to save vram!
+    y_train_src = DatavectorSource(train_datavectors_file, start, stop, n_rows=n_train)
+    y_valid_src = DatavectorSource(valid_datavectors_file, start, stop)
+    y_test_src  = DatavectorSource(test_datavectors_file,  start, stop)
+
+    if n_train is not None:
+        print(f'Using n_train={n_train} samples')
+
+    if cache_preprocessing and inputs_cache.has('x_train', 'x_valid', 'x_test', 'samples_mean', 'samples_std'):
+        print('Loading normalized inputs from', inputs_cache.dir)
+        x_train = torch.as_tensor(inputs_cache.load('x_train'))
+        x_valid = torch.as_tensor(inputs_cache.load('x_valid'))
+        x_test  = torch.as_tensor(inputs_cache.load('x_test'))
+        samples_mean = torch.as_tensor(inputs_cache.load('samples_mean'))
+        samples_std  = torch.as_tensor(inputs_cache.load('samples_std'))
 
-    f_test = open(test_parameters_file)
-    test_params = np.array(f_test.readline().split(' ')[1:])
-    test_params[-1] = test_params[-1][:-1] # because the last param has a \n
-
-    train_idxs = []
-    valid_idxs = []
-    test_idxs  = []
-    for p in sampled_params:
-        train_idxs.append(np.where(train_params==p)[0][0])
-        valid_idxs.append(np.where(valid_params==p)[0][0])
-        test_idxs.append(np.where(test_params==p)[0][0])
+    else:
+        if shared_data is not None:
+            x_train = shared_data['x_train'][:len(y_train_src)]
+            x_valid = shared_data['x_valid']
+            x_test  = shared_data['x_test']
+        else:
+            # the parameter files are read through a binary cache (built on first use, rebuilt whenever the
+            # text file changes), and only the ord columns are pulled out, by name.
+            train_table = ParameterTable(train_parameters_file, cache_dir)
+            valid_table = ParameterTable(valid_parameters_file, cache_dir)
+            test_table  = ParameterTable(test_parameters_file,  cache_dir)
+
+            x_train = torch.as_tensor(train_table.columns(sampled_params, rows=slice(0, len(y_train_src))),dtype=torch.float64)
+            x_valid = torch.as_tensor(valid_table.columns(sampled_params),dtype=torch.float64)
+            x_test  = torch.as_tensor(test_table.columns(sampled_params),dtype=torch.float64)
+
+        # === TRANSFER LEARNING: Choose preprocessing strategy ===
+        if transfer_learning and not renormalize_inputs:
+            # Use pretrained preprocessing for consistency
+            samples_mean = pretrained_samples_mean
+            samples_std = pretrained_samples_std
+            print('TRANSFER LEARNING: Using pretrained preprocessing parameters')
+        else:
+            # Normal training - compute new preprocessing parameters
+            samples_mean = torch.Tensor(x_train.mean(axis=0, keepdims=True))
+            samples_std  = torch.Tensor(x_train.std(axis=0, keepdims=True))
+            print('TRANSFER LEARNING: Computing new preprocessing parameters' if transfer_learning else
+                  'NORMAL TRAINING: Computing new preprocessing parameters')
+
+        x_train = torch.div( (x_train - samples_mean), 5*samples_std)
+        x_valid = torch.div( (x_valid - samples_mean), 5*samples_std)
+        x_test  = torch.div( (x_test  - samples_mean), 5*samples_std)
+
+        # convert to float32
+        x_train = torch.as_tensor(x_train,dtype=torch.float32)
+        x_valid = torch.as_tensor(x_valid,dtype=torch.float32)
+        x_test  = torch.as_tensor(x_test, dtype=torch.float32)
+
+        if cache_preprocessing:
+            inputs_cache.save('x_train', x_train.numpy())
+            inputs_cache.save('x_valid', x_valid.numpy())
+            inputs_cache.save('x_test',  x_test.numpy())
+            inputs_cache.save('samples_mean', samples_mean.numpy())
+            inputs_cache.save('samples_std',  samples_std.numpy())
+
+    # the pretrained input layer, refolded for the target normalization
+    if renormalize_inputs:
+        in_scale, in_shift = renormalize_input_layer(model, pretrained_samples_mean, pretrained_samples_std,
+                                                     samples_mean, samples_std)
+        print(f'TRANSFER LEARNING: input layer reparameterized for the target normalization '
+              f'(std ratio {in_scale.min().item():.3g}-{in_scale.max().item():.3g}, largest mean shift {in_shift.abs().max().item():.3g})')
+
+    # dv_fid is the mean over rows start:stop of the training set, as before
+    get_dv_fid = lambda: torch.mean(y_train_src.read(start, stop),axis=0)
+
+    if cache_preprocessing:
+        # keyed on the covariance content, the probe slice and the data files. The training targets
+        # are whitened for the whole file once and sliced to n_train, so N-sweeps share them.
+        whitening_cache = PreprocessingCache(preprocessing_dir, 'whitening', {
+            'cov':        file_digest(get_cov_file(train_yaml)),
+            'probe':      [start, stop],
+            'dv_files':   [file_stamp(f) for f in (train_datavectors_file, valid_datavectors_file, test_datavectors_file)],
+            'n_fid_rows': min(stop, len(y_train_src)) - start,     # the rows dv_fid is the mean of
+        })
+
+        dv_evals, dv_evecs, dv_fid = cached_eigenbasis(whitening_cache,
+            lambda: torch.as_tensor(get_cov(train_yaml)[start:stop,start:stop],dtype=torch.float64),
+            get_dv_fid, squeeze_factor)
+
+        y_train_all = DatavectorSource(train_datavectors_file, start, stop)
+        y_train = cached_targets(whitening_cache, 'y_train', y_train_all, dv_fid, dv_evecs, dv_evals, squeeze_factor)[:len(y_train_src)]
+        y_valid = torch.from_numpy(np.array(cached_targets(whitening_cache, 'y_valid', y_valid_src, dv_fid, dv_evecs, dv_evals, squeeze_factor)))
+        y_test  = torch.from_numpy(np.array(cached_targets(whitening_cache, 'y_test',  y_test_src,  dv_fid, dv_evecs, dv_evals, squeeze_factor)))
+
+    elif shared_data is not None:
+        # whitened once for the whole sweep. dv_fid only differs from the shared one when n_train < stop
+        # (fewer rows to average), which moves every whitened vector by the same constant
+        dv_evals = shared_data['dv_evals']
+        dv_evecs = shared_data['dv_evecs']
+        dv_fid   = get_dv_fid()
+
+        y_train = shared_data['y_train'][:len(y_train_src)]
+        y_valid = shared_data['y_valid']
+        y_test  = shared_data['y_test']
+
+        if not torch.equal(dv_fid, shared_data['dv_fid']):
+            shift = torch.div( (dv_fid - shared_data['dv_fid']) @ dv_evecs, torch.sqrt(dv_evals)).to(torch.float32)
+            y_train = y_train - shift
+            y_valid = y_valid - shift
+            y_test  = y_test  - shift
 
-    # load the data of the given train_prefix and valid_prefix. Leave on cpu to save vram!
-    x_train = torch.as_tensor(np.loadtxt(train_parameters_file)[:,train_idxs],dtype=torch.float64)
-    y_train = torch.as_tensor(np.load(train_datavectors_file)[:,start:stop],dtype=torch.float64)
+    else:
+        # convert data
+        covmat = torch.as_tensor(get_cov(train_yaml, squeeze_factor)[start:stop,start:stop],dtype=torch.float64)
+        dv_fid = get_dv_fid()
+
+        # diagonalize the training datavectors
+        dv_evals, dv_evecs = torch.linalg.eigh(covmat)
+
+    if rank == 0:
+        barrier()
+
+    # every rank uses rank 0's normalized inputs and eigenbasis, so that a different BLAS or thread
+    # count cannot make them differ (e.g. eigenvector signs). No-ops in a single process.
+    for t in (x_train, x_valid, x_test, samples_mean, samples_std, dv_fid, dv_evals, dv_evecs):
+        broadcast_tensor(t)
+
+    # each rank trains on its own contiguous block of the training set, all of the same length. The
+    # validation and test sets are split over the ranks too and their results combined.
+    train_rows = shard_slice(len(x_train), rank, world_size, equal=True)
+    valid_rows = shard_slice(len(x_valid), rank, world_size)
+    test_rows  = shard_slice(len(x_test),  rank, world_size)
+
+    x_train = x_train[train_rows]
+
+    if cache_preprocessing:
+        # the cached training targets are already a memmap, so streaming needs no extra file
+        y_train = y_train[train_rows]
+        train_in_ram = fits_in_ram(y_train.nbytes)
+        if train_in_ram:
+            y_train = torch.from_numpy(np.array(y_train))
+        stream_file = None
+
+    elif shared_data is not None:
+        y_train = y_train[train_rows]
+        train_in_ram = True
+        stream_file = None
 
-    x_valid = torch.as_tensor(np.loadtxt(valid_parameters_file)[:,valid_idxs],dtype=torch.float64)
-    y_valid = torch.as_tensor(np.load(valid_datavectors_file)[:,start:stop],dtype=torch.float64)
+    else:
+        y_train_shard = y_train_src.shard(train_rows)
 
-    x_test = torch.as_tensor(np.loadtxt(test_parameters_file)[:,test_idxs],dtype=torch.float64)
-    y_test = torch.as_tensor(np.load(test_datavectors_file)[:,start:stop],dtype=torch.float64)
+        # whiten the datavectors. The training set stays in RAM if it fits (same test as the dataset
+        # generators), otherwise it is written to a float32 memmap on disk and streamed during training.
+        train_in_ram = fits_in_ram(4 * y_train_shard.shape[0] * y_train_shard.shape[1])
 
-    # convert data
-    covmat = torch.as_tensor(get_cov(train_yaml)[start:stop,start:stop],dtype=torch.float64)
-    dv_fid  = torch.as_tensor(torch.mean(y_train[start:stop],axis=0),dtype=torch.float64)
+        if train_in_ram:
+            y_train = y_train_shard.whiten(dv_fid, dv_evecs, dv_evals)
+            stream_file = None
+        else:
+            stream_dir  = cache_dir if cache_dir is not None else os.path.dirname(train_datavectors_file)
+            stream_file = os.path.join(stream_dir, f'{os.path.basename(train_datavectors_file)}.whitened_{start}_{stop}_rank{rank}_{os.getpid()}.npy')
+            print(f'Training set does not fit in RAM. Streaming it from {stream_file}')
+            y_train = y_train_shard.whiten(dv_fid, dv_evecs, dv_evals,
+                out=np.lib.format.open_memmap(stream_file, mode='w+', dtype=np.float32, shape=y_train_shard.shape))
 
-    # === TRANSFER LEARNING: Choose preprocessing strategy ===
-    if transfer_learning:
-        # Use pretrained preprocessing for consistency
-        samples_mean = pretrained_samples_mean
-        samples_std = pretrained_samples_std
-        print('TRANSFER LEARNING: Using pretrained preprocessing parameters')
-    else:
-        # Normal training - compute new preprocessing parameters
-        samples_mean = torch.Tensor(x_train.mean(axis=0, keepdims=True))
-        samples_std  = torch.Tensor(x_train.std(axis=0, keepdims=True))
-        print('NORMAL TRAINING: Computing new preprocessing parameters')
-
-    x_train = torch.div( (x_train - samples_mean), 5*samples_std)
-    x_valid = torch.div( (x_valid - samples_mean), 5*samples_std)
-    x_test  = torch.div( (x_test  - samples_mean), 5*samples_std)
-
-    # diagonalize the training datavectors
-    dv_evals, dv_evecs = torch.linalg.eigh(covmat)
-    inv_covmat = torch.diag(1/dv_evals).type(torch.float32).to(device)
-
-    y_train = torch.div( (y_train - dv_fid) @ dv_evecs, torch.sqrt(dv_evals))
-    y_valid = torch.div( (y_valid - dv_fid) @ dv_evecs, torch.sqrt(dv_evals))
-    y_test  = torch.div( (y_test  - dv_fid) @ dv_evecs, torch.sqrt(dv_evals))
-
-    # convert to float32
-    x_train = torch.as_tensor(x_train,dtype=torch.float32)
-    y_train = torch.as_tensor(y_train,dtype=torch.float32)
-    x_valid = torch.as_tensor(x_valid,dtype=torch.float32)
-    y_valid = torch.as_tensor(y_valid,dtype=torch.float32)
-    x_test  = torch.as_tensor(x_test, dtype=torch.float32)
-    y_test  = torch.as_tensor(y_test, dtype=torch.float32)
+        y_valid = y_valid_src.whiten(dv_fid, dv_evecs, dv_evals)
+        y_test  = y_test_src.whiten(dv_fid, dv_evecs, dv_evals)
 
     # === TRANSFER LEARNING: Setup optimizer for trainable parameters only ===
     if transfer_learning:
@@ -591,135 +1742,265 @@ def train_emulator(train_yaml, probe,
     # load the data into loaders
     model.to(device)
 
-    generator = torch.Generator(device=device)
-    trainset    = torch.utils.data.TensorDataset(x_train, y_train)
-    validset    = torch.utils.data.TensorDataset(x_valid, y_valid)
+    # the frozen leading layers are evaluated once here, and everything below runs the rest of the
+    # network (forward_model) on their output. model still holds all the weights. With bf16 the
+    # training forward runs the prefix under autocast and testing in float32, so it is not cached.
+    forward_model = model
+    n_prefix = frozen_prefix_length(model) if (cache_frozen_prefix and ensemble == 1 and precision == 'fp32') else 0
+    if n_prefix > 0:
+        prefix = model.model[:n_prefix]
+        width  = prefix_features(prefix, x_train[:1], device).shape[1]
+        if fits_in_ram(4 * width * (len(x_train) + len(x_valid) + len(x_test))):
+            prefix_start = time.perf_counter()
+            x_train = prefix_features(prefix, x_train, device, eval_chunk_size)
+            x_valid = prefix_features(prefix, x_valid, device, eval_chunk_size)
+            x_test  = prefix_features(prefix, x_test,  device, eval_chunk_size)
+            forward_model = SuffixModel(model, n_prefix)
+            print(f'Frozen prefix model.0-{n_prefix-1}: features of width {width} computed once in {time.perf_counter() - prefix_start:.1f} s, '
+                  f'training model.{n_prefix}-{len(model.model)-1}')
+        else:
+            print('Frozen prefix features do not fit in RAM, recomputing them every step')
 
-    trainloader = torch.utils.data.DataLoader(trainset, batch_size=batch_size, shuffle=False, drop_last=True, num_workers=0)#, generator=generator)
-    validloader = torch.utils.data.DataLoader(validset, batch_size=batch_size, shuffle=False, drop_last=True, num_workers=0)#, generator=generator)
+    if train_in_ram:
+        trainloader = BatchIterator(x_train, y_train, rank_batch_size, shuffle=shuffle, drop_last=not keep_last_batch, seed=seed)
+    else:
+        trainloader = StreamingBatchIterator(x_train, y_train, rank_batch_size, shuffle=shuffle, drop_last=not keep_last_batch, seed=seed)
+    validloader = BatchIterator(x_valid[valid_rows], y_valid[valid_rows], rank_batch_size, shuffle=False, drop_last=not keep_last_batch)
+    x_test, y_test = x_test[test_rows], y_test[test_rows]
+
+    # the checkpoint --resume continues from, if there is one
+    checkpoint_filename = model_filename + '.ckpt'
+    resuming = resume and os.path.exists(checkpoint_filename)
+    head_valid_loss = None
+    if head_solve:
+        head = list(model.model)[-2:]
+        if not (isinstance(head[0], torch.nn.Linear) and isinstance(head[1], Affine)
+                and frozen_prefix_length(model) == len(model.model) - 2):
+            raise ValueError("head_solve needs a freeze strategy that only leaves the output Linear and Affine trainable (early_4)")
+
+    # early_4: only the output Linear and Affine are trained, which is linear least squares on the
+    # frozen features. Solve it directly; the n_epochs Adam epochs below, if any, then polish it.
+    # Not solved when a checkpoint is resumed: the checkpoint has the weights.
+    if head_solve and not resuming:
+        solve_start = time.perf_counter()
+        features = (lambda t: t) if forward_model is not model else model.model[:-2]
+        solve_output_head(features, head[0], head[1], x_train, y_train, device, ridge, eval_chunk_size)
+        head_metrics = chi2_metrics(eval_delta_chi2(forward_model, x_test, y_test, device, eval_chunk_size))
+        with torch.no_grad():
+            head_loss = full_batch_loss(forward_model, loss_fcn, x_train, y_train, device, eval_chunk_size)
+            forward_model.eval()
+            losses = []
+            for X_v, Y_v_batch in validloader:
+                with autocast_context(precision, device):
+                    Y_v_pred = forward_model(X_v.to(device))
+                losses.append(float(loss_fcn(Y_v_batch.to(device), Y_v_pred.float())))
+            head_valid_loss = float(np.mean(losses))
+        print(f'Output head solved by ridge least squares in {time.perf_counter() - solve_start:.1f} s: '
+              f'training loss {head_loss:1.3e}, validation loss {head_valid_loss:1.3e}, '
+              f'test median Delta Chi2 {head_metrics["median_chi2"]:1.3e}')
+
+    if ensemble > 1:
+        histories, metrics = train_ensemble(replicas, loss_form, learning_rate, weight_decay, n_epochs,
+            trainloader, validloader, x_test, y_test, device, eval_every, eval_chunk_size,
+            patience, min_lr, target_median_chi2)
+
+        if stream_file is not None:
+            del trainloader, y_train
+            os.remove(stream_file)
+
+        print('')
+        print('Testing results.')
+        print(' seed | mean Delta Chi2 | median Delta Chi2 | N Chi2 > 1 | frac Chi2 < 0.2')
+        for s, replica, h, m in zip(seeds, replicas, histories, metrics):
+            model_file_s, extra_file_s = replica_filenames(model_filename, extra_filename, s)
+            save_histories(h, seed_filename(losses_file, s), seed_filename(metrics_file, s), save_losses, save_testing_metrics)
+            torch.save(replica.state_dict(), model_file_s)
+            save_extra(extra_file_s, samples_mean, samples_std, dv_fid, dv_evals, dv_evecs, sampled_params)
+            print(f' {s:4d} | {m["mean_chi2"]:15.3e} | {m["median_chi2"]:17.3e} | {m["n_gt_1"]:10d} | {m["frac_lt_0p2"]:15.3f}')
+
+        medians = np.array([m['median_chi2'] for m in metrics])
+        print(f'Median Delta Chi2 over seeds = {np.mean(medians):1.3e} +- {np.std(medians):1.3e}')
+        print('\nDone!')
+        return metrics
+
+    if lbfgs_steps > 0 and not train_in_ram:
+        raise ValueError("lbfgs_steps needs the training set in RAM, use a smaller n_train")
 
     # begin training
     print('Begin training...',end='')
     train_start_time = datetime.now()
 
-    losses_train = []
-    losses_valid = []
     loss = 100.
-    #initialize testing metrics lists
-    test_mean_chi2 = []
-    test_median_chi2 = []
-    test_frac_gt_0p2 = []
-    test_frac_gt_1 = []
-    # ======= New additions from Béla =======
-    test_frac_lt_0p2 = []      # fraction with chi^2 < 0.2
-    test_criterion_met = []    # boolean if criterion is satisfied
+    histories = new_histories()
+    losses_train = histories['losses_train']
+    losses_valid = histories['losses_valid']
+
+    # resume from the last checkpoint. The batch order of every epoch only depends on the seed and
+    # the epoch number, so together with the restored states the run continues bit-for-bit.
+    first_epoch = 0
+    metrics = None
+    early_stopping = EarlyStopping(patience, min_lr, target_median_chi2)
+
+    # the solved head is where early stopping starts from: the Adam epochs only replace it if they do better
+    if head_valid_loss is not None:
+        early_stopping.update(head_valid_loss, model, first_epoch-1)
+
+    if resuming:
+        checkpoint = load_checkpoint(checkpoint_filename, model, optim, scheduler)
+        first_epoch = checkpoint['epoch']
+        for key in histories:
+            histories[key].extend(checkpoint['histories'][key])
+        metrics = checkpoint.get('metrics', None)
+        if 'early_stopping' in checkpoint:
+            early_stopping.load_state_dict(checkpoint['early_stopping'])
+        print(f'\rResuming from {checkpoint_filename} at epoch {first_epoch}...',end='')
+    elif resume:
+        print(f'\rNo checkpoint at {checkpoint_filename}, starting from scratch...',end='')
+
+    # data-parallel: the gradients are averaged over the ranks during backward
+    if world_size > 1:
+        train_model = DistributedDataParallel(forward_model, device_ids=[device] if device.startswith('cuda') else None)
+    else:
+        train_model = forward_model
 
-    for e in range(n_epochs):
-        model.train()
+    # the training step compiled on its first call. Validation and testing stay eager, they are a
+    # small fraction of the time and run in eval mode (another graph).
+    optim_step = optim.step
+    if compile_step:
+        train_model = compile_model(train_model)
+        optim_step  = compile_optimizer_step(optim)
+
+    train_time    = 0.0
+    train_samples = 0
+
+    for e in range(first_epoch, n_epochs):
+        forward_model.train()
 
         # training loss
         losses = []
-        for i, data in enumerate(trainloader):    
-            X       = data[0].to(device)
-            Y_batch = data[1].to(device)
-            Y_pred  = model(X)
+        epoch_start = time.perf_counter()
+        # the peak memory of the training steps is the same every epoch, measure it on the first
+        with PeakMemory(device) if e == first_epoch else contextlib.nullcontext() as peak_memory:
+            for X, Y_batch in trainloader.epoch(e):
+                X       = X.to(device)
+                Y_batch = Y_batch.to(device)
+                with autocast_context(precision, device):
+                    Y_pred = train_model(X)
 
-            # PCA part
-            diff = Y_batch - Y_pred
-            chi2 = torch.diag(diff @ torch.t(diff))
+                # PCA part, always in float32
+                loss = loss_fcn(Y_batch, Y_pred.float())
 
-            # loss = torch.mean(chi2)                      # ordinary chi2
-            loss = torch.mean((1+2*chi2)**(1/2))-1       # hyperbola
-            # loss = torch.mean(torch.mean(chi2**(1/2)))   # sqrt(chi2)
+                losses.append(loss.cpu().detach().numpy())
 
-            losses.append(loss.cpu().detach().numpy())
+                optim.zero_grad()
+                loss.backward()
+                optim_step()
 
-            optim.zero_grad()
-            loss.backward()
-            optim.step()
+        train_time    += time.perf_counter() - epoch_start
+
+        if e == first_epoch:
+            print(f'\rPeak memory of a training step (batch {rank_batch_size}): {peak_memory.peak/2**20:.1f} MB, '
+                  f'{peak_memory.increase/2**20:.1f} MB above the memory in use before training')
+        train_samples += len(losses) * rank_batch_size * world_size
 
-        losses_train.append(np.mean(losses))
+        losses_train.append(all_reduce_mean(float(np.mean(losses))))
 
         ###validation loss
         losses=[]
         with torch.no_grad():
-            model.eval()
+            forward_model.eval()
             losses = []
-            for i, data in enumerate(validloader):  
-                X_v       = data[0].to(device)
-                Y_v_batch = data[1].to(device)
-                Y_v_pred = model(X_v)
+            for X_v, Y_v_batch in validloader:
+                X_v       = X_v.to(device)
+                Y_v_batch = Y_v_batch.to(device)
+                with autocast_context(precision, device):
+                    Y_v_pred = forward_model(X_v)
 
-                diff_v = Y_v_batch - Y_v_pred
-                chi2_v = torch.diag(diff_v @ torch.t(diff_v))
-
-                # loss_vali = torch.mean(chi2_v)                      # ordinary chi2
-                loss_vali = torch.mean((1+2*chi2_v)**(1/2))-1       # hyperbola
-                # loss_vali = torch.mean(torch.mean(chi2_v**(1/2)))   # sqrt(chi2)
+                loss_vali = loss_fcn(Y_v_batch, Y_v_pred.float())
 
                 losses.append(float(loss_vali.cpu().detach().numpy()))
 
-            losses_valid.append(np.mean(losses))
+            # mean over all the validation batches of all ranks, so every rank steps the scheduler
+            # (and early stopping) on the same value
+            losses_valid.append(all_reduce_mean(float(np.mean(losses)) if losses else 0.0, len(losses)))
 
-            scheduler.step(losses_valid[e])
+            scheduler.step(losses_valid[-1])
             optim.zero_grad()
 
-        ### Testing metrics at each epoch
-        with torch.no_grad():
-            Y_t = model(x_test.to(device))
-            delta_chi2 = torch.diag((y_test.to(device) - Y_t) @ torch.t(y_test.to(device) - Y_t))
-            
-            # Compute metrics
-            mean_chi2 = torch.mean(delta_chi2).cpu().detach().numpy()
-            median_chi2 = torch.median(delta_chi2).cpu().detach().numpy()
-            
-            # Count fractions
-            n_total = len(delta_chi2)
-            n_gt_0p2 = torch.sum((delta_chi2 > 0.2).float()).cpu().detach().numpy()
-            n_gt_1 = torch.sum((delta_chi2 >= 1).float()).cpu().detach().numpy()
-            # ====== New addition: > to < ===== 
-            n_lt_0p2 = torch.sum((delta_chi2 < 0.2).float()).cpu().detach().numpy()
-            
-            # ====== New computing fractions =-=====
-            frac_gt_0p2 = n_gt_0p2 / n_total   # fraction with chi^2 > 0.2
-            frac_gt_1 = n_gt_1 / n_total       # fraction greater than 1
-            frac_lt_0p2 = n_lt_0p2 / n_total   # fraction with chi^2 < 0.2
-            criterion_met = frac_lt_0p2 > 0.1  # fractional criterion
-
-            # Append to lists
-            test_mean_chi2.append(mean_chi2)
-            test_median_chi2.append(median_chi2)
-            test_frac_gt_0p2.append(frac_gt_0p2)   # same as before, but defining fraction outside of testing
-            test_frac_gt_1.append(frac_gt_1)       # same as before, but defining fraction outside of testing
-            test_frac_lt_0p2.append(frac_lt_0p2)   # New
-            test_criterion_met.append(float(criterion_met)) # New
-
-
-        progress_bar(losses_train[-1],losses_valid[-1],train_start_time, e, n_epochs, optim)
-    
-    if ( save_losses ):
-        np.savetxt("losses.txt", np.array([losses_train,losses_valid],dtype=np.float64))
+        early_stopping.update(losses_valid[-1], model, e)
+
+        ### Testing metrics every eval_every epochs, and always on the last one
+        evaluated = False
+        if( e == n_epochs-1 or (eval_every > 0 and (e+1) % eval_every == 0) ):
+            evaluated = True
+            delta_chi2 = all_gather_cat(eval_delta_chi2(forward_model, x_test, y_test, device, eval_chunk_size))
+            metrics = chi2_metrics(delta_chi2)
+            append_metrics(histories, metrics, e)
+
+        stop_reason = early_stopping.stop_reason(optim, model, metrics if evaluated else None) if early_stopping.enabled else None
+
+        if( rank == 0 and checkpoint_every > 0 and ((e+1) % checkpoint_every == 0 or stop_reason is not None) ):
+            save_checkpoint(checkpoint_filename, e+1, model, optim, scheduler, histories,
+                metrics=metrics, early_stopping=early_stopping.state_dict())
+
+        progress_bar(losses_train[-1],losses_valid[-1],train_start_time, e, n_epochs, optim, first_epoch)
+
+        if stop_reason is not None:
+            print(f'\nEarly stopping at epoch {e+1}: {stop_reason}')
+            break
+
+    if rank == 0 and keep_checkpoint:
+        save_checkpoint(checkpoint_filename, len(losses_train), model, optim, scheduler, histories,
+            metrics=metrics, early_stopping=early_stopping.state_dict())
+
+    # second-order fine-tuning, from the best Adam weights. Early stopping keeps following the
+    # validation loss, so the weights saved are the best of both phases. Not run once the Adam
+    # phase met target_median_chi2: those are the weights kept.
+    if lbfgs_steps > 0 and not early_stopping.reached_target:
+        if early_stopping.enabled:
+            early_stopping.restore_best(model)
+        metrics = train_lbfgs(model, loss_fcn, x_train, y_train, validloader, x_test, y_test, device,
+            lbfgs_steps, histories, early_stopping, len(losses_train), lr=lbfgs_lr, max_iter=lbfgs_max_iter,
+            weight_decay=weight_decay, chunk_size=eval_chunk_size, eval_every=eval_every, forward_model=forward_model)
+
+    # with early stopping we keep the weights with the best validation loss, and the final testing
+    # metrics are those of the weights we save
+    if early_stopping.enabled and early_stopping.best_state is not None:
+        if early_stopping.best_epoch < 0:
+            print(f'\nKeeping the solved output head, no epoch improved on it (validation loss {early_stopping.best_loss:1.3e})')
+        else:
+            print(f'\nRestoring the weights of epoch {early_stopping.best_epoch+1} (validation loss {early_stopping.best_loss:1.3e})')
+        early_stopping.restore_best(model)
+        metrics = None
 
-    if ( save_testing_metrics ):
-        np.savetxt("testing_metrics.txt", np.array([
-            test_mean_chi2,           # mean chi2
-            test_median_chi2,         # median chi2  
-            test_frac_gt_0p2,         # fraction > 0.2
-            test_frac_gt_1,           # fraction > 1.0
-            test_frac_lt_0p2,         # NEW fraction < 0.2 
-            test_criterion_met        # NEW criterion met (1 if True, 0 if False)
-        ], dtype=np.float64))
+    # also happens when resuming a checkpoint written after the last epoch
+    if metrics is None:
+        metrics = chi2_metrics(all_gather_cat(eval_delta_chi2(forward_model, x_test, y_test, device, eval_chunk_size)))
+
+    if train_time > 0:
+        rate = train_samples / train_time
+        print(f'\nTraining throughput: {rate:1.3e} samples/s on {world_size} rank(s), {rate/world_size:1.3e} samples/s per rank')
+
+    if stream_file is not None:
+        del trainloader, y_train
+        os.remove(stream_file)
+
+    # only rank 0 writes the outputs
+    if rank != 0:
+        cleanup_distributed()
+        return
+
+    save_histories(histories, losses_file, metrics_file, save_losses, save_testing_metrics)
 
-    # save the model
+    # save the model, with the LoRA updates folded into the weights
+    if freeze_strategy == 'lora':
+        merge_lora(model)
     torch.save(model.state_dict(), model_filename)
-    with h5.File(extra_filename, 'w') as f:
-        f['sample_mean']   = samples_mean
-        f['sample_std']    = samples_std
-        f['dv_fid']        = dv_fid
-        f['dv_evals']      = dv_evals
-        f['dv_evecs']      = dv_evecs
-        f['train_params']  = sampled_params
+    save_extra(extra_filename, samples_mean, samples_std, dv_fid, dv_evals, dv_evecs, sampled_params)
 
+    # the run is complete, the checkpoint is no longer needed
+    if not keep_checkpoint and os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
 
     # now lets test the model
     print('')
@@ -737,37 +2018,93 @@ def train_emulator(train_yaml, probe,
     #      = (dv.T U D^{-1/2}) @ (D^{-1/2} U^{-1} dv)
     #      = dv_norm.T @ dv_norm
     # and dv_norm is just the model output!
-
-    Y_t = model(x_test.to(device))
-    delta_chi2 = torch.diag((y_test.to(device) - Y_t) @ torch.t(y_test.to(device) - Y_t))
-
-    chi2_g_1  = 0
-    chi2_g_p2 = 0
-
-    for c in delta_chi2:
-        if( c>0.2 and c<1 ):
-            chi2_g_p2 += 1
-        elif( c>=1 ):
-            chi2_g_1 += 1
+    #
+    # The last epoch is always evaluated, so metrics already hold the final model's results.
 
     print('Testing results.')
-    print('Mean   Delta Chi2 = {:1.3e}'.format(torch.mean(delta_chi2).cpu().detach().numpy()))
-    print('Median Delta Chi2 = {:1.3e}'.format(torch.median(delta_chi2).cpu().detach().numpy()))
-    print('N points with Chi2 > 1  :', chi2_g_1)
-    print('N points with Chi2 > 0.2:', chi2_g_p2)
+    print('Mean   Delta Chi2 = {:1.3e}'.format(metrics['mean_chi2']))
+    print('Median Delta Chi2 = {:1.3e}'.format(metrics['median_chi2']))
+    print('N points with Chi2 > 1  :', metrics['n_gt_1'])
+    print('N points with Chi2 > 0.2:', metrics['n_gt_0p2'] - metrics['n_gt_1']) # 0.2 < chi2 < 1
     # === New additions by Béla ===
-    print("N points with Chi2 < 0.2: {}".format(n_lt_0p2)) 
-    print("Fraction with Chi2 < 0.2: {:.3f}".format(frac_lt_0p2))
-    print("Fractional criterion (>0.1): {} (Target: True)".format(criterion_met))
+    print("N points with Chi2 < 0.2: {}".format(metrics['n_lt_0p2'])) 
+    print("Fraction with Chi2 < 0.2: {:.3f}".format(metrics['frac_lt_0p2']))
+    print("Fractional criterion (>0.1): {} (Target: True)".format(metrics['criterion_met']))
 
+    # is the bf16 speedup safe? The saved model is used in float32; also show what bf16 inference
+    # would give, and the float32 run it should match
+    if precision == 'bf16':
+        with autocast_context(precision, device):
+            metrics_bf16 = chi2_metrics(eval_delta_chi2(forward_model, x_test, y_test, device, eval_chunk_size))
+        precision_report(metrics, metrics_bf16,
+            load_metrics_file(reference_metrics) if reference_metrics is not None else None)
+
+    cleanup_distributed()
 
     # Done :)
     print('\nDone!')
 
-    return
+    return metrics
 
 if __name__ == "__main__":
+    args, unknown = get_parser().parse_known_args()
+    cobaya_yaml   = args.cobaya_yaml
+    probe         = args.probe
+    n_epochs      = args.n_epochs
+    batch_size    = args.batch_size
+    learning_rate = args.learning_rate
+    weight_decay  = args.weight_decay
+    save_losses   = args.save_losses
+    # ======== Additions by Béla =======  
+    save_testing_metrics = args.save_testing_metrics
+    n_train = args.n_train
+    squeeze_factor = args.squeeze_factor
+    # === TRANSFER LEARNING VARIABLES ===
+    transfer_learning = args.transfer_learning
+    pretrained_model = args.pretrained_model
+    freeze_strategy = args.freeze_strategy
+    loss_form = args.loss_form
+    eval_every = args.eval_every
+    eval_chunk_size = args.eval_chunk_size
+    shuffle = args.shuffle
+    seed = args.seed
+    keep_last_batch = args.keep_last_batch
+    cache_preprocessing = args.cache_preprocessing
+    checkpoint_every = args.checkpoint_every
+    resume = args.resume
+    distributed = args.distributed
+    ensemble = args.ensemble
+    patience = args.patience
+    min_lr = args.min_lr
+    target_median_chi2 = args.target_median_chi2
+    lbfgs_steps = args.lbfgs_steps
+    lbfgs_max_iter = args.lbfgs_max_iter
+    lbfgs_lr = args.lbfgs_lr
+    precision = args.precision
+    compile_step = args.compile
+    cache_frozen_prefix = not args.recompute_frozen_prefix
+    head_solve = args.head_solve
+    ridge = args.ridge
+    lora_ranks = parse_lora_ranks(args.lora_rank)
+    lora_alpha = args.lora_alpha
+    lock_input_cols = args.lock_input_cols
+    renormalize_inputs = args.renormalize_inputs
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
     train_emulator(cobaya_yaml, probe, 
         n_epochs, batch_size, learning_rate, weight_decay, 
         save_losses, save_testing_metrics, squeeze_factor,
-        transfer_learning, pretrained_model, freeze_strategy)
+        transfer_learning, pretrained_model, freeze_strategy,
+        loss_form=loss_form, eval_every=eval_every, eval_chunk_size=eval_chunk_size,
+        shuffle=shuffle, seed=seed, keep_last_batch=keep_last_batch, n_train=n_train,
+        cache_preprocessing=cache_preprocessing, checkpoint_every=checkpoint_every, resume=resume,
+        patience=patience, min_lr=min_lr, target_median_chi2=target_median_chi2, distributed=distributed,
+        ensemble=ensemble, model_file=args.model_file, extra_file=args.extra_file,
+        losses_file=args.losses_file, metrics_file=args.metrics_file,
+        lbfgs_steps=lbfgs_steps, lbfgs_max_iter=lbfgs_max_iter, lbfgs_lr=lbfgs_lr,
+        precision=precision, reference_metrics=args.reference_metrics, compile_step=compile_step,
+        cache_frozen_prefix=cache_frozen_prefix, head_solve=head_solve, ridge=ridge,
+        lora_ranks=lora_ranks, lora_alpha=lora_alpha, lock_input_cols=lock_input_cols,
+        renormalize_inputs=renormalize_inputs)